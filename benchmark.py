@@ -0,0 +1,1043 @@
+'''
+Micro-benchmarks for performance sensitive parts of the server
+
+$ python benchmark.py parser
+$ python benchmark.py spec -n 5
+$ python benchmark.py coordinate --rows 1000000
+$ python benchmark.py xml -n 100
+$ python benchmark.py signup --sizes 100,1000,10000
+$ python benchmark.py snp -n 3
+$ python benchmark.py ttam -n 20 --latency 100
+
+Benchmarks that need a database create their data under a dedicated owner
+in the database given by `--database` (a SQLite file by default).
+'''
+import os
+import sys
+import json
+import time
+import timeit
+import random
+import subprocess
+from copy import deepcopy
+from datetime import datetime
+from argparse import ArgumentParser
+
+BASEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fhir')
+CONDITION_DIR = os.path.join(BASEDIR, 'examples', 'conditions')
+
+PATIENT = {
+    'resourceType': 'Patient',
+    'text': {
+        'status': 'generated',
+        'div': '<div><p>John Smith</p></div>'
+    },
+    'name': [{'text': 'John Smith', 'family': ['Smith'], 'given': ['John']}],
+    'gender': {
+        'text': 'male',
+        'coding': [{
+            'code': 'M',
+            'system': 'http://hl7.org/fhir/v3/AdministrativeGender'}]
+    }
+}
+
+OBSERVATION = {
+    'resourceType': 'Observation',
+    'name': {
+        'text': 'Genetic analysis',
+        'coding': [{
+            'code': '55233-1',
+            'display': 'Genetic analysis master panel',
+            'system': 'http://loinc.org'}]
+    },
+    'interpretation': {
+        'coding': [{
+            'code': 'POS',
+            'display': 'Positive',
+            'system': 'http://hl7.org/fhir/vs/observation-interpretation'}]
+    },
+    'status': 'final',
+    'reliability': 'ok',
+    'subject': {'reference': 'Patient/example'},
+    'extension': [{
+        'url': 'http://genomics.smartplatforms.org/dictionary/GeneticObservation#AssessedCondition',
+        'valueReference': {'reference': 'Condition/example'}
+    }]
+}
+
+SEQUENCE = {
+    'resourceType': 'Sequence',
+    'text': {
+        'status': 'generated',
+        'div': '<div>Genotype of rs12345 is AG</div>'
+    },
+    'type': 'dna',
+    'patient': {'reference': 'Patient/example'},
+    'chromosome': {'text': '1'},
+    'start': 150000,
+    'end': 150001,
+    'source': {'text': 'germline'},
+    'observedSequence': ['A', 'G']
+}
+
+
+def load_examples():
+    '''
+    return a list of (resource_type, resource) used as benchmark input
+    '''
+    examples = [('Patient', PATIENT),
+                ('Observation', OBSERVATION),
+                ('Sequence', SEQUENCE)]
+    for example in sorted(os.listdir(CONDITION_DIR)):
+        with open(os.path.join(CONDITION_DIR, example)) as example_f:
+            condition = json.load(example_f)
+        condition['subject'] = {'reference': 'Patient/example'}
+        examples.append(('Condition', condition))
+    return examples
+
+
+def report(name, runs, seconds):
+    print '%-30s %10.1f us/call' % (name, seconds / runs * 1e6)
+
+
+def walk(datatype, data, correctible):
+    '''
+    Same as `fhir_parser.parse` but builds a `FHIRElement` for every element spec on every call.
+
+    This is the original (uncompiled) validator, which compiled plans are compared against.
+    '''
+    from fhir.fhir_spec import SPECS
+    from fhir.fhir_parser import add_custom_search_elements
+    search_elements = []
+    if datatype in SPECS:
+        elements = [FHIRElement(element_spec, correctible)
+                    for element_spec in SPECS[datatype]['elements']]
+
+        search_elements = [element.get_search_elements()
+                           for element in elements if element.validate(data)]
+        if len(elements) != len(search_elements):
+            return False, None
+        search_elements = filter(lambda x: x.get('spec') is not None,
+                        search_elements)
+
+    return True, add_custom_search_elements(datatype, data, correctible, search_elements)
+
+
+class FHIRElement(object):
+    '''
+    validator of an element spec, used by `walk`
+    '''
+
+    def __init__(self, spec, correctible):
+        self.correctible = correctible
+        self.path = spec['path']
+        self.elem_types = []
+        if 'type' in spec['definition']:
+            self.elem_types = [_type['code']
+                               for _type in spec['definition']['type']]
+        self.min_occurs = spec['definition']['min']
+        self.max_occurs = spec['definition']['max']
+        self.search_spec = spec.get('searchParam')
+        self.search_elements = []
+
+    def _push_ancestors(self, jsondict, path_elems, elem_ancestors):
+        cur_key = path_elems[0]
+        if cur_key not in jsondict:
+            return
+        val = jsondict[cur_key]
+        if isinstance(val, dict):
+            elem_ancestors.append((val, path_elems[1:]))
+        else:
+            elem_ancestors.extend(
+                [(ancestor, path_elems[1:]) for ancestor in val])
+
+    def get_search_elements(self):
+        return {'spec': self.search_spec, 'elements': self.search_elements}
+
+    def validate(self, data):
+        from fhir import fhir_parser
+        path_elems = self.path.split('.')
+        if len(path_elems) == 1:
+            return True
+        elem_name = path_elems[-1]
+        path_elems = path_elems[1:-1]
+        elem_parents = []
+        elem_ancestors = []
+
+        if len(path_elems) == 0:
+            elem_parents = [data]
+        else:
+            self._push_ancestors(data, path_elems, elem_ancestors)
+
+        while len(elem_ancestors) > 0:
+            ancestor, ancestor_path = elem_ancestors.pop()
+            if len(ancestor_path) == 0:
+                elem_parents.append(ancestor)
+            else:
+                self._push_ancestors(ancestor, ancestor_path, elem_ancestors)
+
+        for parent in elem_parents:
+            if not isinstance(parent, dict):
+                return False
+
+            elem = parent.get(elem_name)
+
+            if elem is None:
+                if self.min_occurs > 0:
+                    return False
+                continue
+
+            if isinstance(elem, list):
+                if self.max_occurs != "*":
+                    return False
+
+                elems = elem
+                for i, elem in enumerate(elems):
+                    if not self.validate_elem(elem):
+                        if not self.correctible:
+                            return False
+
+                        corrected = fhir_parser.correct_element(elem, self.elem_types)
+                        if corrected is not None:
+                            elems[i] = corrected
+                        return False
+
+            elif self.max_occurs == '*' and not self.correctible:
+                return False
+
+            elif not self.validate_elem(elem):
+                if not self.correctible:
+                    return False
+
+                corrected = fhir_parser.correct_element(elem, self.elem_types)
+                if corrected is not None:
+                    if self.max_occurs == '*':
+                        parent[elem_name] = [corrected]
+                    else:
+                        parent[elem_name] = corrected
+                else:
+                    return False
+            elif self.max_occurs == '*':
+                # in this case, the elem itself is correct, with a cardinality
+                # or '*' but stored as a single item
+                parent[elem_name] = [elem]
+
+        return True
+
+    def validate_elem(self, elem):
+        from fhir.fhir_parser import FHIR_PRIMITIVE_VALIDATORS
+        for elem_type in self.elem_types:
+            if elem_type in FHIR_PRIMITIVE_VALIDATORS:
+                validate_func = FHIR_PRIMITIVE_VALIDATORS[elem_type]
+                if not validate_func(elem):
+                    return False
+                else:
+                    continue
+
+            elif elem_type == 'Resource' and 'resourceType' in elem:
+                elem_type = elem['resourceType']
+
+            # type of the element is a complex type
+            valid, _ = walk(elem_type, elem, self.correctible)
+            if not valid:
+                return False
+
+        if self.search_spec is not None:
+            self.search_elements.append(elem)
+
+        return True
+
+
+def bench_parser(args):
+    '''
+    compare compiled validator plans against the original walker
+    '''
+    from fhir import fhir_parser
+
+    examples = load_examples()
+    for resource_type, resource in examples:
+        # make sure both implementations agree before timing them
+        compiled = fhir_parser.parse(resource_type, deepcopy(resource), False)
+        walked = walk(resource_type, deepcopy(resource), False)
+        assert compiled[0] and walked[0]
+        assert sorted(compiled[1]) == sorted(walked[1])
+
+    for name, parse in (('walker', walk), ('compiled plan', fhir_parser.parse)):
+        for resource_type in ('Patient', 'Observation', 'Sequence', 'Condition'):
+            # validation might correct data in place so we give each call its own copy
+            inputs = [deepcopy(resource)
+                      for _ in xrange(args.runs)
+                      for rtype, resource in examples if rtype == resource_type]
+            num_calls = len(inputs)
+            seconds = timeit.timeit(lambda: parse(resource_type, inputs.pop(), False),
+                                    number=num_calls)
+            report('%s (%s)' % (name, resource_type), num_calls, seconds)
+
+
+# measures import time of specs. and memory used by a worker after it parses a few resources
+SPEC_PROBE = '''
+import time
+from resource import getrusage, RUSAGE_SELF
+start_rss = getrusage(RUSAGE_SELF).ru_maxrss
+start = time.time()
+import fhir
+import_time = time.time() - start
+import benchmark
+from fhir.fhir_parser import parse
+for resource_type, data in benchmark.load_examples():
+    parse(resource_type, data, False)
+print import_time, getrusage(RUSAGE_SELF).ru_maxrss - start_rss
+'''
+
+
+def bench_spec(args):
+    '''
+    measure cost of loading specs. in a fresh worker process
+    '''
+    basedir = os.path.dirname(os.path.abspath(__file__))
+    for _ in xrange(args.runs):
+        output = subprocess.check_output([sys.executable, '-c', SPEC_PROBE], cwd=basedir)
+        import_time, rss = output.split()
+        print 'import fhir %8.1f ms, RSS %8d KB' % (float(import_time) * 1e3, int(rss))
+
+
+def make_large_sequence(num_elements):
+    '''
+    make a Sequence resource with `num_elements` observed bases
+    '''
+    sequence = deepcopy(SEQUENCE)
+    sequence['observedSequence'] = [random.choice('ACGT') for _ in xrange(num_elements)]
+    return sequence
+
+
+def bench_xml(args):
+    '''
+    time conversion between json and xml
+    '''
+    from io import BytesIO
+    from lxml import etree
+    from fhir.util import json_to_xml, xml_to_json, parse_xml
+
+    examples = load_examples()
+    examples.append(('Sequence (%d elements)' % args.elements, make_large_sequence(args.elements)))
+    for name, resource in examples:
+        xml = json_to_xml(resource)
+        resource_type = resource['resourceType']
+        seconds = timeit.timeit(lambda: json_to_xml(resource), number=args.runs)
+        report('json to xml (%s)' % name, args.runs, seconds)
+        seconds = timeit.timeit(lambda: xml_to_json(etree.fromstring(xml), resource_type),
+                                number=args.runs)
+        report('xml to json (%s)' % name, args.runs, seconds)
+        seconds = timeit.timeit(lambda: parse_xml(BytesIO(xml)), number=args.runs)
+        report('streaming xml to json (%s)' % name, args.runs, seconds)
+
+
+BENCH_OWNER = 'benchmark'
+CHROMOSOMES = [str(chrom) for chrom in xrange(1, 23)] + ['X', 'Y']
+# roughly the length of chromosome 1
+MAX_POSITION = 249000000
+
+
+class BenchUser(object):
+    email = BENCH_OWNER
+
+
+class MockG(object):
+    def __init__(self):
+        self._nodep_buffers = {}
+        self._reference_cache = {}
+
+
+def get_bench_app(args):
+    from fhir import create_app
+    return create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+
+
+def populate_sequences(num_rows):
+    '''
+    insert synthetic Sequence resources (without search params) until there are `num_rows` of them
+    '''
+    from fhir.models import db, Resource, User
+    from fhir.util import get_bin
+    if User.query.get(BENCH_OWNER) is None:
+        db.session.add(User(email=BENCH_OWNER))
+        db.session.commit()
+    existing = Resource.query.filter_by(owner_id=BENCH_OWNER, resource_type='Sequence').count()
+    now = datetime.now()
+    rand = random.Random(existing)
+    for batch_start in xrange(existing, num_rows, 10000):
+        rows = []
+        for i in xrange(batch_start, min(batch_start + 10000, num_rows)):
+            start = rand.randint(0, MAX_POSITION)
+            end = start + rand.randint(0, 1000)
+            rows.append({
+                'owner_id': BENCH_OWNER,
+                'resource_id': 'seq-%d' % i,
+                'resource_type': 'Sequence',
+                'update_time': now,
+                'create_time': now,
+                'data': '{}',
+                'version': 1,
+                'visible': True,
+                'chromosome': rand.choice(CHROMOSOMES),
+                'start': start,
+                'end': end,
+                'bin': get_bin(start, end)
+            })
+        Resource.core_insert(rows)
+
+
+def bench_coordinate(args):
+    '''
+    time `Sequence?coordinate=..` search with and without genomic bins
+    '''
+    from fhir.models import db, Resource
+    from fhir.query_builder import QueryBuilder, COORD_RE
+
+    def make_unbinned_pred(coord):
+        coord_match = COORD_RE.match(coord)
+        return db.and_(Resource.resource_type == 'Sequence',
+                       Resource.chromosome == coord_match.group('chrom'),
+                       Resource.start <= int(coord_match.group('end')),
+                       Resource.end >= int(coord_match.group('start')))
+
+    with get_bench_app(args).app_context():
+        populate_sequences(args.rows)
+        query_builder = QueryBuilder(BenchUser)
+        binned = query_builder.build_query('Sequence', {'coordinate': args.coordinate})
+        unbinned = Resource.query.filter(Resource.visible == True,
+                                         Resource.owner_id == BENCH_OWNER,
+                                         make_unbinned_pred(args.coordinate))
+        assert binned.count() == unbinned.count()
+        for name, query in (('without bins', unbinned), ('with bins', binned)):
+            # a search fetches a page and counts all matches (see `fhir_api.FHIRBundle`)
+            seconds = timeit.timeit(lambda: (query.limit(50).all(), query.count()),
+                                    number=args.runs)
+            report('%s (%d rows)' % (name, args.rows), args.runs, seconds)
+
+
+GIVEN_NAMES = ['John', 'Jane', 'Mary', 'James', 'Robert', 'Linda', 'Michael', 'Susan']
+
+
+def make_family_name(rand):
+    return ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz') for _ in xrange(7)).capitalize()
+
+
+def populate_patients(num_rows):
+    '''
+    insert synthetic Patient resources and their `name` search params until there are `num_rows` of them
+    '''
+    from fhir.models import db, Resource, SearchParam, User
+    from fhir.search_stats import analyze
+    if User.query.get(BENCH_OWNER) is None:
+        db.session.add(User(email=BENCH_OWNER))
+        db.session.commit()
+    existing = Resource.query.filter_by(owner_id=BENCH_OWNER, resource_type='Patient').count()
+    now = datetime.now()
+    rand = random.Random(existing)
+    for batch_start in xrange(existing, num_rows, 10000):
+        resources = []
+        params = []
+        for i in xrange(batch_start, min(batch_start + 10000, num_rows)):
+            key = {
+                'owner_id': BENCH_OWNER,
+                'resource_id': 'pt-%d' % i,
+                'resource_type': 'Patient',
+                'update_time': now
+            }
+            resources.append(dict(key, create_time=now, data='{}', version=1, visible=True))
+            params.append(dict(key,
+                               param_type='string',
+                               name='name',
+                               missing=False,
+                               text='::%s::%s::' % (rand.choice(GIVEN_NAMES), make_family_name(rand))))
+        Resource.core_insert(resources)
+        SearchParam.core_insert(params)
+    # as `load_bulk.py` does (see `fhir.search_stats`)
+    analyze(db.engine)
+
+
+def bench_text(args):
+    '''
+    time `Patient?name=..` search with and without the trigram index (see `fhir.text_index`)
+    '''
+    from fhir.models import db
+    from fhir.query_builder import QueryBuilder
+    from fhir import text_index
+
+    app = get_bench_app(args)
+    with app.app_context():
+        populate_patients(args.rows)
+        query_builder = QueryBuilder(BenchUser)
+        url = str(db.engine.url)
+        indexed = text_index.create_text_index(db.engine)
+        # family name of the first patient (see `populate_patients`), and a common given name
+        rand = random.Random(0)
+        rand.choice(GIVEN_NAMES)
+        for name in (make_family_name(rand), 'Mary'):
+            counts = []
+            for use_index in (False, True):
+                if db.engine.dialect.name == 'sqlite':
+                    text_index._has_fts[url] = use_index and indexed
+                elif not use_index:
+                    # stop Postgres from using the trigram index
+                    db.session.execute('SET LOCAL enable_bitmapscan = off')
+                query = query_builder.build_query('Patient', {'name': name})
+                # a search fetches a page and counts all matches (see `fhir_api.FHIRBundle`)
+                seconds = timeit.timeit(lambda: (query.limit(50).all(), query.count()),
+                                        number=args.runs)
+                counts.append(query.count())
+                db.session.rollback()
+                report('name=%s (%s index, %d rows)' % (name, 'with' if use_index else 'without', args.rows),
+                       args.runs, seconds)
+            assert counts[0] == counts[1]
+        print 'trigram index available: %s' % indexed
+
+
+NUM_OBSERVATION_CODES = 100
+NUM_OBSERVATION_SUBJECTS = 1000
+
+
+def populate_observations(num_rows):
+    '''
+    insert synthetic Observations and their `subject`, `name` and `date` search params
+    until there are `num_rows` of them
+    '''
+    from fhir.models import db, Resource, SearchParam, User
+    from fhir.search_stats import analyze
+    if User.query.get(BENCH_OWNER) is None:
+        db.session.add(User(email=BENCH_OWNER))
+        db.session.commit()
+    existing = Resource.query.filter_by(owner_id=BENCH_OWNER, resource_type='Observation').count()
+    now = datetime.now()
+    rand = random.Random(existing)
+    for batch_start in xrange(existing, num_rows, 10000):
+        resources = []
+        # rows of an executemany have to have the same columns, hence a list per param type
+        subjects, names, dates = [], [], []
+        for i in xrange(batch_start, min(batch_start + 10000, num_rows)):
+            key = {
+                'owner_id': BENCH_OWNER,
+                'resource_id': 'obs-%d' % i,
+                'resource_type': 'Observation',
+                'update_time': now
+            }
+            resources.append(dict(key, create_time=now, data='{}', version=1, visible=True))
+            date = datetime(rand.randint(2000, 2015), rand.randint(1, 12), rand.randint(1, 28))
+            subjects.append(dict(key, param_type='reference', name='subject', missing=False,
+                                 referenced_type='Patient',
+                                 referenced_id='pt-%d' % rand.randrange(NUM_OBSERVATION_SUBJECTS)))
+            names.append(dict(key, param_type='token', name='name', missing=False,
+                              system='http://loinc.org',
+                              code='code-%d' % rand.randrange(NUM_OBSERVATION_CODES)))
+            dates.append(dict(key, param_type='date', name='date', missing=False,
+                              start_date=date, end_date=date))
+        Resource.core_insert(resources)
+        for params in (subjects, names, dates):
+            SearchParam.core_insert(params)
+    # as `load_bulk.py` does (see `fhir.search_stats`)
+    analyze(db.engine)
+
+
+def bench_search(args):
+    '''
+    time multi-parameter searches of Observations,
+    planned (see `fhir.query_builder`) vs. intersecting subqueries of every parameter (what we did before)
+    '''
+    from fhir.models import db, Resource, SearchParam
+    from fhir.fhir_spec import SPECS
+    from fhir.query_builder import QueryBuilder
+
+    searches = [
+        {'subject:Patient': 'pt-7', 'name': 'code-3', 'date': '>2010-01-01'},
+        {'name': 'code-3', 'date': '>2010-01-01'},
+        {'date': '>2015-06-01', 'name': 'code-3,code-4'},
+        {'date': '>2015-06-01', 'subject:Patient': 'pt-7,pt-8'},
+        {'subject:Patient': 'pt-7'}
+    ]
+
+    def build_intersect_query(query_builder, params):
+        preds = [query_builder.make_pred_from_param('Observation', param_and_val,
+                                                    SPECS['Observation']['searchParams'])[0]
+                 for param_and_val in params.iteritems()]
+        selected = db.intersect(*[db.select([SearchParam.resource_id]).where(pred) for pred in preds])
+        return Resource.query.filter(Resource.visible == True,
+                                     Resource.resource_type == 'Observation',
+                                     Resource.owner_id == BENCH_OWNER,
+                                     Resource.resource_id.in_(selected.alias()))
+
+    with get_bench_app(args).app_context():
+        populate_observations(args.rows)
+        query_builder = QueryBuilder(BenchUser)
+        for params in searches:
+            search = '&'.join('%s=%s' % item for item in sorted(params.iteritems()))
+            planned = query_builder.build_query('Observation', params)
+            intersected = build_intersect_query(query_builder, params)
+            assert planned.count() == intersected.count()
+            for name, query in (('intersect', intersected), ('planned', planned)):
+                # a search fetches a page and counts all matches (see `fhir_api.FHIRBundle`)
+                seconds = timeit.timeit(lambda: (query.limit(50).all(), query.count()),
+                                        number=args.runs)
+                report('%s (%s)' % (search, name), args.runs, seconds)
+            print '%-30s %10d matches' % ('', planned.count())
+
+
+def bench_chain(args):
+    '''
+    time chained searches of Observations (referencing Patients),
+    compiled into joins (see `QueryBuilder.select_chain`) vs. nested subqueries (what we did before)
+    '''
+    from fhir.models import db, Resource, SearchParam
+    from fhir.query_builder import QueryBuilder
+
+    class NestedQueryBuilder(QueryBuilder):
+        def make_chain_pred(self, param_data, param_val, resource_type, depth):
+            referenced_type = self.get_referenced_type(param_data, resource_type)
+            chained_query = self.build_query(referenced_type, {param_data['chained_param']: param_val})
+            ids = chained_query.with_entities(Resource.resource_id).subquery()
+            pred = db.and_(SearchParam.referenced_type == referenced_type,
+                           SearchParam.referenced_id.in_(ids))
+            return pred, chained_query.count()
+
+    with get_bench_app(args).app_context():
+        populate_observations(args.rows)
+        populate_patients(args.rows / 10)
+        # family name of the first patient (see `populate_patients`)
+        rand = random.Random(0)
+        rand.choice(GIVEN_NAMES)
+        searches = [
+            ('Observation', {'subject:Patient.name': make_family_name(rand)}),
+            ('Observation', {'subject:Patient.name': 'Mary', 'name': 'code-3'}),
+            ('Observation', {'subject:Patient._has:Observation:subject:name': 'code-3', 'date': '>2015-06-01'}),
+            ('Patient', {'_has:Observation:subject:name': 'code-3'})
+        ]
+        for resource_type, params in searches:
+            search = '%s?%s' % (resource_type, '&'.join('%s=%s' % item for item in sorted(params.iteritems())))
+            counts = []
+            for name, query_builder in (('nested', NestedQueryBuilder(BenchUser)), ('joined', QueryBuilder(BenchUser))):
+                if resource_type == 'Patient' and name == 'nested':
+                    # reverse chains weren't supported
+                    continue
+                query = query_builder.build_query(resource_type, params)
+                # a search fetches a page and counts all matches (see `fhir_api.FHIRBundle`)
+                seconds = timeit.timeit(lambda: (query.limit(50).all(), query.count()),
+                                        number=args.runs)
+                counts.append(query.count())
+                report('%s (%s)' % (search, name), args.runs, seconds)
+            assert len(set(counts)) == 1
+            print '%-30s %10d matches' % ('', counts[0])
+
+
+def bench_include(args):
+    '''
+    time a page of Observations with their subjects included (`_include`)
+    vs. the page followed by a read of every subject (what a client had to do before)
+    '''
+    from fhir.models import db, Session
+
+    app = get_bench_app(args)
+    with app.app_context():
+        populate_observations(args.rows)
+        populate_patients(NUM_OBSERVATION_SUBJECTS)
+        if Session.query.get(BENCH_OWNER) is None:
+            db.session.add(Session(id=BENCH_OWNER, user_id=BENCH_OWNER))
+            db.session.commit()
+    client = app.test_client()
+    client.set_cookie('localhost', 'session_id', BENCH_OWNER)
+    search_url = '/api/Observation?name=code-3&_format=json&_total=none'
+
+    def get(url):
+        resp = client.get(url)
+        assert resp.status_code == 200
+        return json.loads(resp.data)
+
+    subject_urls = ['/api/%s?_format=json' % entry['title']
+                    for entry in get(search_url + '&_include=Observation:subject')['entry']
+                    if entry['title'].startswith('Patient/')]
+
+    def get_each():
+        get(search_url)
+        for url in subject_urls:
+            get(url)
+
+    for name, run in (('read each subject', get_each),
+                      ('_include', lambda: get(search_url + '&_include=Observation:subject'))):
+        seconds = timeit.timeit(run, number=args.runs)
+        report('page with subjects (%s)' % name, args.runs, seconds)
+    print '%-30s %10d subjects' % ('', len(subject_urls))
+
+
+PAGE_OWNER = 'benchmark-page'
+
+
+def get_page_client(app, num_elements):
+    '''
+    return a test client of a user with 50 Observations and 50 Sequences (with `num_elements` bases),
+    i.e. a page of each
+    '''
+    from fhir.models import db, Resource, Session, User
+    with app.app_context():
+        if User.query.get(PAGE_OWNER) is None:
+            db.session.add(User(email=PAGE_OWNER))
+            db.session.add(Session(id=PAGE_OWNER, user_id=PAGE_OWNER))
+            db.session.commit()
+            sequence = make_large_sequence(num_elements)
+            Resource.core_insert([Resource(resource_type, data, PAGE_OWNER).get_insert_params()
+                                  for resource_type, data in (('Observation', OBSERVATION),
+                                                              ('Sequence', sequence))
+                                  for _ in xrange(50)])
+    client = app.test_client()
+    client.set_cookie('localhost', 'session_id', PAGE_OWNER)
+    return client
+
+
+def bench_projection(args):
+    '''
+    measure bytes and time of a page of Observations and Sequences (with --elements bases)
+    with `_summary` and `_elements`, and time dumping a page of summaries
+    saved with resources (see `fhir.projection`) vs. made from whole resources
+    '''
+    from fhir.models import db, Resource
+    from fhir.fhir_api import dump_json_entry
+    from fhir.projection import Projection, project
+
+    app = get_bench_app(args)
+    client = get_page_client(app, args.elements)
+    searches = [
+        'Observation?_format=json',
+        'Observation?_format=json&_summary=true',
+        'Observation?_format=json&_summary=data',
+        'Observation?_format=json&_elements=name,subject',
+        'Observation?_summary=true',
+        'Sequence?_format=json',
+        'Sequence?_format=json&_summary=true',
+        'Sequence?_format=json&_elements=chromosome,start,end',
+        'Sequence?_format=json&_elements=observedSequence',
+        'Sequence?_summary=true',
+    ]
+    for search in searches:
+        url = '/api/%s&_total=none' % search
+        resp = client.get(url)
+        assert resp.status_code == 200
+        seconds = timeit.timeit(lambda: client.get(url).data, number=args.runs)
+        report(search, args.runs, seconds)
+        print '%-30s %10d bytes' % ('', len(resp.data))
+
+    with app.app_context():
+        projection = Projection('true', None)
+        for resource_type in ('Observation', 'Sequence'):
+            resources = (Resource.query
+                    .filter_by(owner_id=PAGE_OWNER, resource_type=resource_type)
+                    .options(db.undefer(Resource.summary))
+                    .all())
+            def dump_made():
+                for resource in resources:
+                    data = project(json.loads(resource.data), resource_type, summary='true')
+                    json.dumps(data, separators=(',', ':'))
+            for name, dump in (('whole', lambda: [dump_json_entry(resource, '/') for resource in resources]),
+                               ('made summary', dump_made),
+                               ('saved summary', lambda: [dump_json_entry(resource, '/', projection=projection)
+                                                          for resource in resources])):
+                seconds = timeit.timeit(dump, number=args.runs)
+                report('dump 50 %ss (%s)' % (resource_type, name), args.runs, seconds)
+
+
+def bench_conditional(args):
+    '''
+    time reading a Sequence (with --elements bases) and searching a page of them,
+    unconditionally vs. with `If-None-Match` of what's read before (i.e. 304)
+    '''
+    from fhir.models import Resource
+
+    app = get_bench_app(args)
+    client = get_page_client(app, args.elements)
+    with app.app_context():
+        sequence_id = Resource.query.filter_by(owner_id=PAGE_OWNER, resource_type='Sequence').first().resource_id
+    for name, url in (('read', '/api/Sequence/%s?_format=json' % sequence_id),
+                      ('search', '/api/Sequence?_format=json')):
+        etag = client.get(url).headers['ETag']
+        for headers in ({}, {'If-None-Match': etag}):
+            status = client.get(url, headers=headers).status_code
+            seconds = timeit.timeit(lambda: client.get(url, headers=headers).data, number=args.runs)
+            report('%s (%d)' % (name, status), args.runs, seconds)
+
+
+def make_snp_file(snp_file, num_snps):
+    '''
+    write a synthetic SNP file (formatted like fhir/ttam/snps.sorted.txt.gz) and index it with tabix,
+    return path of the compressed file
+    '''
+    import pysam
+    rand = random.Random(0)
+    snps = sorted((rand.choice(CHROMOSOMES), rand.randint(1, MAX_POSITION), 'rs%d' % i)
+                  for i in xrange(num_snps))
+    with open(snp_file, 'w') as snp_f:
+        for line_num, (chrom, pos, rsid) in enumerate(snps):
+            snp_f.write('%d\t%s\t%s\t%d\n' % (line_num, rsid, chrom, pos))
+    return pysam.tabix_index(snp_file, seq_col=2, start_col=3, end_col=3, force=True)
+
+
+def bench_snp(args):
+    '''
+    time looking up SNPs of a 23andMe `Sequence?coordinate=..` search with 1, 10, and 100 regions,
+    and getting a page of SNPs of a large region
+    '''
+    from fhir.ttam import util as ttam_util
+    from fhir.ttam.adaptor import extract_coords
+
+    snp_file = args.snp_file
+    if snp_file is None:
+        snp_file = make_snp_file('/tmp/fhir_benchmark_snps.txt', args.snps)
+    ttam_util.SNP_FILE = snp_file
+
+    def get_snps_before(coords):
+        # what we did before: open the file, and fetch with an iterator of its own, for every region
+        from pysam import TabixFile, asTuple
+        snp_table = {}
+        for coord in coords:
+            rows = TabixFile(snp_file, parser=asTuple()).fetch(
+                    coord.get('chrom'), coord.get('start'), coord.get('end'), multiple_iterators=True)
+            snp_table.update((row[ttam_util.SNP_IDX], (row[ttam_util.CHROM_IDX], row[ttam_util.POS_IDX]))
+                             for row in rows)
+        return snp_table
+
+    def get_snps(coords, cached):
+        if not cached:
+            ttam_util._region_cache.clear()
+        snp_table = {}
+        for coord in coords:
+            snp_table.update(ttam_util.get_snps(**coord))
+        return snp_table
+
+    rand = random.Random(0)
+    for num_regions in (1, 10, 100):
+        regions = []
+        for _ in xrange(num_regions):
+            start = rand.randint(0, MAX_POSITION)
+            regions.append('%s:%d-%d' % (rand.choice(CHROMOSOMES), start, start + 100000))
+        coords = extract_coords({'coordinate': ','.join(regions)})
+        assert get_snps_before(coords) == get_snps(coords, False)
+        for name, lookup in (('reopened', get_snps_before),
+                             ('kept open', lambda coords: get_snps(coords, False)),
+                             ('kept open, cached', lambda coords: get_snps(coords, True))):
+            seconds = timeit.timeit(lambda: lookup(coords), number=args.runs)
+            report('%d regions (%s)' % (num_regions, name), args.runs, seconds)
+
+    # fetches of the whole file (e.g. `Sequence` without a coordinate) read it from the start,
+    # whatever was fetched before in this thread
+    from itertools import islice
+    whole_file = list(ttam_util.get_snp_data())
+    assert len(whole_file) > 0 and list(ttam_util.get_snp_data()) == whole_file
+    # and so do counts and pages of them (e.g. after a region is read), which are what
+    # `Sequence` without a coordinate is answered with (see `fhir.ttam.adaptor.get_many`)
+    ttam_util._count_cache.clear()
+    ttam_util.get_snps(CHROMOSOMES[0])
+    assert ttam_util.count_snps([(None, None, None)]) == len(whole_file)
+    assert len(list(islice(ttam_util.iter_distinct_snps([(None, None, None)]), 10))) == 10
+
+    # a page of SNPs of a whole chromosome: read all of its SNPs and slice (what we did before)
+    # vs. count SNPs once and read only SNPs up to the end of the page
+    regions = [(CHROMOSOMES[0], None, None)]
+    def get_page_before():
+        snp_table = dict(ttam_util.get_snps(*regions[0]))
+        return ttam_util.slice_(snp_table.keys(), 100, 10)
+    def get_page():
+        return (list(islice(ttam_util.iter_distinct_snps(regions), 100, 110)),
+                ttam_util.count_snps(regions))
+    for name, get in (('read all', get_page_before), ('read page', get_page)):
+        seconds = timeit.timeit(get, number=args.runs)
+        report('page of chromosome (%s)' % name, args.runs, seconds)
+
+
+class StubTTAM(object):
+    '''
+    A local stand-in for 23andMe API (a WSGI app) that answers after `latency` seconds
+    and counts requests it gets
+    '''
+    PROFILES = [{'id': 'profile%d' % i, 'first_name': 'John', 'last_name': 'Doe %d' % i}
+                for i in xrange(3)]
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.num_requests = 0
+
+    def __call__(self, environ, start_response):
+        import time
+        from urlparse import parse_qs
+        self.num_requests += 1
+        time.sleep(self.latency)
+        path = environ['PATH_INFO']
+        if path == '/token/':
+            body = {'access_token': 'stub', 'refresh_token': 'stub', 'expires_in': 86400}
+        elif path == '/1/names/':
+            body = {'profiles': self.PROFILES}
+        elif path.startswith('/1/genotypes/'):
+            locations = parse_qs(environ['QUERY_STRING'])['locations'][0].split()
+            body = {'id': path.rsplit('/', 1)[-1],
+                    'genotypes': [{'location': rsid, 'call': 'AG'} for rsid in locations]}
+        else:
+            start_response('404 NOT FOUND', [])
+            return ['']
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps(body)]
+
+
+def start_stub_ttam(latency):
+    '''
+    serve a `StubTTAM` in a background thread, return it and its url
+    '''
+    from threading import Thread
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    stub = StubTTAM(latency)
+    server = make_server('127.0.0.1', 0, stub, threaded=True, request_handler=QuietRequestHandler)
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    return stub, 'http://127.0.0.1:%d/' % server.server_port
+
+
+def bench_ttam(args):
+    '''
+    time 23andMe API calls (made to a local stub server) with and without cache,
+    and count calls made upstream when identical calls are made concurrently
+    '''
+    from threading import Thread
+    from fhir.ttam import models as ttam_models, cache as ttam_cache, upstream
+    from fhir.ttam.models import TTAMClient
+
+    stub, stub_url = start_stub_ttam(args.latency / 1000.)
+    ttam_models.TOKEN_URI = stub_url + 'token/'
+    ttam_models.API_BASE = stub_url + '1/'
+    ttam_config = {'client_id': 'benchmark', 'client_secret': 'benchmark',
+                   'redirect_uri': stub_url, 'scope': 'genomes names'}
+    app = get_bench_app(args)
+    app.config['TTAM_CONFIG'] = ttam_config
+    rsids = ['rs%d' % i for i in xrange(100)]
+    with app.app_context():
+        client = TTAMClient('benchmark', BENCH_OWNER, ttam_config)
+        for name, call in (('get_patients', client.get_patients),
+                           ('get_snps', lambda: client.get_snps(rsids))):
+            for cached in (False, True):
+                ttam_cache.get_cache().clear()
+                call()
+                num_requests = stub.num_requests
+                def run():
+                    if not cached:
+                        ttam_cache.get_cache().clear()
+                    call()
+                seconds = timeit.timeit(run, number=args.runs)
+                report('%s (%s)' % (name, 'cached' if cached else 'uncached'), args.runs, seconds)
+                print '%-30s %10d requests' % ('', stub.num_requests - num_requests)
+
+        ttam_cache.get_cache().clear()
+        num_requests = stub.num_requests
+        def get_patients():
+            with app.app_context():
+                client.get_patients()
+        threads = [Thread(target=get_patients) for _ in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print '10 concurrent get_patients      %10d requests' % (stub.num_requests - num_requests)
+        print 'cache hit rate %.2f, %d calls coalesced' % (ttam_cache.get_hit_rate(),
+                                                           ttam_cache.STATS['coalesced'])
+
+        # long lists of SNPs are split into multiple (concurrent) requests
+        many_rsids = ['rs%d' % i for i in xrange(args.snps_per_call)]
+        ttam_cache.get_cache().clear()
+        num_requests = stub.num_requests
+        started = time.time()
+        snps = client.get_snps(many_rsids)
+        print '%-30s %10.1f ms, %d requests, %d genotypes' % (
+                'get_snps (%d SNPs)' % len(many_rsids), (time.time() - started) * 1000,
+                stub.num_requests - num_requests, sum(map(len, snps.itervalues())))
+        print 'upstream: %d requests, %d errors, %.1f ms per call' % (
+                upstream.STATS['requests'], upstream.STATS['errors'],
+                upstream.get_average_latency() * 1000)
+
+
+def populate_public_data(num_resources):
+    '''
+    index example resources as public data (owned by super user) until there are `num_resources` of them
+    '''
+    from fhir.models import db, Resource, User, commit_buffers
+    from fhir.indexer import index_resources
+    from fhir.fhir_parser import parse_resources
+    if User.query.get('super') is None:
+        db.session.add(User(email='super'))
+        db.session.commit()
+    existing = Resource.query.filter_by(owner_id='super').count()
+    examples = load_examples()
+    for batch_start in xrange(existing, num_resources, 1000):
+        batch = [deepcopy(examples[i % len(examples)])
+                 for i in xrange(batch_start, min(batch_start + 1000, num_resources))]
+        resources = [(Resource(resource['resourceType'], resource, owner_id='super'), search_elements)
+                     for _, resource, search_elements in parse_resources(batch)]
+        buf = MockG()
+        index_resources(resources, g=buf)
+        commit_buffers(buf)
+
+
+def bench_signup(args):
+    '''
+    time signing up (which copies all public data to the new user) against size of public data
+    '''
+    from uuid import uuid4
+    from fhir.ui import create_user
+    from fhir.models import SearchParam
+
+    def signup():
+        create_user({'email': 'signup-%s' % uuid4(), 'password': 'benchmark'})
+
+    with get_bench_app(args).test_request_context():
+        for size in sorted(int(size) for size in args.sizes.split(',')):
+            populate_public_data(size)
+            num_params = SearchParam.query.filter_by(owner_id='super').count()
+            seconds = timeit.timeit(signup, number=args.signups)
+            report('signup (%d resources, %d params)' % (size, num_params), args.signups, seconds)
+
+
+BENCHMARKS = {
+    'parser': bench_parser,
+    'spec': bench_spec,
+    'coordinate': bench_coordinate,
+    'text': bench_text,
+    'search': bench_search,
+    'chain': bench_chain,
+    'include': bench_include,
+    'projection': bench_projection,
+    'conditional': bench_conditional,
+    'xml': bench_xml,
+    'signup': bench_signup,
+    'snp': bench_snp,
+    'ttam': bench_ttam,
+}
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    arg_parser.add_argument('-n', '--runs', type=int, default=1000)
+    arg_parser.add_argument('--database', default='sqlite:////tmp/fhir_benchmark.db')
+    arg_parser.add_argument('--rows', type=int, default=1000000)
+    arg_parser.add_argument('--coordinate', default='1:100000-200000')
+    arg_parser.add_argument('--elements', type=int, default=10000,
+            help='number of elements of the synthetic resource used by the xml benchmark')
+    arg_parser.add_argument('--sizes', default='100,1000,10000',
+            help='sizes of public data used by the signup benchmark')
+    arg_parser.add_argument('--signups', type=int, default=3)
+    arg_parser.add_argument('--snp-file', help='tabix-indexed SNP file used by the snp benchmark, '
+                            'a synthetic one with --snps SNPs is made by default')
+    arg_parser.add_argument('--snps', type=int, default=1000000)
+    arg_parser.add_argument('--latency', type=int, default=100,
+            help='latency (in milliseconds) of the stub 23andMe server used by the ttam benchmark')
+    arg_parser.add_argument('--snps-per-call', type=int, default=1000,
+            help='number of SNPs asked for by the last get_snps of the ttam benchmark')
+    args = arg_parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
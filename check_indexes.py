@@ -0,0 +1,146 @@
+'''
+Check that every shape of search query (see `fhir.query_builder.PRED_MAKERS`)
+is answered with indexes rather than scans of whole tables,
+by looking at query plans (EXPLAIN) of the database in `config.py`
+
+$ python check_indexes.py [--database sqlite:////tmp/fhir.db] [-v]
+
+Exits with status 1 if any query scans a whole table.
+Run `python migrate_db.py` first if the database is created by an older version of the server.
+'''
+import sys
+import json
+from argparse import ArgumentParser
+from fhir import create_app, db
+from fhir.fhir_spec import SPECS, REFERENCE_TYPES
+from fhir.models import Resource
+from fhir.query_builder import QueryBuilder, PRED_MAKERS
+
+# tables that must not be scanned
+CHECKED_TABLES = ('resource', 'searchparam')
+# a search param value of each type
+SAMPLE_VALUES = {
+    'quantity': '5.4|http://unitsofmeasure.org|mg',
+    'number': '>1',
+    'token': 'http://loinc.org|1234-5',
+    'date': '>2015-01-01',
+    'string': 'smith',
+    'reference': 'example'
+}
+
+
+class CheckUser(object):
+    email = 'check_indexes'
+
+
+def find_param(param_type):
+    '''
+    return (resource type, name) of a search param of a type
+    '''
+    for resource_type in sorted(SPECS):
+        for name, spec_type in sorted(SPECS[resource_type]['searchParams'].iteritems()):
+            if spec_type != param_type:
+                continue
+            reference_types = REFERENCE_TYPES[resource_type].get(name)
+            if param_type == 'reference' and (len(reference_types) != 1 or reference_types[0] == 'Any'):
+                # the referenced type can't be deducted
+                continue
+            return resource_type, name
+    return None
+
+
+def get_query_shapes():
+    '''
+    yield (description, query) of searches of every shape
+    '''
+    query_builder = QueryBuilder(CheckUser)
+    for param_type in sorted(PRED_MAKERS.keys() + ['reference']):
+        found = find_param(param_type)
+        if found is None:
+            print 'skip no search param is of type %s' % param_type
+            continue
+        resource_type, name = found
+        shapes = [(name, SAMPLE_VALUES[param_type])]
+        if param_type == 'string':
+            shapes.append((name + ':exact', 'Smith'))
+        for param, value in shapes:
+            yield ('%s?%s=%s' % (resource_type, param, value),
+                   query_builder.build_query(resource_type, {param: value}))
+    resource_type, name = find_param('token')
+    yield ('%s?%s:missing=true' % (resource_type, name),
+           query_builder.build_query(resource_type, {name + ':missing': 'true'}))
+    # several params, some of which might be checked per resource (see `QueryBuilder.build_query`)
+    params = dict((param, SAMPLE_VALUES[param_type])
+                  for param, param_type in SPECS[resource_type]['searchParams'].iteritems()
+                  if param_type in ('token', 'date'))
+    yield ('%s?%s' % (resource_type, '&'.join('%s=%s' % item for item in sorted(params.iteritems()))),
+           query_builder.build_query(resource_type, params))
+    yield ('Sequence?coordinate=1:100000-200000',
+           query_builder.build_query('Sequence', {'coordinate': '1:100000-200000'}))
+    yield ('Patient', query_builder.build_query('Patient', {}))
+
+
+def explain(conn, query):
+    '''
+    return plan of a query as a list of (table, uses index) and its text
+    '''
+    # a page of a search, see `fhir_api.FHIRBundle`
+    ordered = query.order_by(Resource.update_time, Resource.resource_id).limit(50)
+    compiled = ordered.statement.compile(bind=db.engine)
+    cursor = conn.cursor()
+    if db.engine.dialect.name == 'sqlite':
+        params = [compiled.params[name] for name in compiled.positiontup]
+        cursor.execute('EXPLAIN QUERY PLAN %s' % compiled, params)
+        details = [row[-1] for row in cursor.fetchall()]
+        accesses = []
+        for detail in details:
+            words = detail.split()
+            if words[0] in ('SCAN', 'SEARCH') and words[1] in CHECKED_TABLES:
+                # a SCAN reads every row, even if it's done with an index
+                accesses.append((words[1], words[0] == 'SEARCH'))
+        return accesses, '\n'.join(details)
+    else:
+        # tables are likely too small for the planner to bother with indexes
+        cursor.execute('SET enable_seqscan = off')
+        cursor.execute('EXPLAIN (FORMAT JSON) %s' % compiled, compiled.params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        accesses = []
+        nodes = [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if node.get('Relation Name') in CHECKED_TABLES:
+                accesses.append((node['Relation Name'], node['Node Type'] != 'Seq Scan'))
+            nodes.extend(node.get('Plans', []))
+        return accesses, json.dumps(plan, indent=2)
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--database', help='SQL connection url, the one in config.py by default')
+    arg_parser.add_argument('-v', '--verbose', action='store_true', help='print query plans')
+    args = arg_parser.parse_args()
+    if args.database is not None:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    else:
+        from config import APP_CONFIG
+        app = create_app(APP_CONFIG)
+
+    failed = False
+    with app.app_context():
+        conn = db.engine.raw_connection()
+        try:
+            for description, query in get_query_shapes():
+                accesses, plan = explain(conn, query)
+                scanned = sorted(set(table for table, indexed in accesses if not indexed))
+                if scanned:
+                    failed = True
+                    print 'FAIL %s scans %s' % (description, ', '.join(scanned))
+                else:
+                    print 'ok   %s' % description
+                if args.verbose or scanned:
+                    print '\n'.join('     ' + line for line in plan.splitlines())
+        finally:
+            conn.close()
+    sys.exit(1 if failed else 0)
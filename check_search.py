@@ -0,0 +1,93 @@
+'''
+Check that searches find what they should, for searches whose params are indexed
+by hand rather than from resources, because no resource we have is searchable by them
+(e.g. there are no search params of type quantity in the specs)
+
+$ python check_search.py [--database sqlite:////tmp/fhir.db]
+
+Exits with status 1 if any search finds something other than what's expected.
+Search params added here are removed afterwards.
+'''
+import sys
+from argparse import ArgumentParser
+from fhir import create_app, db
+from fhir.indexer import index_quantity
+from fhir.models import SearchParam
+from fhir.query_builder import make_quantity_pred
+
+OWNER = 'check_search'
+UNIT = '|http://unitsofmeasure.org|mg'
+# resource id -> quantity of it (as in a resource)
+QUANTITIES = {
+    'plain': {'value': 5.4, 'system': 'http://unitsofmeasure.org', 'code': 'mg'},
+    'large': {'value': 7, 'system': 'http://unitsofmeasure.org', 'code': 'mg'},
+    'below': {'value': 3, 'comparator': '<', 'system': 'http://unitsofmeasure.org', 'code': 'mg'},
+    'above': {'value': 10, 'comparator': '>=', 'system': 'http://unitsofmeasure.org', 'code': 'mg'},
+    'other_unit': {'value': 5.4, 'system': 'http://unitsofmeasure.org', 'code': 'g'}
+}
+# search -> ids of resources it should find
+QUANTITY_SEARCHES = {
+    '5.4' + UNIT: ['plain'],
+    '7' + UNIT: ['large'],
+    '10' + UNIT: ['above'],
+    '<6' + UNIT: ['below', 'plain'],
+    '<5' + UNIT: ['below'],
+    '>5' + UNIT: ['above', 'large', 'plain'],
+    '>8' + UNIT: ['above'],
+    '>=7' + UNIT: ['above', 'large'],
+    '5.4||': ['other_unit', 'plain']
+}
+
+
+def add_quantities():
+    '''
+    index quantities of `QUANTITIES`, one of which is stored without a comparator
+    '''
+    indexes = []
+    for resource_id, quantity in QUANTITIES.iteritems():
+        index = index_quantity({'owner_id': OWNER,
+                                'resource_type': 'Observation',
+                                'resource_id': resource_id,
+                                'name': 'value-quantity',
+                                'param_type': 'quantity',
+                                'missing': False}, quantity)
+        if resource_id == 'large':
+            # as indexed by older versions of the server
+            index['comparator'] = None
+        indexes.append(index)
+    db.session.execute(SearchParam.__table__.insert(), indexes)
+
+
+def find(pred):
+    '''
+    return ids of resources with search params matching a predicate
+    '''
+    return sorted(resource_id for resource_id, in
+                  db.session.query(SearchParam.resource_id)
+                  .filter(SearchParam.owner_id == OWNER, pred))
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--database', help='SQL connection url, the one in config.py by default')
+    args = arg_parser.parse_args()
+    if args.database is not None:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': args.database})
+    else:
+        from config import APP_CONFIG
+        app = create_app(APP_CONFIG)
+
+    failed = False
+    with app.app_context():
+        try:
+            add_quantities()
+            for search, expected in sorted(QUANTITY_SEARCHES.iteritems()):
+                found = find(make_quantity_pred({}, search))
+                if found != expected:
+                    failed = True
+                    print 'FAIL value-quantity=%s finds %s rather than %s' % (search, found, expected)
+                else:
+                    print 'ok   value-quantity=%s' % search
+        finally:
+            db.session.rollback()
+    sys.exit(1 if failed else 0)
@@ -4,7 +4,8 @@ import fhir_api
 import fhir_error
 from fhir_spec import RESOURCES
 from query_builder import InvalidQuery
-from models import Access, Session, Client, commit_buffers
+from models import commit_buffers
+import auth_cache
 import ttam
 import util
 from functools import partial, wraps
@@ -28,15 +29,12 @@ def verify_access(request, resource_type, access_type):
         return True
     elif request.client is not None:
         # not a user but an OAuth consumer
-        # check database and verify if the consumer has access
+        # check (cached) accesses granted to the consumer
         request.authorizer = request.client.authorizer
-        if datetime.now() > request.client.expire_at:
+        if (request.client.expire_at is None or
+                datetime.now() > request.client.expire_at):
             return False
-        accesses = Access.query.filter_by(
-                client_code=request.client.code,
-                access_type=access_type,
-                resource_type=resource_type)
-        return accesses.count() > 0
+        return request.client.can_access(resource_type, access_type)
     else:
         return False
 
@@ -71,17 +69,38 @@ def get_client():
     check if a user is logged-in via current session
     '''
     session_id = request.cookies.get('session_id') 
-    request.session = Session.query.filter_by(id=session_id).first()
+    request.session = auth_cache.get_session(session_id)
     request.client = None
     auth_header = AUTH_HEADER_RE.match(request.headers.get('authorization', ''))
     if auth_header is not None:
-        request.client = (Client
-                .query
-                .filter_by(access_token=auth_header.group('access_token'),
-                    authorized=True)
-                .first())
+        request.client = auth_cache.get_client(auth_header.group('access_token'))
         
 
+@api.route('/', methods=['POST'])
+def handle_bundle():
+    '''
+    handle a transaction (a bundle of resources to be created)
+
+    Access is verified for type of every resource in the bundle.
+    '''
+    request.api_base = util.get_api_base() 
+    if request.session is not None:
+        request.authorizer = request.session.user
+    elif request.client is not None:
+        request.authorizer = request.client.authorizer
+    else:
+        return fhir_error.inform_forbidden()
+    fhir_request = fhir_api.FHIRRequest(request)
+    if isinstance(fhir_request.data, dict):
+        resource_types = set(map(fhir_api.get_entry_type, fhir_request.data.get('entry', [])))
+        if not all(verify_access(request, resource_type, 'write')
+                   for resource_type in resource_types
+                   if resource_type in RESOURCES):
+            return fhir_error.inform_forbidden()
+
+    return fhir_api.handle_transaction(fhir_request)
+
+
 @api.route('/<resource_type>', methods=['GET', 'POST'])
 @protected
 def handle_resource(resource_type):
@@ -142,15 +161,24 @@ def init_globals():
 
     To do so, before every request, we declare a global variable (in flasks term) for caching,
     and after every request, we "commit" those buffers.
+
+    We also memoize references resolved by the indexer within a request here
+    (see `indexer.resolve_references`).
     '''
     g._nodep_buffers = {}
+    g._reference_cache = {}
 
 @api.after_request
 def cleanup(resp):
     '''
     See doc of `init_globals`
+
+    Time spent waiting for 23andMe is reported in the `Server-Timing` header.
     '''
     commit_buffers(g)
+    ttam_seconds = getattr(g, 'ttam_seconds', 0.)
+    if ttam_seconds > 0:
+        resp.headers['Server-Timing'] = 'ttam;dur=%.1f' % (ttam_seconds * 1000)
     return resp
 
 
@@ -0,0 +1,138 @@
+'''
+Per-worker cache of authorizations
+
+Without this, every API request queries Session, Client and Access
+before doing any actual work. We cache what a session id or an access token
+resolves to: the user, when it expires, and what resources it can access.
+
+Each worker has its own cache, so a logout or a revocation in one worker
+is only seen by other workers after CACHE_TTL seconds.
+'''
+import time
+from threading import Lock
+from sqlalchemy.orm import make_transient_to_detached
+from database import db
+from models import Session, Client, Access, User
+from util import LRUCache
+
+# seconds an authorization is trusted before we look it up again
+CACHE_TTL = 60
+CACHE_SIZE = 10000
+
+_cache = LRUCache(CACHE_SIZE)
+# counters are updated by threads of a worker, hence the lock
+STATS = {'hits': 0, 'misses': 0}
+_stats_lock = Lock()
+
+
+def get_user(user_id):
+    '''
+    get a user (attached to current database session) without querying database
+    '''
+    user = User(email=user_id)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+class Authorization(object):
+    '''
+    What a session id or an access token resolves to
+    '''
+    def __init__(self, user_id, expire_at=None, client_code=None, accesses=None):
+        self.user_id = user_id
+        self.expire_at = expire_at
+        self.client_code = client_code
+        # set of (resource_type, access_type)
+        self.accesses = accesses
+
+    @property
+    def user(self):
+        return get_user(self.user_id)
+
+    # so that an authorization of an access token can be used like a `Client`
+    authorizer = user
+
+    def can_access(self, resource_type, access_type):
+        return (resource_type, access_type) in self.accesses
+
+
+def _get(key, lookup):
+    '''
+    get an authorization from cache, or look it up if it's not cached (or too old)
+
+    Authorizations that are not found are not cached
+    so that a newly granted one can be used right away.
+    '''
+    cached = _cache.get(key)
+    if cached is not None:
+        auth, cached_until = cached
+        if time.time() < cached_until:
+            with _stats_lock:
+                STATS['hits'] += 1
+            return auth
+    with _stats_lock:
+        STATS['misses'] += 1
+    auth = lookup(key[1])
+    if auth is None:
+        _cache.pop(key)
+    else:
+        _cache.set(key, (auth, time.time() + CACHE_TTL))
+    return auth
+
+
+def _lookup_session(session_id):
+    session = Session.query.get(session_id)
+    if session is None or session.user_id is None:
+        return None
+    return Authorization(session.user_id)
+
+
+def _lookup_token(access_token):
+    client = (Client
+            .query
+            .filter_by(access_token=access_token, authorized=True)
+            .first())
+    if client is None:
+        return None
+    accesses = (db.session.query(Access.resource_type, Access.access_type)
+            .filter_by(client_code=client.code))
+    return Authorization(client.authorizer_id,
+                         expire_at=client.expire_at,
+                         client_code=client.code,
+                         accesses=frozenset(accesses))
+
+
+def get_session(session_id):
+    '''
+    get authorization of a user's session, None if there's no such session
+    '''
+    if not session_id:
+        return None
+    return _get(('session', session_id), _lookup_session)
+
+
+def get_client(access_token):
+    '''
+    get authorization of an OAuth consumer's access token, None if the token is not authorized
+    '''
+    return _get(('token', access_token), _lookup_token)
+
+
+def forget_session(session_id):
+    '''
+    invalidate a session (e.g. when a user logs out)
+    '''
+    _cache.pop(('session', session_id))
+
+
+def forget_token(access_token):
+    '''
+    invalidate an access token (e.g. when it's granted or revoked)
+    '''
+    _cache.pop(('token', access_token))
+
+
+def get_hit_rate():
+    with _stats_lock:
+        hits, lookups = STATS['hits'], STATS['hits'] + STATS['misses']
+    return float(hits) / lookups if lookups > 0 else 0.
@@ -1,37 +1,120 @@
-from flask import Response, render_template, g
+from flask import Response, render_template, g, current_app, stream_with_context
 from database import db
 from models import Resource, SearchParam
 import fhir_parser
 import fhir_error
-from util import json_response, xml_response, xml_bundle_response, xml_to_json, json_to_xml, get_api_base
-from fhir_spec import SPECS, REFERENCE_TYPES
-from query_builder import QueryBuilder
-from indexer import index_resource
+from util import (json_response, xml_response, xml_bundle_response, parse_xml,
+                  json_to_xml, get_api_base, buffer_chunks)
+from fhir_spec import SPECS, REFERENCE_TYPES, RESOURCES
+from query_builder import QueryBuilder, InvalidQuery
+from projection import Projection, SUMMARY_MODES
+from indexer import index_resource, index_resources
+from models import commit_buffers
 import ttam
 import json
+import base64
+import dateutil.parser
+from uuid import uuid4
 from urlparse import urljoin
 from urllib import urlencode
 from datetime import datetime
-from lxml import etree
+from itertools import chain
+from multiprocessing import Pool
 
 # TODO: support composite search param
 
 PAGE_SIZE = 50
+# number of resources fetched from database at a time when streaming a bundle
+STREAM_BATCH_SIZE = 100
+# minimum size (in bytes) of a chunk of a streamed bundle
+STREAM_CHUNK_SIZE = 16 * 1024
 BUNDLE_TITLE = 'SMART Genomics Atom Feed' 
+# how `totalResults` of a bundle is computed (see `count_resources`)
+TOTAL_MODES = ('none', 'estimate', 'accurate')
+# entries of a transaction bundle larger than this are validated in parallel
+PARALLEL_PARSE_THRESHOLD = 100
+# number of processes validating large bundles of each (gunicorn) worker,
+# of which there are already a few per cpu (override with `PARSER_PROCESSES` of app config,
+# 0 to validate every bundle in the worker itself)
+PARSER_PROCESSES = 2
 
-def find_latest_resource(resource_type, resource_id, owner_id):
+# pool of processes used to validate large bundles,
+# created when it's first needed in a (forked) worker.
+_parser_pool = None
+
+
+def get_parser_pool():
+    '''
+    get the pool of processes validating large bundles, None if bundles aren't validated in parallel
+    '''
+    global _parser_pool
+    if _parser_pool is None:
+        processes = current_app.config.get('PARSER_PROCESSES', PARSER_PROCESSES)
+        if processes <= 0:
+            return None
+        _parser_pool = Pool(processes)
+    return _parser_pool
+
+def find_latest_resource(resource_type, resource_id, owner_id, load_data=True):
     '''
-    Find the latest resource given it's type, id, and id of it's owner.
+    Find the latest (i.e. current and visible) resource given it's type, id, and id of it's owner.
     Requiring owner's id here because we don't want people touching other people's resources 
+
+    This is a single lookup of the index of current versions (see `Resource.visible`).
+    Data of the resource is loaded when it's first used if not `load_data`.
+    '''
+    query = Resource.query
+    if not load_data:
+        query = query.options(db.defer(Resource.data))
+    return (query
+            .filter_by(
+                resource_type=resource_type,
+                resource_id=resource_id,
+                owner_id=owner_id,
+                visible=True)
+            .first())
+
+
+def has_history(resource_type, resource_id, owner_id):
+    '''
+    check if a resource has ever existed (e.g. it might have been deleted)
     '''
-    return (Resource
+    return db.session.query(
+            Resource
             .query
             .filter_by(
                 resource_type=resource_type,
                 resource_id=resource_id,
                 owner_id=owner_id)
-            .order_by(Resource.version.desc())
-            .first())
+            .exists()).scalar()
+
+
+def encode_cursor(last_resource, offset, total):
+    '''
+    encode the position of a page as an opaque continuation token
+
+    A page starts after `last_resource` (in order of update_time and resource_id),
+    `offset` is the number of resources before the page, and `total`
+    is the number of resources counted by the first page (if any).
+    '''
+    cursor = [last_resource.update_time.isoformat(), last_resource.resource_id, offset, total]
+    return base64.urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')))
+
+
+def decode_cursor(token):
+    '''
+    decode a continuation token made by `encode_cursor`
+    '''
+    try:
+        update_time, resource_id, offset, total = json.loads(base64.urlsafe_b64decode(str(token)))
+        return {
+            'update_time': dateutil.parser.parse(update_time),
+            'resource_id': resource_id,
+            'offset': int(offset),
+            'total': total
+        }
+    except (TypeError, ValueError):
+        raise InvalidQuery
 
 
 class FHIRRequest(object):
@@ -45,117 +128,234 @@ class FHIRRequest(object):
         self.url = request.url
         self.base_url = request.base_url
         self.authorizer = request.authorizer
+        # an OAuth consumer, whose access is limited to some types of resources
+        self.client = request.client if request.session is None else None
         # paging params
+        # `_cursor` is the continuation token we put in a next link,
+        # `_offset` is kept for compatibility
         self.count = int(self.args.get('_count', PAGE_SIZE))
-        self.offset = int(self.args.get('_offset', 0))
+        self.cursor = (decode_cursor(self.args['_cursor'])
+                       if '_cursor' in self.args
+                       else None)
+        self.offset = (self.cursor['offset']
+                       if self.cursor is not None
+                       else int(self.args.get('_offset', 0)))
+        # validators of a conditional request
+        self.if_none_match = request.if_none_match
+        self.if_modified_since = request.if_modified_since
+        self.is_conditional = bool(self.if_none_match) or self.if_modified_since is not None
+        self.total_mode = self.args.get('_total', 'accurate')
+        if self.total_mode not in TOTAL_MODES:
+            raise InvalidQuery
+        # projection of resources of a bundle (see `projection`), None if they are whole
+        summary = self.args.get('_summary', 'false')
+        if summary not in SUMMARY_MODES:
+            raise InvalidQuery
+        elements = ([element for element in self.args['_elements'].split(',') if element]
+                    if '_elements' in self.args
+                    else None)
+        self.projection = (Projection(summary, elements)
+                           if summary != 'false' or elements is not None
+                           else None)
 
         if request.method in ('POST', 'PUT'):
             # regardless of format of uploaded data
             # we process it as a json object (technically a Python Dict) 
             if self.format == 'xml':
-                dataroot = etree.fromstring(request.data)
-                # tag of an etree element = {whatever xmlns value is}[element name]
-                # we only care about `element name` here
-                resource_type = dataroot.tag.split('}')[-1]
-                self.data = xml_to_json(dataroot, resource_type)
+                # a resource or a bundle (Atom feed)
+                self.data = parse_xml(request.stream)
             else:
                 self.data = json.loads(request.data)
 
-    def _get_url(self, is_prev):
+    def can_read(self, resource_type):
+        '''
+        check if a type of resources can be read, e.g. when they are included by a search
+        '''
+        return self.client is None or self.client.can_access(resource_type, 'read')
+
+    def _get_url(self, **paging_args):
         '''
         helper function for generating paged links
         '''
         args = self.args.to_dict(flat=False)
-        if is_prev:
-            new_offset = self.offset - self.count
-        else:
-            new_offset = self.offset + self.count
-
-        args.update({'_offset': new_offset})
+        args.pop('_offset', None)
+        args.pop('_cursor', None)
+        args.update(paging_args)
 
         return "%s?%s" % (self.base_url, urlencode(args, doseq=True))
 
-    def get_next_url(self):
+    def get_next_url(self, last_resource=None, total=None):
         '''
         return the url of next page
+
+        The url carries a continuation token if the last resource of current page is given,
+        otherwise an offset. There's no next page of empty pages (`_count=0`),
+        which would be the same page over and over again.
         '''
-        return self._get_url(is_prev=False)
+        if self.count <= 0:
+            return None
+        new_offset = self.offset + self.count
+        if last_resource is None:
+            return self._get_url(_offset=new_offset)
+        return self._get_url(_cursor=encode_cursor(last_resource, new_offset, total))
 
     def get_prev_url(self):
         '''
-        return the url of previous page
+        return the url of previous page (None if pages are empty, see `get_next_url`)
         '''
-        return self._get_url(is_prev=True)
+        if self.count <= 0:
+            return None
+        return self._get_url(_offset=self.offset - self.count)
+
+
+def estimate_count(query):
+    '''
+    estimate number of rows returned by a query with the query planner,
+    fall back to an accurate count if the database can't estimate.
+    '''
+    if db.engine.dialect.name != 'postgresql':
+        return query.count()
+    compiled = query.statement.compile(bind=db.engine)
+    plan = db.session.execute('EXPLAIN (FORMAT JSON) %s' % compiled, compiled.params).scalar()
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def load_columns(query, projection, resource_type=None):
+    '''
+    make a query of resources (of `resource_type` if it's known) load what's needed to project them,
+    i.e. their summaries rather than whole resources if they are projected from summaries
+    '''
+    if projection is None:
+        return query
+    if projection.uses_summary(resource_type):
+        # resources saved without a summary (see `migration.backfill_summaries`) are still
+        # projected from whole resources, which are loaded one by one
+        return query.options(db.undefer(Resource.summary), db.defer(Resource.data))
+    elif projection.elements is not None:
+        # some of them might be projected from summaries
+        return query.options(db.undefer(Resource.summary))
+    return query
+
+
+def count_resources(query, request, total=None):
+    '''
+    count resources found by a query as requested by `_total`,
+    unless they are already counted (`total`)
+
+    The count is made by the first page and carried along by continuation tokens,
+    so that later pages don't have to count again.
+    '''
+    if request.total_mode == 'none':
+        return None
+    elif request.cursor is not None and request.cursor['total'] is not None:
+        return request.cursor['total']
+    elif total is not None:
+        return total
+    elif request.total_mode == 'estimate':
+        return estimate_count(query)
+    else:
+        return query.count()
 
 
 class FHIRBundle(object): 
     '''
     Represent a bundle in FHIR
     ''' 
-    def __init__(self, query, request, version_specific=False, ttam_resource=None):
+    def __init__(self, query, request, version_specific=False, ttam_resource=None, include=None, total=None):
+        '''
+        `include` makes queries of resources included by a search (see `_iter_resources`)
+        given ids of resources of the page, `total` is number of resources if they are counted
+        '''
         self.api_base = get_api_base()
         self.request_url = request.url
         self.data_format = request.format
         self.version_specific = version_specific
         self.update_time = datetime.now().isoformat()
 
-        self.resources = query.\
-                limit(request.count).\
-                offset(request.offset).all()
-        self.resource_count = query.count() 
-
-        if ttam_resource is not None:
+        # resources are paged in order of (update_time, resource_id),
+        # so that a page can start right after the last resource of previous page
+        ordered_query = query.order_by(Resource.update_time, Resource.resource_id)
+
+        if ttam_resource is None:
+            if request.cursor is not None:
+                update_time = request.cursor['update_time']
+                page_query = ordered_query.filter(db.or_(
+                    Resource.update_time > update_time,
+                    db.and_(Resource.update_time == update_time,
+                            Resource.resource_id > request.cursor['resource_id'])))
+            else:
+                page_query = ordered_query.offset(request.offset)
+            # fetch one more resource to see if there's a next page.
+            # resources are fetched in batches while the bundle is streamed (see `_iter_resources`),
+            # so we don't know the next page until then
+            self.resources = page_query.limit(request.count + 1).yield_per(STREAM_BATCH_SIZE)
+            self.resource_count = count_resources(query, request, total)
+            self.next_url = None
+        else:
             # 23andMe resource(s) are being requested here.
             # We need to figure out the paging properties for 23andme resources.
             # We preserve determinism here by lining all internal resources before
             # 23andMe resources (
             # think about it like this ...---, with '.' being internal, and '-' being 23andMe.
             # Here we have three internal resources and 3 23andMe resources.
-            # So a 4-offset is the same as a 0-offset of 23andMe resources,
-            # and a 1-offset is also a 0-offset of 23andMe. And so forth).  
-            num_resources = len(self.resources) 
-            ttam_offset = (request.offset - self.resource_count
-                    if request.offset >= self.resource_count
-                    else 0)
-            ttam_limit = request.count - num_resources
-            ttam_resources, ttam_count = ttam.get_many(ttam_resource, request.args, ttam_offset, ttam_limit)
-            self.resource_count += ttam_count 
-            if num_resources < request.count:
-                self.resources.extend(ttam_resources)
-
-        self.next_url = (request.get_next_url()
-                         if len(self.resources) + request.offset < self.resource_count
-                         else None) 
+            # So a 4-offset is the same as a 1-offset of 23andMe resources,
+            # and a 1-offset is a 0-offset of 23andMe. And so forth).
+            # Internal resources of the page are streamed, and only 23andMe resources
+            # of the page are fetched.
+            internal_count = query.count()
+            self.resource_count = internal_count + ttam.count_many(ttam_resource, request.args)
+            num_internal = max(min(internal_count - request.offset, request.count), 0)
+            ttam_offset = max(request.offset - internal_count, 0)
+            ttam_resources = ttam.get_many(ttam_resource,
+                                           request.args,
+                                           ttam_offset,
+                                           request.count - num_internal)
+            internal_resources = (ordered_query.
+                    offset(request.offset).
+                    limit(num_internal).
+                    yield_per(STREAM_BATCH_SIZE)
+                    if num_internal > 0
+                    else [])
+            self.resources = chain(internal_resources, ttam_resources)
+            self.next_url = (request.get_next_url()
+                             if request.offset + request.count < self.resource_count
+                             else None)
+
+        self.request = request
+        self.include = include
         self.prev_url = (request.get_prev_url()
                          if request.offset - request.count >= 0
                          else None)
 
-
-    def _make_bundle(self):
+    def _iter_resources(self):
         '''
-        helper function for creating a bundle as a dictionary
+        iterate over resources of the bundle, setting `next_url` if there's a next page
         '''
-        bundle = {}
-
-        entries = []
-        for resource in self.resources:
-
-            relative_resource_url = resource.get_url(self.version_specific)
-            resource_url = urljoin(self.api_base, relative_resource_url)
-            resource_content = json.loads(resource.data)
-            if self.data_format == 'xml':
-                resource_content = json_to_xml(resource_content)
-
-            entries.append({
-                'content': resource_content,
-                'created': resource.create_time.isoformat(),
-                'updated': resource.update_time.isoformat(),
-                'id': resource_url,
-                'title': relative_resource_url
-            })
-
-        bundle['entry'] = entries
-
+        last_resource = None
+        found = set()
+        for num_resources, resource in enumerate(self.resources):
+            if num_resources == self.request.count:
+                self.next_url = self.request.get_next_url(last_resource, self.resource_count)
+                break
+            last_resource = resource
+            found.add((resource.resource_type, resource.resource_id))
+            yield resource
+        if self.include is None or len(found) == 0:
+            return
+        # resources included by a search (`_include` and `_revinclude`) follow resources of the page,
+        # each of which is only in the bundle once, even if it's found or included more than once
+        for query in self.include([resource_id for _, resource_id in found]):
+            query = load_columns(query, self.request.projection)
+            for resource in query.yield_per(STREAM_BATCH_SIZE):
+                key = (resource.resource_type, resource.resource_id)
+                if key in found or not self.request.can_read(resource.resource_type):
+                    continue
+                found.add(key)
+                yield resource
+
+    def _get_links(self):
         links = [{'rel': 'self', 'href': self.request_url}]
         if self.next_url is not None:
             links.append({
@@ -167,29 +367,157 @@ class FHIRBundle(object):
                 'rel': 'previous',
                 'href': self.prev_url
             })
+        return links
 
-        bundle['link'] = links
-        bundle['totalResults'] = self.resource_count
-        bundle['updated'] = self.update_time
-        bundle['title'] = BUNDLE_TITLE
-        bundle['id'] = self.request_url
-        bundle['resourceType'] = 'Bundle'
-        return bundle
+    def _iter_json(self):
+        '''
+        stream a bundle in json
+        '''
+        bundle = make_bundle(None, None, self.request_url, self.resource_count, self.update_time)
+        del bundle['entry']
+        del bundle['link']
+        yield json.dumps(bundle)[:-1] + ', "entry": ['
+        for num_resources, resource in enumerate(self._iter_resources()):
+            if num_resources > 0:
+                yield ', '
+            yield dump_json_entry(resource, self.api_base, self.version_specific,
+                                  self.request.projection)
+        # links are known only after all entries are streamed
+        yield '], "link": %s}' % json.dumps(self._get_links())
+
+    def _iter_xml(self):
+        '''
+        stream a bundle in xml
+        '''
+        entries = (make_entry(resource, self.api_base, 'xml', self.version_specific,
+                              self.request.projection)
+                   for resource in self._iter_resources())
+        bundle = make_bundle(entries, None, self.request_url, self.resource_count, self.update_time)
+        # the template renders links after entries, by then `next_url` is known
+        bundle['link'] = LazyList(self._get_links)
+        return current_app.jinja_env.get_template('bundle.xml').generate(**bundle)
 
     def as_response(self):
         '''
-        return a bundle as a response
+        return a bundle as a streamed response
         '''
-        bundle_dict = self._make_bundle()
-
         if self.data_format == 'json':
-            response = json_response()
-            response.data = json.dumps(bundle_dict)
+            chunks, make_response = self._iter_json(), json_response
         else:
-            response = xml_bundle_response()
-            response.data = render_template('bundle.xml', **bundle_dict)
+            chunks, make_response = self._iter_xml(), xml_bundle_response
+        return make_response(stream_with_context(buffer_chunks(chunks, STREAM_CHUNK_SIZE)))
 
-        return response
+
+class LazyList(object):
+    '''
+    a sequence that's made (by calling `make_list`) only when it's iterated
+    '''
+    def __init__(self, make_list):
+        self.make_list = make_list
+
+    def __iter__(self):
+        return iter(self.make_list())
+
+
+def _make_entry_head(resource, api_base, version_specific=False):
+    '''
+    make an entry of a bundle without content
+    '''
+    relative_resource_url = resource.get_url(version_specific)
+    return {
+        'created': resource.create_time.isoformat(),
+        'updated': resource.update_time.isoformat(),
+        'id': urljoin(api_base, relative_resource_url),
+        'title': relative_resource_url
+    }
+
+
+def make_entry(resource, api_base, data_format, version_specific=False, projection=None):
+    '''
+    make an entry of a bundle (as a dictionary) given a resource (and its projection)
+    '''
+    entry = _make_entry_head(resource, api_base, version_specific)
+    if projection is not None:
+        data = projection.load(resource)
+        entry['content'] = json_to_xml(data) if data_format == 'xml' else data
+    elif data_format == 'xml':
+        entry['content'] = resource.as_xml()
+    else:
+        entry['content'] = json.loads(resource.data)
+    return entry
+
+
+def dump_json_entry(resource, api_base, version_specific=False, projection=None):
+    '''
+    dump an entry of a bundle as json,
+    data of the resource (already json) is used as is rather than decoded and encoded again
+    '''
+    entry = json.dumps(_make_entry_head(resource, api_base, version_specific))
+    data = resource.data if projection is None else projection.dump(resource)
+    return '%s, "content": %s}' % (entry[:-1], data)
+
+
+def make_bundle(entries, links, bundle_id, total, update_time):
+    '''
+    make a bundle as a dictionary
+    '''
+    bundle = {
+        'entry': entries,
+        'link': links,
+        'updated': update_time,
+        'title': BUNDLE_TITLE,
+        'id': bundle_id,
+        'resourceType': 'Bundle'
+    }
+    if total is not None:
+        bundle['totalResults'] = total
+    return bundle
+
+
+def is_not_modified(request, etag, last_modified=None):
+    '''
+    check if what a conditional request asks for is what the client already has,
+    by `If-None-Match`, or `If-Modified-Since` if the former isn't given
+    '''
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None and last_modified is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def not_modified_response(etag, last_modified=None):
+    '''
+    return a response to a conditional request saying that nothing has changed
+    '''
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def get_search_etag(total, last_update):
+    '''
+    return the (weak) entity tag of resources found by a search given their number and
+    when the last of them was updated, one of which changes if any resource is added,
+    updated or removed
+    '''
+    return '%d-%s' % (total, last_update.strftime('%Y%m%d%H%M%S%f') if last_update is not None else '')
+
+
+def bundle_response(bundle_dict, data_format, status='200'):
+    '''
+    return a bundle (as a dictionary) as a response
+    '''
+    if data_format == 'json':
+        response = json_response(status=status)
+        response.data = json.dumps(bundle_dict)
+    else:
+        response = xml_bundle_response(status=status)
+        response.data = render_template('bundle.xml', **bundle_dict)
+
+    return response
 
 
 def handle_create(request, resource_type):
@@ -208,19 +536,132 @@ def handle_create(request, resource_type):
     return resource.as_response(request, created=True)
 
 
+def get_entry_type(entry):
+    '''
+    get type of the resource of a bundle entry
+    '''
+    content = entry.get('content') if isinstance(entry, dict) else None
+    if isinstance(content, dict):
+        return content.get('resourceType')
+
+
+def link_entries(entries, resource_types):
+    '''
+    assign ids to resources of a transaction bundle and
+    rewrite references between entries (by their ids) as references to the new ids
+
+    return the new ids
+    '''
+    resource_ids = [str(uuid4()) for _ in entries]
+    new_urls = {entry['id']: '%s/%s' % (resource_type, resource_id)
+                for entry, resource_type, resource_id in zip(entries, resource_types, resource_ids)
+                if entry.get('id')}
+    elements = [entry['content'] for entry in entries]
+    while len(elements) > 0:
+        element = elements.pop()
+        if isinstance(element, dict):
+            if element.get('reference') in new_urls:
+                element['reference'] = new_urls[element['reference']]
+            elements.extend(element.itervalues())
+        elif isinstance(element, list):
+            elements.extend(element)
+    return resource_ids
+
+
+def handle_transaction(request):
+    '''
+    handle FHIR transaction: create all resources in a bundle at once
+
+    Either all resources are created or none of them is,
+    in which case we respond with an OperationOutcome for each invalid entry.
+    '''
+    bundle = request.data
+    if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+        return fhir_error.inform_bad_request()
+    entries = [entry if isinstance(entry, dict) else {}
+               for entry in bundle.get('entry', [])]
+    resource_types = map(get_entry_type, entries)
+
+    errors = {}
+    for i, resource_type in enumerate(resource_types):
+        if resource_type not in RESOURCES:
+            errors[i] = '400'
+    parsed_entries = [i for i in xrange(len(entries)) if i not in errors]
+    pool = (get_parser_pool()
+            if len(parsed_entries) > PARALLEL_PARSE_THRESHOLD
+            else None)
+    parsed = fhir_parser.parse_resources(
+            ((resource_types[i], entries[i]['content']) for i in parsed_entries),
+            request.format == 'xml',
+            pool)
+    search_elements = {}
+    for i, (valid, content, elements) in zip(parsed_entries, parsed):
+        if not valid:
+            errors[i] = '400'
+        else:
+            # content might have been corrected in another process
+            entries[i]['content'] = content
+            search_elements[i] = elements
+
+    update_time = datetime.now().isoformat()
+    if len(errors) > 0:
+        outcomes = [{
+            'content': (fhir_error.make_outcome(errors[i])
+                        if request.format == 'json'
+                        else json_to_xml(fhir_error.make_outcome(errors[i]))),
+            'updated': update_time,
+            'id': entries[i].get('id'),
+            'title': 'Invalid entry'
+        } for i in sorted(errors)]
+        bundle = make_bundle(outcomes, [], request.url, len(outcomes), update_time)
+        return bundle_response(bundle, request.format, status='400')
+
+    resource_ids = link_entries(entries, resource_types)
+    resources = [(Resource(resource_type,
+                           entry['content'],
+                           owner_id=request.authorizer.email,
+                           resource_id=resource_id),
+                  search_elements[i])
+                 for i, (entry, resource_type, resource_id)
+                 in enumerate(zip(entries, resource_types, resource_ids))]
+    # insert all resources and their search params within one transaction
+    with db.engine.begin() as conn:
+        index_resources(resources, bind=conn)
+        commit_buffers(g, bind=conn)
+
+    resp_entries = []
+    for entry, (resource, _) in zip(entries, resources):
+        resp_entry = make_entry(resource, request.api_base, request.format)
+        if entry.get('id'):
+            resp_entry['link'] = [{'rel': 'alternate', 'href': entry['id']}]
+        resp_entries.append(resp_entry)
+    bundle = make_bundle(resp_entries, [], request.url, len(resp_entries), update_time)
+    return bundle_response(bundle, request.format)
+
+
 def handle_read(request, resource_type, resource_id):
     '''
     handle FHIR read operation
     '''
-    if resource_type in ('Patient', 'Sequence') and resource_id.startswith('ttam_'):
+    is_ttam = resource_type in ('Patient', 'Sequence') and resource_id.startswith('ttam_')
+    if is_ttam:
         resource = ttam.get_one(resource_type, resource_id)
     else:
-        resource = find_latest_resource(resource_type, resource_id, owner_id=request.authorizer.email)
+        # data of the resource isn't needed if the client already has it
+        resource = find_latest_resource(resource_type, resource_id,
+                                        owner_id=request.authorizer.email,
+                                        load_data=not request.is_conditional)
 
     if resource is None:
+        # only look at the history of a resource when it's not found
+        if not is_ttam and has_history(resource_type, resource_id, request.authorizer.email):
+            return fhir_error.inform_gone()
         return fhir_error.inform_not_found() 
-    elif not resource.visible:
-        return fhir_error.inform_gone()
+
+    if not is_ttam:
+        etag, last_modified = resource.get_etag(), resource.get_last_modified()
+        if is_not_modified(request, etag, last_modified):
+            return not_modified_response(etag, last_modified)
 
     return resource.as_response(request)
 
@@ -229,7 +670,7 @@ def handle_update(request, resource_type, resource_id):
     '''
     handle FHIR update operation
     '''
-    old = find_latest_resource(resource_type, resource_id, owner=request.authorizer)
+    old = find_latest_resource(resource_type, resource_id, owner_id=request.authorizer.email)
     if old is None:
         return fhir_error.inform_not_allowed()
 
@@ -250,13 +691,42 @@ def handle_search(request, resource_type):
     handle FHIR search operation
     '''
     query_builder = QueryBuilder(request.authorizer)
-    search_query = query_builder.build_query(resource_type, request.args)
+    found_query = query_builder.build_query(resource_type, request.args)
+    includes = query_builder.get_includes(resource_type, request.args)
+    include = None
+    if len(includes) > 0:
+        include = lambda resource_ids: [query_builder.build_include_query(inc, resource_ids)
+                                        for inc in includes]
     ttam_resource = None
     if (resource_type in ('Patient', 'Sequence') and
             g.ttam_client is not None):
         ttam_resource = resource_type 
-    resp_bundle = FHIRBundle(search_query, request, ttam_resource=ttam_resource)
-    return resp_bundle.as_response()
+
+    # a bundle has an entity tag if it only has resources found by the search
+    # (i.e. no 23andMe resources or included resources),
+    # which is made when they are counted anyway (first page of an accurate total),
+    # or when the client asks if the bundle has changed
+    etag = total = None
+    if (ttam_resource is None and len(includes) == 0 and
+            (request.is_conditional or
+             (request.total_mode == 'accurate' and request.cursor is None))):
+        total, last_update = found_query.with_entities(
+                db.func.count(Resource.resource_id),
+                db.func.max(Resource.update_time)).one()
+        etag = get_search_etag(total, last_update)
+        # (`If-Modified-Since` doesn't work here, since a removed resource doesn't change `last_update`)
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+
+    search_query = load_columns(found_query, request.projection, resource_type)
+    resp_bundle = FHIRBundle(search_query, request,
+                             ttam_resource=ttam_resource,
+                             include=include,
+                             total=total)
+    response = resp_bundle.as_response()
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
 
 
 def handle_history(request, resource_type, resource_id, version):
@@ -276,11 +746,15 @@ def handle_history(request, resource_type, resource_id, version):
     if version is not None:
         # request = GET [api base]/[resource]/[resource_id]/_history/[version]
         # don't render as a bundle in this case
+        if request.is_conditional:
+            hist_query = hist_query.options(db.defer(Resource.data))
         resource = hist_query.first()
         if resource is None:
             return fhir_error.inform_not_found()
-        else:
-            return resource.as_response(request)
+        etag, last_modified = resource.get_etag(), resource.get_last_modified()
+        if is_not_modified(request, etag, last_modified):
+            return not_modified_response(etag, last_modified)
+        return resource.as_response(request)
 
     resp_bundle = FHIRBundle(hist_query, request, version_specific=True)
 
@@ -11,18 +11,25 @@ CODES = {
     '204': ('Resource successfully deleted', 'information')
 }
 
-def new_error(status_code):
+def make_outcome(status_code):
     '''
-    Create a new OperationOutcome resource from HTTP status_code
+    Create a new OperationOutcome resource (as a json dictionary) from HTTP status_code
     '''
     msg, severity = CODES[status_code]
-    outcome_content = {
+    return {
         'resourceType': 'OperationOutcome',
         'issue': {
             'severity': severity,
             'details': msg
         }
     }
+
+
+def new_error(status_code):
+    '''
+    Create a new OperationOutcome response from HTTP status_code
+    '''
+    outcome_content = make_outcome(status_code)
     is_xml = (request.args.get('_format', 'xml') == 'xml')
     response= (json_response(json.dumps(outcome_content))
             if not is_xml
@@ -4,6 +4,8 @@ from ui import ui
 from oauth import oauth
 from ttam.view import ttam
 from database import db
+from models import XML_CACHE, XML_CACHE_SIZE
+from text_index import has_text_index
 from argparse import ArgumentParser
 
 
@@ -28,8 +30,12 @@ def create_app(config):
     '''
     app = Flask(__name__)
     app.config.update(config)
+    XML_CACHE.resize(app.config.get('XML_CACHE_SIZE', XML_CACHE_SIZE))
     register_blueprints(app)
     db.init_app(app)
     with app.app_context():
         db.create_all()
+        if not has_text_index(db.engine):
+            app.logger.warning('no trigram index of search params, run migrate_db.py to build it '
+                               '(see `fhir.text_index`)')
     return app 
@@ -2,6 +2,8 @@
 import re
 import os
 import json
+from collections import namedtuple
+from itertools import izip, imap
 from fhir_spec import SPECS
 
 # TODO: support parsing path wild card path
@@ -43,6 +45,9 @@ FHIR_PRIMITIVE_INIT = {
     'integer': int
 }
 
+# number of resources sent to a worker process at a time by `parse_resources`
+PARSE_CHUNKSIZE = 50
+
 ASSESED_TRAIT_EXTENSION_URL = 'http://genomics.smartplatforms.org/dictionary/GeneticObservation#AssessedCondition'
 
 ASSESSED_TRAIT_SPEC = {
@@ -63,23 +68,10 @@ def get_assessed_condition(observation, correctable):
                     return condition_ref
 
 
-def parse(datatype, data, correctible):
+def add_custom_search_elements(datatype, data, correctible, search_elements):
     '''
-    walk through a complex datatype or a resource and collect elements bound to search params
+    extract elements for SMART Genomics' custom search param - assesed-condition
     '''
-    search_elements = []
-    if datatype in SPECS:
-        elements = [FHIRElement(element_spec, correctible)
-                    for element_spec in SPECS[datatype]['elements']]
-
-        search_elements = [element.get_search_elements()
-                           for element in elements if element.validate(data)]
-        if len(elements) != len(search_elements):
-            return False, None
-        search_elements = filter(lambda x: x.get('spec') is not None,
-                        search_elements)
-
-    # extract element for SMART Genomics' custom search param - assesed-condition
     if datatype == 'Observation':
         condition = get_assessed_condition(data, correctible)
         customed_search_param = {
@@ -89,7 +81,25 @@ def parse(datatype, data, correctible):
             customed_search_param['elements'].append(condition)
         search_elements.append(customed_search_param)
 
-    return True, search_elements
+    return search_elements
+
+
+def parse(datatype, data, correctible):
+    '''
+    walk through a complex datatype or a resource and collect elements bound to search params
+
+    This runs the compiled plan of `datatype` (see `get_plan`).
+    '''
+    search_elements = []
+    plan = get_plan(datatype)
+    if plan is not None:
+        collected = run_plan(plan, data, correctible)
+        if collected is None:
+            return False, None
+        search_elements = [{'spec': spec, 'elements': elements}
+                           for spec, elements in izip(plan.search_specs, collected)]
+
+    return True, add_custom_search_elements(datatype, data, correctible, search_elements)
 
 
 def parse_resource(resource_type, resource, correctible=False):
@@ -104,6 +114,32 @@ def parse_resource(resource_type, resource, correctible=False):
     return False, None
 
 
+def parse_entry(entry):
+    '''
+    parse a (resource_type, resource, correctible) tuple
+
+    return (valid, resource, search_elements), the resource is returned along because
+    it might have been corrected in another process (see `parse_resources`).
+    '''
+    resource_type, resource, correctible = entry
+    valid, search_elements = parse_resource(resource_type, resource, correctible)
+    return valid, resource, search_elements
+
+
+def parse_resources(resources, correctible=False, pool=None):
+    '''
+    parse an iterable of (resource_type, resource) lazily,
+    in worker processes of `pool` (a `multiprocessing.Pool`) if given.
+
+    yield (valid, resource, search_elements) for each resource in order.
+    '''
+    entries = ((resource_type, resource, correctible)
+               for resource_type, resource in resources)
+    if pool is None:
+        return imap(parse_entry, entries)
+    return pool.imap(parse_entry, entries, PARSE_CHUNKSIZE)
+
+
 def correct_element(element, element_types):
     for et in element_types:
         if et in FHIR_PRIMITIVE_INIT:
@@ -112,121 +148,215 @@ def correct_element(element, element_types):
             except:
                 pass
 
-class FHIRElement(object):
-
-    def __init__(self, spec, correctible):
-        self.correctible = correctible
-        self.path = spec['path']
-        self.elem_types = []
-        if 'type' in spec['definition']:
-            self.elem_types = [_type['code']
-                               for _type in spec['definition']['type']]
-        self.min_occurs = spec['definition']['min']
-        self.max_occurs = spec['definition']['max']
-        self.search_spec = spec.get('searchParam')
-        self.search_elements = []
-
-    def _push_ancestors(self, jsondict, path_elems, elem_ancestors):
-        cur_key = path_elems[0]
-        if cur_key not in jsondict:
-            return
-        val = jsondict[cur_key]
-        if isinstance(val, dict):
-            elem_ancestors.append((val, path_elems[1:]))
-        else:
-            elem_ancestors.extend(
-                [(ancestor, path_elems[1:]) for ancestor in val])
-
-    def get_search_elements(self):
-        return {'spec': self.search_spec, 'elements': self.search_elements}
-
-    def validate(self, data):
-        path_elems = self.path.split('.')
-        if len(path_elems) == 1:
-            return True
-        elem_name = path_elems[-1]
-        path_elems = path_elems[1:-1]
-        elem_parents = []
-        elem_ancestors = []
-
-        if len(path_elems) == 0:
-            elem_parents = [data]
-        else:
-            self._push_ancestors(data, path_elems, elem_ancestors)
-
-        while len(elem_ancestors) > 0:
-            ancestor, ancestor_path = elem_ancestors.pop()
-            if len(ancestor_path) == 0:
-                elem_parents.append(ancestor)
-            else:
-                self._push_ancestors(ancestor, path_elems, elem_ancestors)
 
-        for parent in elem_parents:
-            if not isinstance(parent, dict):
-                return False
+# Compiled validator plans
+#
+# Building a validator for every element spec on every call (and re-splitting its path
+# on every validation, see `walk` of benchmark.py) is wasteful
+# since specs never change in the lifetime of a process.
+# Instead we compile each profile once into an immutable plan and reuse it.
+# Per-call state (elements collected for search params) is kept outside of the plan.
 
-            elem = parent.get(elem_name)
+class ElementPlan(namedtuple('ElementPlan', ['ancestors', 'name', 'elem_types', 'validators',
+                                             'min_occurs', 'repeats', 'search_slot'])):
+    '''
+    compiled (immutable) form of an element spec
 
-            if elem is None:
-                if self.min_occurs > 0:
-                    return False
-                continue
+    `ancestors` is the pre-split path between the root and the element,
+    `validators` is the pre-resolved type dispatch of the element (see `get_type_validator`),
+    `search_slot` is the index of the search param the element is bound to (or None).
+    '''
+    __slots__ = ()
 
-            if isinstance(elem, list):
-                if self.max_occurs != "*":
-                    return False
 
-                elems = elem
-                for i, elem in enumerate(elems):
-                    if not self.validate_elem(elem):
-                        if not self.correctible:
-                            return False
+class DatatypePlan(namedtuple('DatatypePlan', ['elements', 'search_specs'])):
+    '''
+    compiled (immutable) form of a complex datatype or a resource
+    '''
+    __slots__ = ()
 
-                        corrected = correct_element(elem, self.elem_types)
-                        if corrected is not None:
-                            elems[i] = corrected
-                        return False
 
-            elif self.max_occurs == '*' and not self.correctible:
-                return False
+# compiled plans, keyed by datatype. These are built once per process.
+_PLANS = {}
 
-            elif not self.validate_elem(elem):
-                if not self.correctible:
-                    return False
 
-                corrected = correct_element(elem, self.elem_types)
-                if corrected is not None:
-                    if self.max_occurs == '*':
-                        parent[elem_name] = [corrected]
-                    else:
-                        parent[elem_name] = corrected
-                else:
-                    return False
-            elif self.max_occurs == '*':
-                # in this case, the elem itself is correct, with a cardinality
-                # or '*' but stored as a single item
-                parent[elem_name] = [elem]
+def validate_primitive(validate_func):
+    return lambda elem, correctible: validate_func(elem)
+
+
+def validate_complex(datatype):
+    '''
+    validate an element of a complex type.
+
+    Plans are looked up (rather than embedded) here because types can be recursive
+    (e.g. Extension can have extensions).
+    '''
+    def validate(elem, correctible):
+        return run_plan(get_plan(datatype), elem, correctible) is not None
+    return validate
 
+
+def validate_resource(elem, correctible):
+    '''
+    validate an element of type Resource (e.g. a contained resource)
+    '''
+    if not (isinstance(elem, dict) and 'resourceType' in elem):
         return True
+    plan = get_plan(elem['resourceType'])
+    return plan is None or run_plan(plan, elem, correctible) is not None
+
+
+def get_type_validator(elem_type):
+    '''
+    resolve an element type into a validate function.
 
-    def validate_elem(self, elem):
-        for elem_type in self.elem_types:
-            if elem_type in FHIR_PRIMITIVE_VALIDATORS:
-                validate_func = FHIR_PRIMITIVE_VALIDATORS[elem_type]
-                if not validate_func(elem):
+    Return None if we don't know how to validate the type.
+    '''
+    if elem_type in FHIR_PRIMITIVE_VALIDATORS:
+        return validate_primitive(FHIR_PRIMITIVE_VALIDATORS[elem_type])
+    elif elem_type == 'Resource':
+        return validate_resource
+    elif elem_type in SPECS:
+        return validate_complex(elem_type)
+
+
+def compile_element(spec, search_slot):
+    '''
+    compile an element spec into an `ElementPlan`
+    '''
+    path_elems = tuple(spec['path'].split('.'))
+    elem_types = tuple(_type['code']
+                       for _type in spec['definition'].get('type', ()))
+    validators = tuple(validator
+                       for validator in map(get_type_validator, elem_types)
+                       if validator is not None)
+    return ElementPlan(ancestors=path_elems[1:-1],
+                       name=path_elems[-1],
+                       elem_types=elem_types,
+                       validators=validators,
+                       min_occurs=spec['definition']['min'],
+                       repeats=(spec['definition']['max'] == '*'),
+                       search_slot=search_slot)
+
+
+def compile_spec(datatype):
+    '''
+    compile the profile of a complex datatype or a resource into a `DatatypePlan`
+    '''
+    elements = []
+    search_specs = []
+    for spec in SPECS[datatype]['elements']:
+        if '.' not in spec['path']:
+            # root element is always valid
+            continue
+        search_slot = None
+        if spec.get('searchParam') is not None:
+            search_slot = len(search_specs)
+            search_specs.append(spec['searchParam'])
+        elements.append(compile_element(spec, search_slot))
+
+    return DatatypePlan(elements=tuple(elements), search_specs=tuple(search_specs))
+
+
+def get_plan(datatype):
+    '''
+    get compiled plan of a datatype, compile it if we haven't.
+
+    Return None if the datatype is not defined by the specs.
+    '''
+    plan = _PLANS.get(datatype)
+    if plan is None and datatype in SPECS:
+        plan = _PLANS[datatype] = compile_spec(datatype)
+    return plan
+
+
+def find_parents(data, ancestors):
+    '''
+    find all parents of an element given its ancestors' names
+    '''
+    parents = [data]
+    for name in ancestors:
+        children = []
+        for parent in parents:
+            if not isinstance(parent, dict):
+                return None
+            child = parent.get(name)
+            if child is None:
+                continue
+            elif isinstance(child, list):
+                children.extend(child)
+            else:
+                children.append(child)
+        parents = children
+    return parents
+
+
+def validate_value(plan, elem, correctible, collected):
+    for validate in plan.validators:
+        if not validate(elem, correctible):
+            return False
+
+    if plan.search_slot is not None:
+        collected[plan.search_slot].append(elem)
+
+    return True
+
+
+def validate_element(plan, data, correctible, collected):
+    '''
+    Compiled counterpart of `FHIRElement.validate` (of benchmark.py)
+    '''
+    parents = find_parents(data, plan.ancestors)
+    if parents is None:
+        return False
+
+    for parent in parents:
+        if not isinstance(parent, dict):
+            return False
+
+        elem = parent.get(plan.name)
+
+        if elem is None:
+            if plan.min_occurs > 0:
+                return False
+            continue
+
+        if isinstance(elem, list):
+            if not plan.repeats:
+                return False
+            for item in elem:
+                if not validate_value(plan, item, correctible, collected):
                     return False
-                else:
-                    continue
 
-            elif elem_type == 'Resource' and 'resourceType' in elem:
-                elem_type = elem.resourceType
+        elif plan.repeats and not correctible:
+            return False
 
-            # type of the element is a complex type
-            valid, _ = parse(elem_type, elem, self.correctible)
-            if not valid:
+        elif not validate_value(plan, elem, correctible, collected):
+            if not correctible:
                 return False
 
-        if self.search_spec is not None:
-            self.search_elements.append(elem)
+            corrected = correct_element(elem, plan.elem_types)
+            if corrected is None:
+                return False
+            parent[plan.name] = [corrected] if plan.repeats else corrected
 
-        return True
+        elif plan.repeats:
+            # in this case, the elem itself is correct, with a cardinality
+            # or '*' but stored as a single item
+            parent[plan.name] = [elem]
+
+    return True
+
+
+def run_plan(plan, data, correctible):
+    '''
+    validate data against a compiled plan
+
+    return a list of collected elements for each search param of the plan,
+    or None if the data is invalid
+    '''
+    collected = [[] for _ in plan.search_specs]
+    for element in plan.elements:
+        if not validate_element(element, data, correctible, collected):
+            return None
+    return collected
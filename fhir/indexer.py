@@ -66,23 +66,84 @@ def index_token(index, element):
     return index
 
 
+def get_reference_key(reference_url, owner_id):
+    '''
+    return key (owner_id, resource_type, resource_id) of a referenced resource
+    if reference_url is an internal reference, None otherwise.
+    '''
+    reference = REFERENCE_RE.match(reference_url)
+    if reference is None:
+        return None
+    if reference.group('extern_base') is None or reference.group('extern_base') == get_api_base():
+        return owner_id, reference.group('resource_type'), reference.group('resource_id')
+
+
+def resolve_references(keys, g):
+    '''
+    resolve a set of reference keys (see `get_reference_key`) with one query.
+
+    Resolved references are memoized in `g._reference_cache`,
+    as (resource_type, resource_id, update_time) of the visible version of a referenced resource
+    (or None if the referenced resource doesn't exist), so each resource is looked up once per request.
+    Resources saved during the request (see `index_resources`) update their entries (see `remember_saved`).
+    '''
+    cache = g._reference_cache
+    keys = set(key for key in keys if key not in cache)
+    if len(keys) == 0:
+        return
+    # group referenced ids by their owners and types
+    # so that the query looks like ... WHERE (owner_id = .. AND resource_type = .. AND resource_id IN ..) OR ...
+    grouped = {}
+    for owner_id, resource_type, resource_id in keys:
+        grouped.setdefault((owner_id, resource_type), []).append(resource_id)
+    preds = [db.and_(Resource.owner_id == owner_id,
+                     Resource.resource_type == resource_type,
+                     Resource.resource_id.in_(resource_ids))
+             for (owner_id, resource_type), resource_ids in grouped.iteritems()]
+    referenced = (db.session
+                  .query(Resource.owner_id,
+                         Resource.resource_type,
+                         Resource.resource_id,
+                         Resource.update_time)
+                  .filter(Resource.visible == True, db.or_(*preds)))
+    for key in keys:
+        cache[key] = None
+    for owner_id, resource_type, resource_id, update_time in referenced:
+        cache[owner_id, resource_type, resource_id] = (resource_type, resource_id, update_time)
+
+
+def remember_saved(resources, g):
+    '''
+    make references to saved resources resolve to the versions just saved
+
+    Otherwise a reference to a resource that's been looked up earlier in the request
+    (e.g. referenced before it's updated) would resolve to the old version, or to nothing.
+    Every resource saved within a request has to be passed here (`index_resources` does).
+    '''
+    for resource in resources:
+        g._reference_cache[resource.owner_id, resource.resource_type, resource.resource_id] = (
+            resource.resource_type, resource.resource_id, resource.update_time)
+
+
 def index_reference(index, element, owner_id, g):
     '''
     index a reference
+
+    References should have been resolved by `resolve_references` before this is called.
     '''
     if 'display' in element:
         index['text'] = '::%s::' % (element['display'],)
 
     if 'reference' in element:
         reference_url = element['reference']
-        reference = REFERENCE_RE.match(reference_url)
         index['referenced_url'] = reference_url
-        if reference.group('extern_base') is None or reference.group('extern_base') == get_api_base():
-            # reference is internal reference, we want to link the reference to a Resource
-            index['referenced'] = Resource.query.filter_by(resource_type=reference.group('resource_type'),
-                                                           resource_id=reference.group('resource_id'),
-                                                           owner_id=owner_id,
-                                                           visible=True).first()
+        key = get_reference_key(reference_url, owner_id)
+        referenced = g._reference_cache.get(key) if key is not None else None
+        if referenced is not None:
+            # reference is internal reference, we link the reference to a Resource
+            (index['referenced_type'],
+             index['referenced_id'],
+             index['referenced_update_time']) = referenced
             
     return index
 
@@ -148,21 +209,52 @@ def get_search_args(resource, spec):
     }
 
 
-def index_resource(resource, search_elements, g=g):
-    resource.add_and_commit()
-    params = []
+def get_reference_keys(resource, search_elements):
+    '''
+    collect keys of all internal references within a resource
+    '''
     for search_param in search_elements:
-        args = get_search_args(resource, search_param['spec'])
-        elements = search_param['elements']
-        if len(elements) == 0:
-            save_buffer(g, SearchParam, SearchParam(missing=True, **args))
-        else:
-            for element in elements:
-                if args['param_type'] == 'reference':
-                    index_func = partial(index_reference, owner_id=resource.owner_id, g=g)
-                else:
-                    index_func = SEARCH_INDEX_FUNCS[args['param_type']]
-                if index_func is None:
-                    continue
-                search_index = index_func(dict(args), element) 
-                save_buffer(g, SearchParam, SearchParam(missing=False, **search_index))
+        if search_param['spec']['type'] != 'reference':
+            continue
+        for element in search_param['elements']:
+            if 'reference' in element:
+                key = get_reference_key(element['reference'], resource.owner_id)
+                if key is not None:
+                    yield key
+
+
+def index_resources(resources, g=g, bind=None):
+    '''
+    save a batch of resources and index them, given a list of (resource, search_elements)
+
+    All internal references of the batch are resolved at once.
+    Resources are inserted with `bind` (a connection) if given.
+    '''
+    db.session.commit()
+    Resource.core_insert([resource.get_insert_params() for resource, _ in resources], bind)
+    remember_saved([resource for resource, _ in resources], g)
+
+    resolve_references((key
+                        for resource, search_elements in resources
+                        for key in get_reference_keys(resource, search_elements)), g)
+
+    for resource, search_elements in resources:
+        for search_param in search_elements:
+            args = get_search_args(resource, search_param['spec'])
+            elements = search_param['elements']
+            if len(elements) == 0:
+                save_buffer(g, SearchParam, SearchParam(missing=True, **args))
+            else:
+                for element in elements:
+                    if args['param_type'] == 'reference':
+                        index_func = partial(index_reference, owner_id=resource.owner_id, g=g)
+                    else:
+                        index_func = SEARCH_INDEX_FUNCS[args['param_type']]
+                    if index_func is None:
+                        continue
+                    search_index = index_func(dict(args), element) 
+                    save_buffer(g, SearchParam, SearchParam(missing=False, **search_index))
+
+
+def index_resource(resource, search_elements, g=g):
+    index_resources([(resource, search_elements)], g)
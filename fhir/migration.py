@@ -0,0 +1,148 @@
+'''
+Bring a database created by an older version of the server up to date
+
+`db.create_all` only creates missing tables, so columns and indexes added to
+existing tables since then (e.g. `Resource.bin` and the indexes of `Resource` and `SearchParam`)
+have to be added here.
+'''
+import json
+from sqlalchemy import inspect
+from database import db
+from models import Resource
+from util import get_bin
+from fhir_spec import RESOURCES
+from projection import dump_summary
+from text_index import create_text_index
+from search_stats import analyze
+
+BACKFILL_BATCH_SIZE = 10000
+
+
+def add_missing_columns(engine):
+    '''
+    add columns declared by models but missing in their tables, return names of added columns
+    '''
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                quote(table.name),
+                quote(column.name),
+                column.type.compile(dialect=engine.dialect)))
+            added.append('%s.%s' % (table.name, column.name))
+    return added
+
+
+def backfill_bins(engine):
+    '''
+    compute bins of Sequences saved before `Resource.bin` was added, return number of updated rows
+    '''
+    table = Resource.__table__
+    key = [table.c.owner_id, table.c.resource_id, table.c.resource_type, table.c.update_time]
+    select_missing = (db.select(key + [table.c.start, table.c.end])
+            .where(db.and_(table.c.resource_type == 'Sequence',
+                           table.c.bin == None,
+                           table.c.start != None,
+                           table.c.end != None))
+            .limit(BACKFILL_BATCH_SIZE))
+    update_bin = (table.update()
+            .where(db.and_(*[column == db.bindparam('_' + column.name) for column in key]))
+            .values(bin=db.bindparam('_bin')))
+    num_updated = 0
+    while True:
+        rows = engine.execute(select_missing).fetchall()
+        if len(rows) == 0:
+            return num_updated
+        engine.execute(update_bin, [{
+            '_owner_id': row.owner_id,
+            '_resource_id': row.resource_id,
+            '_resource_type': row.resource_type,
+            '_update_time': row.update_time,
+            '_bin': get_bin(row.start, row.end)} for row in rows])
+        num_updated += len(rows)
+
+
+def backfill_summaries(engine):
+    '''
+    make summaries of resources saved before `Resource.summary` was added, return number of updated rows
+    '''
+    table = Resource.__table__
+    key = [table.c.owner_id, table.c.resource_id, table.c.resource_type, table.c.update_time]
+    select_missing = (db.select(key + [table.c.data])
+            .where(db.and_(table.c.summary == None,
+                           table.c.resource_type.in_(RESOURCES)))
+            .limit(BACKFILL_BATCH_SIZE))
+    update_summary = (table.update()
+            .where(db.and_(*[column == db.bindparam('_' + column.name) for column in key]))
+            .values(summary=db.bindparam('_summary')))
+    num_updated = 0
+    while True:
+        rows = engine.execute(select_missing).fetchall()
+        if len(rows) == 0:
+            return num_updated
+        engine.execute(update_summary, [{
+            '_owner_id': row.owner_id,
+            '_resource_id': row.resource_id,
+            '_resource_type': row.resource_type,
+            '_update_time': row.update_time,
+            '_summary': dump_summary(row.resource_type, json.loads(row.data))} for row in rows])
+        num_updated += len(rows)
+
+
+def hide_old_versions(engine):
+    '''
+    make sure only the latest version of a resource is visible
+    (so that a unique index of current versions can be created), return number of hidden rows
+    '''
+    table = Resource.__table__
+    newer = table.alias('newer')
+    has_newer = db.exists().where(db.and_(newer.c.owner_id == table.c.owner_id,
+                                          newer.c.resource_type == table.c.resource_type,
+                                          newer.c.resource_id == table.c.resource_id,
+                                          newer.c.version > table.c.version))
+    return engine.execute(table.update()
+                          .where(db.and_(table.c.visible == True, has_newer))
+                          .values(visible=False)).rowcount
+
+
+def add_missing_indexes(engine):
+    '''
+    create indexes declared by models but missing in their tables, return names of created indexes
+    '''
+    inspector = inspect(engine)
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+                added.append(index.name)
+    return added
+
+
+def migrate(engine):
+    '''
+    bring the database up to date, return a list of what's been done
+    '''
+    db.metadata.create_all(bind=engine)
+    done = ['added column %s' % column for column in add_missing_columns(engine)]
+    num_bins = backfill_bins(engine)
+    if num_bins > 0:
+        done.append('computed bins of %d sequences' % num_bins)
+    num_summaries = backfill_summaries(engine)
+    if num_summaries > 0:
+        done.append('made summaries of %d resources' % num_summaries)
+    num_hidden = hide_old_versions(engine)
+    if num_hidden > 0:
+        done.append('hid %d old versions of resources' % num_hidden)
+    done.extend('created index %s' % index for index in add_missing_indexes(engine))
+    if not create_text_index(engine):
+        done.append('could not create trigram index of search params (see `fhir.text_index`)')
+    if analyze(engine, force=True):
+        done.append('updated statistics of query planner')
+    return done
@@ -6,17 +6,26 @@ import json
 from uuid import uuid4
 from urlparse import urljoin
 from fhir_spec import RESOURCES
-from util import json_response, xml_response, json_to_xml, hash_password
+from util import json_response, xml_response, json_to_xml, hash_password, get_bin, to_utc, LRUCache
+from projection import dump_summary
 
 # an oauth client can only keep access token for 1800 seconds
 EXPIRE_TIME = 1800
 # special resources to be launched with
 LAUNCH_RESOURCES = set(['Patient', 'Encounter', 'Location'])
+# total length of xml of resources (versions) we keep in memory (see `Resource.as_xml`)
+# (override with `XML_CACHE_SIZE` of app config, 0 for no cache, see `fhir_genomics.create_app`)
+XML_CACHE_SIZE = 64 * 1024 * 1024
+XML_CACHE = LRUCache(XML_CACHE_SIZE, sizeof=len)
 
 
-def commit_buffers(g): 
+def commit_buffers(g, bind=None): 
+    '''
+    insert buffered rows, with `bind` (a connection) if given
+    '''
     for model, buf in g._nodep_buffers.iteritems():
-        model.core_insert(buf) 
+        model.core_insert(buf, bind) 
+    g._nodep_buffers = {}
 
 
 def save_buffer(g, model, obj):
@@ -70,8 +79,33 @@ class SimpleInsert(object):
         self.__class__.core_insert([self.get_insert_params()])
 
     @classmethod
-    def core_insert(cls, objs):
-        db.engine.execute(cls.__table__.insert(), objs)
+    def core_insert(cls, objs, bind=None):
+        if len(objs) == 0:
+            return
+        if bind is None:
+            bind = db.engine
+        bind.execute(cls.__table__.insert(), objs)
+
+    @classmethod
+    def core_copy(cls, owner_id, new_owner_id, bind=None):
+        '''
+        copy all rows owned by `owner_id` to `new_owner_id`
+        with a single INSERT ... SELECT statement
+        '''
+        if bind is None:
+            bind = db.engine
+        table = cls.__table__
+        # auto-incremented ids are left to the database
+        columns = [col for col in table.columns
+                   if not (col.primary_key and isinstance(col.type, db.Integer))]
+        rows = db.select([db.literal(new_owner_id).label('owner_id')
+                          if col.name == 'owner_id' else col
+                          for col in columns]).where(table.c.owner_id == owner_id)
+        bind.execute(table.insert().from_select([col.name for col in columns], rows))
+
+
+# predicate of partial indexes of current versions of resources
+VISIBLE = (db.literal_column('visible') == True)
 
 
 # TODO use autoincrment INT for resource_id instead of uuid (string)
@@ -87,6 +121,23 @@ class Resource(db.Model, SimpleInsert):
     '''
     __tablename__ = 'resource'
 
+    __table_args__ = (
+        # for sequence coordinate search (see `query_builder.make_coord_pred`)
+        db.Index('ix_resource_coordinate', 'owner_id', 'resource_type', 'chromosome', 'bin'),
+        # for search (see `query_builder.QueryBuilder.build_query`), which only looks for
+        # current versions and pages them in order of (update_time, resource_id).
+        # Most rows are old versions, so only current ones are indexed where we can.
+        db.Index('ix_resource_visible', 'owner_id', 'resource_type', 'update_time', 'resource_id',
+                 postgresql_where=VISIBLE,
+                 sqlite_where=VISIBLE),
+        # the current version of a resource (see `visible`), so that a read is one index lookup
+        # rather than a sort of all versions. This also makes sure there's only one.
+        db.Index('ix_resource_current', 'owner_id', 'resource_type', 'resource_id',
+                 unique=True,
+                 postgresql_where=VISIBLE,
+                 sqlite_where=VISIBLE),
+        {})
+
     # upon app startup, we create a resource whose owner's email is 'super', which is impossible
     # for a real user, who has to use a syntatically valid email address
     owner_id = db.Column(db.String, db.ForeignKey('User.email'), primary_key=True)
@@ -95,24 +146,31 @@ class Resource(db.Model, SimpleInsert):
     update_time = db.Column(db.DateTime, primary_key=True)
     create_time = db.Column(db.DateTime)
     data = db.Column(db.Text)
+    # summary of the resource (see `projection`), only loaded when a bundle of summaries is made
+    summary = db.deferred(db.Column(db.Text, nullable=True))
     version = db.Column(db.Integer)
+    # whether this is the current version of a resource,
+    # which is the only visible (i.e. readable and searchable) version
     visible = db.Column(db.Boolean)
 
     # speicalized columns for faster sequence resource query
     chromosome = db.Column(db.String, nullable=True)
     start = db.Column(db.Integer, nullable=True)
     end = db.Column(db.Integer, nullable=True)
+    # UCSC-style bin of a sequence (see `util.get_bin`)
+    bin = db.Column(db.Integer, nullable=True)
 
     owner = db.relationship('User')
 
-    def __init__(self, resource_type, data, owner_id):
+    def __init__(self, resource_type, data, owner_id, resource_id=None):
         '''
         data is a json dictionary of a resource
         '''
         self.update_time = self.create_time = datetime.now()
         self.resource_type = resource_type
-        self.resource_id = str(uuid4())
+        self.resource_id = resource_id if resource_id is not None else str(uuid4())
         self.data = json.dumps(data, separators=(',', ':'))
+        self.summary = dump_summary(resource_type, data)
         self.version = 1
         self.visible = True
         self.owner_id = owner_id
@@ -120,6 +178,7 @@ class Resource(db.Model, SimpleInsert):
             self.chromosome = data['chromosome']['text']
             self.start = data['start']
             self.end = data['end']
+            self.bin = get_bin(self.start, self.end)
 
     def update(self, data):
         '''
@@ -127,7 +186,7 @@ class Resource(db.Model, SimpleInsert):
         and mark the older one unvisible
         '''
         self.visible = False
-        latest = Resource(self.resource_type, data)
+        latest = Resource(self.resource_type, data, self.owner_id)
         latest.resource_id = self.resource_id
         latest.create_time = self.create_time
         latest.version = self.version + 1
@@ -144,7 +203,12 @@ class Resource(db.Model, SimpleInsert):
             response.data = self.data
         else:
             response = xml_response(status=status)
-            response.data = json_to_xml(json.loads(self.data))
+            response.data = self.as_xml()
+
+        if self.owner_id is not None:
+            # a saved resource (i.e. a version of it) never changes
+            response.set_etag(self.get_etag(), weak=True)
+            response.last_modified = self.get_last_modified()
 
         loc_header = 'Location' if created else 'Content-Location'
         response.headers[loc_header] = urljoin(request.api_base, '%s/%s/_history/%s' % (
@@ -154,6 +218,36 @@ class Resource(db.Model, SimpleInsert):
 
         return response
 
+    def get_etag(self):
+        '''
+        return the entity tag of the resource (which is weak, since it's in json or xml),
+        which is different for every version
+        '''
+        return '%d-%s' % (self.version, self.update_time.strftime('%Y%m%d%H%M%S%f'))
+
+    def get_last_modified(self):
+        '''
+        return when the resource was last modified (in UTC)
+        '''
+        return to_utc(self.update_time)
+
+    def as_xml(self):
+        '''
+        return the resource as xml
+
+        A saved resource (i.e. a version of it) never changes,
+        so we cache its xml once it's made.
+        '''
+        if self.owner_id is None or XML_CACHE.capacity <= 0:
+            # not a saved resource (e.g. a 23andMe resource), or there's no cache
+            return json_to_xml(json.loads(self.data))
+        key = (self.owner_id, self.resource_type, self.resource_id, self.update_time)
+        xml = XML_CACHE.get(key)
+        if xml is None:
+            xml = json_to_xml(json.loads(self.data))
+            XML_CACHE.set(key, xml)
+        return xml
+
     def get_url(self, version_specific=False):
         '''
         return the url to the resource
@@ -184,6 +278,15 @@ class SearchParam(db.Model, SimpleInsert):
         db.ForeignKeyConstraint(
             ['owner_id', 'referenced_id', 'referenced_type', 'referenced_update_time'],
             ['resource.owner_id', 'resource.resource_id', 'resource.resource_type', 'resource.update_time']),
+        # search params of a resource
+        db.Index('ix_searchparam_resource', 'owner_id', 'resource_id', 'resource_type', 'update_time'),
+        # for searches compiled by `query_builder.PRED_MAKERS`, all of which look for
+        # params of an owner with a name and type. String and `missing` searches use the prefix
+        # of the index for tokens (inexact strings also use `text_index`).
+        db.Index('ix_searchparam_token', 'owner_id', 'name', 'param_type', 'code', 'system'),
+        db.Index('ix_searchparam_quantity', 'owner_id', 'name', 'param_type', 'quantity'),
+        db.Index('ix_searchparam_date', 'owner_id', 'name', 'param_type', 'start_date', 'end_date'),
+        db.Index('ix_searchparam_reference', 'owner_id', 'name', 'param_type', 'referenced_id', 'referenced_type'),
         {})
 
     id = db.Column(db.Integer, primary_key=True)
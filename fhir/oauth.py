@@ -6,6 +6,7 @@ import json
 from urllib import urlencode
 from fhir_spec import RESOURCES
 from models import db, Session, User, Client, App, Resource, Context
+import auth_cache
 from ui import require_login
 
 oauth = Blueprint('auth', __name__)
@@ -164,7 +165,9 @@ def exchange_token():
         cid, csecret = pair
         assert (client.client_id == cid and
                 client.client_secret == csecret) 
-    return jsonify(client.grant_access_token()) 
+    grant = client.grant_access_token()
+    auth_cache.forget_token(client.access_token)
+    return jsonify(grant) 
 
 
 @oauth.route('/create_context', methods=['GET', 'POST'])
@@ -217,7 +220,7 @@ def create_context():
 @oauth.before_request
 def get_session():
     session_id = request.cookies.get('session_id') 
-    request.session = Session.query.filter_by(id=session_id).first()
+    request.session = auth_cache.get_session(session_id)
 
 
 @oauth.errorhandler(AssertionError)
@@ -0,0 +1,137 @@
+'''
+Projection of resources in a bundle, as requested by `_summary` and `_elements` of a search
+
+The DSTU1 profiles we have don't say which elements are in a summary of a resource,
+so a summary has the elements that are either mandatory or searchable, which leaves out
+e.g. the narrative (`text`), contained resources, and observed bases of a Sequence.
+A summary of each version of a resource is saved along with it (`Resource.summary`),
+so that a bundle of summaries is made without reading, decoding and encoding whole resources.
+'''
+import json
+from fhir_spec import SPECS
+
+# values of `_summary`
+# `true`: summary elements, `text`: narrative and mandatory elements,
+# `data`: everything but the narrative, `false`: everything
+SUMMARY_MODES = ('true', 'text', 'data', 'false')
+
+# resource type -> (summary elements, mandatory elements)
+_elements = {}
+
+
+def _get_elements(resource_type):
+    '''
+    return names of top-level summary and mandatory elements of a type of resources
+
+    Name of a choice of types (e.g. `value[x]`) is its prefix (e.g. `value`).
+    '''
+    elements = _elements.get(resource_type)
+    if elements is None:
+        summary, mandatory = set(), set()
+        for element in SPECS[resource_type]['elements']:
+            path = element['path'].split('.')
+            if len(path) < 2:
+                continue
+            name = path[1].replace('[x]', '')
+            if 'searchParam' in element:
+                summary.add(name)
+            if len(path) == 2 and element['definition'].get('min', 0) > 0:
+                summary.add(name)
+                mandatory.add(name)
+        elements = _elements[resource_type] = (summary, mandatory)
+    return elements
+
+
+def _has_element(names, key):
+    '''
+    check if a key of a resource (e.g. `valueQuantity`, or `_status`
+    for extensions of a primitive) is of one of the named elements
+    '''
+    key = key.lstrip('_')
+    if key in names:
+        return True
+    # a choice of types
+    for end in xrange(1, len(key)):
+        if key[end].isupper() and key[:end] in names:
+            return True
+    return False
+
+
+def project(data, resource_type, summary='false', elements=None):
+    '''
+    project a resource (as a dictionary) by `_summary` and `_elements`
+    '''
+    summary_elements, mandatory = _get_elements(resource_type)
+    if elements is not None:
+        names = mandatory.union(elements)
+    elif summary == 'true':
+        names = summary_elements
+    elif summary == 'text':
+        names = mandatory.union(['text'])
+    elif summary == 'data':
+        return {key: value for key, value in data.iteritems() if key != 'text'}
+    else:
+        return data
+    return {key: value for key, value in data.iteritems()
+            if key == 'resourceType' or _has_element(names, key)}
+
+
+def dump_summary(resource_type, data):
+    '''
+    dump a summary of a resource (as a dictionary) as json
+    '''
+    if resource_type not in SPECS:
+        return None
+    return json.dumps(project(data, resource_type, summary='true'), separators=(',', ':'))
+
+
+def _get_summary(resource):
+    '''
+    get summary of a resource if it's loaded, rather than loading it for this one resource
+    '''
+    return resource.__dict__.get('summary')
+
+
+class Projection(object):
+    '''
+    projection of resources of a bundle (`elements` takes precedence over `summary`)
+    '''
+    def __init__(self, summary, elements):
+        self.summary = summary
+        self.elements = elements
+        self._uses_summary = {}
+
+    def uses_summary(self, resource_type):
+        '''
+        check if resources of a type are projected from their summaries,
+        which is the case if everything asked for is in a summary
+        '''
+        uses_summary = self._uses_summary.get(resource_type)
+        if uses_summary is None:
+            if self.elements is None:
+                uses_summary = (self.summary == 'true')
+            else:
+                uses_summary = (resource_type in SPECS and
+                                all(_has_element(_get_elements(resource_type)[0], element)
+                                    for element in self.elements))
+            self._uses_summary[resource_type] = uses_summary
+        return uses_summary
+
+    def load(self, resource):
+        '''
+        return a projected resource as a dictionary
+        '''
+        summary = _get_summary(resource)
+        from_summary = summary is not None and self.uses_summary(resource.resource_type)
+        data = json.loads(summary if from_summary else resource.data)
+        return project(data, resource.resource_type, self.summary, self.elements)
+
+    def dump(self, resource):
+        '''
+        dump a projected resource as json
+        '''
+        summary = _get_summary(resource)
+        if summary is not None and self.elements is None and self.summary == 'true':
+            # which is what's asked for
+            return summary
+        return json.dumps(self.load(resource), separators=(',', ':'))
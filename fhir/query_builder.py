@@ -1,10 +1,13 @@
 '''
 Build SQL query from FHIR search parameters
 '''
+from flask import current_app
 from models import db, Resource, SearchParam
+from text_index import make_text_pred
+from search_stats import get_param_stats
 from fhir_spec import SPECS, REFERENCE_TYPES
 import dateutil.parser
-from util import iterdict
+from util import iterdict, get_overlapping_bins
 from functools import partial
 import re
 
@@ -17,10 +20,30 @@ NUMBER_RE = re.compile(r'%s?(?P<number>\d+(?:\.\d+)?)'% COMPARATOR_RE)
 QUANTITY_RE = re.compile(r'%s\|(?P<system>.+)?\|(?P<code>.+)?'% NUMBER_RE.pattern)
 DATE_RE = re.compile(r'%s?(?P<date>.+)' % COMPARATOR_RE)
 COORD_RE = re.compile(r'(?P<chrom>.+):(?P<start>\d+)-(?P<end>\d+)') 
+# reverse chained search, e.g. `_has:Observation:subject:code`
+HAS_RE = re.compile(r'_has:(?P<resource_type>[^:]+):(?P<reference_param>[^:]+):(?P<param>.+)')
+# `_include` or `_revinclude`, e.g. `Observation:subject` or `Observation:subject:Patient`
+INCLUDE_RE = re.compile(r'(?P<resource_type>[^:]+):(?P<param>[^:]+)(?::(?P<target_type>[^:]+))?$')
+# a coordinate search spanning more bins than this (i.e. longer than ~60Mb)
+# is not restricted by bins, since it will read most of a chromosome anyway
+MAX_COORD_BINS = 500
 # there are two types of modifier: Resource modifier and others...
 NON_TYPE_MODIFIERS = ['missing', 'text', 'exact'] 
-# select helper
-SELECT_FROM_SEARCH_PARAM = db.select([SearchParam.resource_id]).select_from(SearchParam)
+# a search param belongs to a version of a resource, which is identified by this key
+RESOURCE_KEY = (Resource.owner_id, Resource.resource_type, Resource.resource_id, Resource.update_time)
+SEARCH_PARAM_KEY = (SearchParam.owner_id, SearchParam.resource_type, SearchParam.resource_id, SearchParam.update_time)
+# estimated fraction of (present) search params matched by a range search (e.g. `date=>2010`)
+# of unknown range of values, or a word of a text search (i.e. not `:exact`)
+RANGE_SELECTIVITY = 1 / 3.
+TEXT_SELECTIVITY = 0.1
+# cost of checking a search param of a resource by its key,
+# relative to reading a search param matching a predicate
+PROBE_COST = 4
+# a chained search (e.g. `subject.name=Smith`) is rejected if it has more links than this,
+# or it's estimated to read more search params than this
+# (override with `SEARCH_MAX_CHAIN_DEPTH` and `SEARCH_MAX_CHAIN_COST` of app config)
+MAX_CHAIN_DEPTH = 3
+MAX_CHAIN_COST = 1000000
 
 
 class InvalidQuery(Exception):
@@ -31,19 +54,69 @@ class InvalidQuery(Exception):
     pass 
 
 
-def intersect_predicates(predicates):
+def select_matched(pred):
     '''
-    helper function to intersect a set of predicates
+    select keys of resources (versions) with search params matching a predicate
     '''
-    return db.intersect(*[SELECT_FROM_SEARCH_PARAM.where(pred)
-                          for pred in predicates])
+    return db.select(SEARCH_PARAM_KEY).where(pred).correlate(None)
 
-def union_predicates(predicates):
+
+def has_matched(pred):
+    '''
+    check if a resource (of the enclosing query) has a search param matching a predicate
     '''
-    helper function to union a set of predicates
+    return (db.exists()
+            .where(db.and_(pred, *[sp_col == res_col
+                                   for sp_col, res_col in zip(SEARCH_PARAM_KEY, RESOURCE_KEY)]))
+            .correlate(Resource))
+
+
+def estimate_range(stats, param_type, param_val):
     '''
-    return db.union(*[SELECT_FROM_SEARCH_PARAM.where(pred)
-                          for pred in predicates]) 
+    estimate fraction of search params matched by a range search (e.g. `date=>2010`),
+    assuming values are spread evenly between the smallest and the largest one
+    '''
+    matched = (DATE_RE if param_type == 'date' else NUMBER_RE).match(param_val)
+    if (matched is None or
+            matched.group('comparator') is None or
+            stats.min_value is None or
+            stats.min_value == stats.max_value):
+        return RANGE_SELECTIVITY
+    try:
+        if param_type == 'date':
+            value = dateutil.parser.parse(matched.group('date'))
+            below = (value - stats.min_value).total_seconds()
+            span = (stats.max_value - stats.min_value).total_seconds()
+        else:
+            value = float(matched.group('number'))
+            below = value - stats.min_value
+            span = float(stats.max_value - stats.min_value)
+    except (ValueError, TypeError):
+        return RANGE_SELECTIVITY
+    fraction = min(max(below / span, 0.), 1.)
+    return fraction if '<' in matched.group('comparator') else 1 - fraction
+
+
+def estimate_matches(stats, param_data, param_type, param_val, chain_estimate=None):
+    '''
+    estimate number of search params matched by a search, given statistics of the search param
+    (and estimated number of resources found by the chain, if it's a chained search)
+    '''
+    if param_data['modifier'] == 'missing':
+        return stats.num_missing if param_val == 'true' else stats.num_present
+    if chain_estimate is not None:
+        # each of the resources found by the chain is referenced by this many search params
+        return min(chain_estimate * float(stats.num_present) / max(stats.num_distinct, 1),
+                   stats.num_present)
+    estimate = 0.
+    for alt in param_val.split(','):
+        if param_type == 'date' or (param_type in ('number', 'quantity') and alt[:1] in ('<', '>')):
+            estimate += stats.num_present * estimate_range(stats, param_type, alt)
+        elif param_type == 'string' and param_data['modifier'] != 'exact':
+            estimate += stats.num_present * TEXT_SELECTIVITY * len(alt.split())
+        else:
+            estimate += float(stats.num_present) / max(stats.num_distinct, 1)
+    return min(estimate, stats.num_present)
 
 
 def make_number_pred(param_data, param_val):
@@ -87,24 +160,27 @@ def make_quantity_pred(param_data, param_val):
         preds.append(SearchParam.system == quantity.group('system')) 
     # tough stuff here... because quantity stored in the database can also have comparator
     # we have to build query based on the comparators from both the search and the db
-    value = quantity.group('number') 
+    value = float(quantity.group('number'))
     comparator = quantity.group('comparator') 
     if comparator is None:
         comparator = '=' 
 
+    # a stored quantity is either a plain value (comparator `=`, see `indexer.index_quantity`,
+    # or none) or a bound (e.g. `<5`), which is only matched by a search on the same side of it
+    plain = db.or_(SearchParam.comparator == None, SearchParam.comparator == '=')
     val_preds = []
     if '<' in comparator:
-        val_preds = [
-            SearchParam.comparator.in_('<', '<='),
-            SearchParam.comparator.quantity < value]
-    elif '>' in comparison:
-        val_preds = [
-            SearchParam.comparator.in_('>', '>='),
-            SearchParam.comparator.quantity > value]
+        val_preds.append(db.and_(
+                            db.or_(plain, SearchParam.comparator.in_(['<', '<='])),
+                            SearchParam.quantity < value))
+    elif '>' in comparator:
+        val_preds.append(db.and_(
+                            db.or_(plain, SearchParam.comparator.in_(['>', '>='])),
+                            SearchParam.quantity > value))
 
     if '=' in comparator:
         val_preds.append(db.and_(
-                            SearchParam.comparator.in_(None, '<=', '>='),
+                            db.or_(plain, SearchParam.comparator.in_(['<=', '>='])),
                             SearchParam.quantity == value))
 
     preds.append(db.or_(*val_preds)) 
@@ -142,8 +218,8 @@ def make_string_pred(param_data, param_val):
         # we split the search param here so that
         # an (inexact) search like "hello world" will get a hit 
         # for text like "hello tom" even though the whole text might not be hit.
-        preds = [SearchParam.text.ilike('%%%s%%' % text)
-                 for text in param_val.split()]
+        # (a trigram index is used if there's one, see `text_index`)
+        preds = [make_text_pred(text) for text in param_val.split()]
         return db.or_(*preds)
 
 
@@ -179,31 +255,51 @@ PRED_MAKERS = {
 }
 
 def make_coord_pred(coord): 
+    '''
+    Compile a coordinate search (e.g. "1:123-123123") into a SQL predicate
+
+    Besides comparing start and end positions, we also restrict the search to the
+    bins that can have overlapping sequences, so that an index can be used.
+    '''
     coord_match = COORD_RE.match(coord) 
     if coord_match is None:
         raise InvalidQuery
     chrom = coord_match.group('chrom')
-    start = coord_match.group('start')
-    end = coord_match.group('end')
-    return db.and_(
-            Resource.resource_type == 'Sequence',
-            Resource.chromosome == chrom,
-            Resource.start <= end,
-            Resource.end >= start) 
+    start = int(coord_match.group('start'))
+    end = int(coord_match.group('end'))
+    preds = [Resource.resource_type == 'Sequence',
+             Resource.chromosome == chrom,
+             Resource.start <= end,
+             Resource.end >= start]
+    bins = [_bin
+            for first, last in get_overlapping_bins(start, end)
+            for _bin in xrange(first, last + 1)]
+    if len(bins) <= MAX_COORD_BINS:
+        preds.append(Resource.bin.in_(bins))
+    return db.and_(*preds) 
 
 
 class QueryBuilder(object):
     def __init__(self, resource_owner):
         self.owner_id = resource_owner.email
+        self.max_chain_depth = current_app.config.get('SEARCH_MAX_CHAIN_DEPTH', MAX_CHAIN_DEPTH)
+        self.max_chain_cost = current_app.config.get('SEARCH_MAX_CHAIN_COST', MAX_CHAIN_COST)
+        # compiled chains, so that an identical chain is only compiled once,
+        # and estimated number of search params read by all of them
+        self.chains = {}
+        self.chain_cost = 0
+
+    def add_chain_cost(self, estimate):
+        '''
+        account for search params read by a chain, reject the search if it reads too many
+        '''
+        self.chain_cost += estimate
+        if self.chain_cost > self.max_chain_cost:
+            raise InvalidQuery
 
-    def make_reference_pred(self, param_data, param_val, resource_type):
-        '''	
-        make a predicate based on a ResourceReference
-
-        Implement it as a method here because `make_reference_pred`,
-        unlike other `make_**_pred`s, can potentially be dealing with
-        chained query -- which requires us to reinvoke `build_query`
-        method recursively.
+    def get_referenced_type(self, param_data, resource_type):
+        '''
+        figure out type of resources referenced by a search param
         '''
         # a reference search must have exactly ONE resource type,
         # which is either specified via a modifier
@@ -217,34 +313,137 @@ class QueryBuilder(object):
             # either can't deduct type of the referenced resource
             # or the modifier supplied is an invalid type
             raise InvalidQuery 
-        referenced_type = (modifier
-                        if modifier is not None and modifier not in NON_TYPE_MODIFIERS
-                        else possible_reference_types[0]) 
-        chained_param = param_data['chained_param']
-        if chained_param is not None:
-            # we have a chained query...
-            chained_query = {chained_param: param_val}
-            # make a subquery that finds referenced resoruce that fits the description
-            reference_query = self.build_query(referenced_type,
-                                         chained_query,
-                                         id_only=True) 
-            pred = db.and_(SearchParam.referenced_type==referenced_type,
-                            SearchParam.referenced_id.in_(reference_query))
-        else:
-            pred = db.and_(SearchParam.referenced_id==param_val,
-                            SearchParam.referenced_type==referenced_type)
-    
-        return pred
+        return (modifier
+                if modifier is not None and modifier not in NON_TYPE_MODIFIERS
+                else possible_reference_types[0]) 
 
+    def make_reference_pred(self, param_data, param_val, resource_type):
+        '''	
+        make a predicate based on a ResourceReference
+        '''
+        referenced_type = self.get_referenced_type(param_data, resource_type)
+        return db.and_(SearchParam.referenced_id==param_val,
+                       SearchParam.referenced_type==referenced_type)
 
-    def make_pred_from_param(self, resource_type, param_and_val, possible_param_types):
+    def select_chain(self, resource_type, param_and_val, depth):
         '''
-        Compile FHIR search parameter into a SQL predicate
+        select keys of (current versions of) resources matching a search param,
+        return the selection and estimated number of resources it has
+
+        This is the end of a chained search (e.g. `Patient?name=Smith` of `subject.name=Smith`),
+        which is joined with search params referencing these resources.
+        (It's not a CTE, since Python 2's sqlite3 doesn't know that a `WITH` statement
+        returns nothing when it finds nothing.)
+        '''
+        key = (resource_type,) + tuple(param_and_val)
+        if key in self.chains:
+            chain, estimate, cost = self.chains[key]
+            self.add_chain_cost(cost)
+            return chain, estimate
+        if depth > self.max_chain_depth:
+            raise InvalidQuery
+        cost_before = self.chain_cost
+        raw_param, param_val = param_and_val
+        if raw_param.startswith('_has:'):
+            referencing, estimate = self.select_referencing(resource_type, param_and_val, depth)
+            chain = (db.select([Resource.owner_id, Resource.resource_id, Resource.update_time])
+                    .select_from(Resource.__table__.join(
+                        referencing,
+                        db.and_(Resource.owner_id == referencing.c.owner_id,
+                                Resource.resource_id == referencing.c.resource_id)))
+                    .where(db.and_(Resource.visible == True,
+                                   Resource.resource_type == resource_type)))
+        else:
+            matched = self.make_pred_from_param(resource_type,
+                                                param_and_val,
+                                                SPECS[resource_type]['searchParams'],
+                                                depth=depth)
+            if matched is None:
+                raise InvalidQuery
+            pred, estimate = matched
+            self.add_chain_cost(estimate)
+            chain = (db.select([SearchParam.owner_id, SearchParam.resource_id, SearchParam.update_time])
+                    .select_from(SearchParam.__table__.join(
+                        Resource.__table__,
+                        db.and_(*[sp_col == res_col
+                                  for sp_col, res_col in zip(SEARCH_PARAM_KEY, RESOURCE_KEY)])))
+                    .where(db.and_(Resource.visible == True, pred)))
+        # a set of resources, which keeps SQLite from flattening it into the join
+        # (and then reading referencing search params before it knows which resources are referenced)
+        chain = chain.distinct().alias('chain_%d' % len(self.chains))
+        self.chains[key] = chain, estimate, self.chain_cost - cost_before
+        return chain, estimate
+
+    def select_referencing(self, resource_type, param_and_val, depth):
+        '''
+        select (owner and id of) resources referenced by resources matching a reverse chained search
+        (e.g. Patients referenced by `subject` of Observations with `code=1234`
+        for `Patient?_has:Observation:subject:code=1234`),
+        return the selection and estimated number of references it has
+        '''
+        raw_param, param_val = param_and_val
+        has = HAS_RE.match(raw_param)
+        if has is None or has.group('resource_type') not in SPECS:
+            raise InvalidQuery
+        referencing_type = has.group('resource_type')
+        reference_param = has.group('reference_param')
+        if SPECS[referencing_type]['searchParams'].get(reference_param) != 'reference':
+            raise InvalidQuery
+        reference_types = REFERENCE_TYPES[referencing_type][reference_param]
+        if resource_type not in reference_types and reference_types[0] != 'Any':
+            raise InvalidQuery
+        chain, chain_estimate = self.select_chain(referencing_type,
+                                                  (has.group('param'), param_val),
+                                                  depth + 1)
+        stats = get_param_stats(self.owner_id, referencing_type, reference_param, 'reference')
+        # search params referencing from each resource
+        estimate = chain_estimate * float(stats.num_present) / max(stats.num_rows, 1)
+        self.add_chain_cost(estimate)
+        referencing = (db.select([SearchParam.owner_id, SearchParam.referenced_id.label('resource_id')])
+                .select_from(SearchParam.__table__.join(
+                    chain,
+                    db.and_(SearchParam.owner_id == chain.c.owner_id,
+                            SearchParam.resource_id == chain.c.resource_id,
+                            SearchParam.update_time == chain.c.update_time)))
+                .where(db.and_(SearchParam.resource_type == referencing_type,
+                               SearchParam.name == reference_param,
+                               SearchParam.param_type == 'reference',
+                               SearchParam.referenced_type == resource_type)))
+        return referencing.alias(), estimate
+
+    def make_chain_pred(self, param_data, param_val, resource_type, depth):
+        '''
+        make a predicate of a chained search (e.g. `subject.name=Smith`),
+        which joins search params with resources they reference (see `select_chain`),
+        return the predicate and estimated number of referenced resources
+        '''
+        referenced_type = self.get_referenced_type(param_data, resource_type)
+        # a union (e.g. `subject.name=Smith,Jones`) is dealt with by the end of the chain
+        chain, estimate = self.select_chain(referenced_type,
+                                            (param_data['chained_param'], param_val),
+                                            depth + 1)
+        if depth == 0:
+            # search params of searched resources are semi-joined with the chain, since
+            # they are either what the search starts with, or checked for each found resource
+            # (see `build_query`), and SQLite would rather read all of the chain for each of them
+            pred = db.tuple_(SearchParam.owner_id, SearchParam.referenced_id).in_(
+                db.select([chain.c.owner_id, chain.c.resource_id]))
+        else:
+            # a chain is always read as a whole
+            pred = db.and_(SearchParam.referenced_id==chain.c.resource_id,
+                           SearchParam.owner_id==chain.c.owner_id)
+        return db.and_(SearchParam.referenced_type==referenced_type, pred), estimate
+
+    def make_pred_from_param(self, resource_type, param_and_val, possible_param_types, depth=0):
+        '''
+        Compile FHIR search parameter into a SQL predicate (of SearchParam),
+        return the predicate and estimated number of search params it matches
 
         This is the "master" function that invokes other `make_*_pred` functions.
         `param_and_val` is the key-value pair of a parameter and its value
         `possible_param_types` is a dictionary maintaining the mapping between
         a name of a search parameter and it's type (string, number, etc).
+        `depth` is how many links of a chained search there are before this parameter.
         '''
         raw_param, param_val = param_and_val 
         matched_param = PARAM_RE.match(raw_param)
@@ -258,10 +457,16 @@ class QueryBuilder(object):
             # an undefined search parameter is supplied
             return None 
         param_type = possible_param_types[param] if modifier != 'text' else 'string'
+        chain_estimate = None
         if modifier == 'missing':
             pred = ((SearchParam.missing == True)
                     if param_val == 'true'
                     else (SearchParam.missing == False))
+        elif param_data['chained_param'] is not None:
+            if param_type != 'reference':
+                raise InvalidQuery
+            chain_pred, chain_estimate = self.make_chain_pred(param_data, param_val, resource_type, depth)
+            preds = [chain_pred]
         else:
             if param_type == 'reference':
                 pred_maker = partial(self.make_reference_pred,
@@ -273,18 +478,23 @@ class QueryBuilder(object):
             # deal with FHIR's union search (e.g. `abc=x,y,z`) here
             alts = param_val.split(',')
             preds = [pred_maker(param_data, alt) for alt in alts]
-            pred = db.or_(*preds)
     
-        return db.and_(pred,
-                       SearchParam.name==param,
-                       SearchParam.param_type==possible_param_types[param],
-                       SearchParam.owner_id==self.owner_id)
+        param_pred = db.and_(SearchParam.name==param,
+                             SearchParam.param_type==possible_param_types[param],
+                             SearchParam.owner_id==self.owner_id,
+                             SearchParam.resource_type==resource_type)
+        if modifier == 'missing':
+            pred = db.and_(pred, param_pred)
+        else:
+            # every alternative of a union search is a complete predicate,
+            # so each of them can be looked up with an index (e.g. `ix_searchparam_reference`)
+            pred = db.or_(*[db.and_(alt_pred, param_pred) for alt_pred in preds])
+        stats = get_param_stats(self.owner_id, resource_type, param, possible_param_types[param])
+        return pred, estimate_matches(stats, param_data, param_type, param_val, chain_estimate)
     
-    def build_query(self, resource_type, params, id_only=False):
+    def build_query(self, resource_type, params):
         '''
         Compile a SQL query from a set of FHIR search params
-        
-        If `id_only` is true, a SQL query that selects only `resource_id` will be returned
         '''
         query_args = [Resource.visible == True,
                       Resource.resource_type == resource_type,
@@ -303,14 +513,109 @@ class QueryBuilder(object):
             coord_preds = map(make_coord_pred, coords)
             query_args.append(db.or_(*coord_preds))
         if len(predicates) > 0:
-            query_args.append(
-                Resource.resource_id.in_(intersect_predicates(predicates).alias())) 
+            # search params are matched by the full key of a resource version, so that
+            # a resource can't be found by what an older version (or another resource type) says.
+            # Resources matching the most selective predicates are found first (a semi-join
+            # with the intersection of what they match), then each of them is checked against
+            # the rest of the predicates, from more to less selective, by looking up its search params.
+            # A predicate is in the first group if reading what it matches is cheaper than
+            # looking up search params of resources matching the most selective one.
+            predicates.sort(key=lambda (pred, estimate): estimate)
+            max_estimate = predicates[0][1] * PROBE_COST
+            num_first = len([estimate for _, estimate in predicates if estimate <= max_estimate])
+            if num_first == 1:
+                matched = select_matched(predicates[0][0])
+            else:
+                # SQLite can only look up resources by keys from an intersection
+                # if it's wrapped in a subquery
+                intersected = db.intersect(*[select_matched(pred)
+                                             for pred, _ in predicates[:num_first]]).alias()
+                matched = db.select(list(intersected.c)).select_from(intersected)
+            query_args.append(db.tuple_(*RESOURCE_KEY).in_(matched))
+            query_args.extend(has_matched(pred) for pred, _ in predicates[num_first:])
+        # reverse chained search (e.g. `Patient?_has:Observation:subject:code=1234`)
+        for param_and_val in iterdict(params):
+            if param_and_val[0].startswith('_has:'):
+                referencing, _ = self.select_referencing(resource_type, param_and_val, 0)
+                query_args.append(db.tuple_(Resource.owner_id, Resource.resource_id).in_(
+                    db.select(list(referencing.c)).select_from(referencing)))
         if '_id' in params:
             query_args.append(Resource.resource_id.in_(params['_id'].split(',')))
 
-        if id_only:
-            return db.select([Resource.resource_id]).\
-                                    select_from(Resource).\
-                                    where(db.and_(*query_args)).alias()
-        else: 
-            return Resource.query.filter(*query_args)
+        return Resource.query.filter(*query_args)
+
+    def get_includes(self, resource_type, params):
+        '''
+        parse `_include` and `_revinclude` params of a search,
+        return a list of (whether it's `_revinclude`, type of referencing resources,
+        name of the reference search param, type of referenced resources or None if it can be any)
+        '''
+        includes = []
+        for raw_param, param_val in iterdict(params):
+            if raw_param not in ('_include', '_revinclude'):
+                continue
+            include = INCLUDE_RE.match(param_val)
+            if include is None:
+                raise InvalidQuery
+            referencing_type, param, referenced_type = include.groups()
+            if (referencing_type not in SPECS or
+                    SPECS[referencing_type]['searchParams'].get(param) != 'reference'):
+                raise InvalidQuery
+            reverse = (raw_param == '_revinclude')
+            if reverse:
+                # found resources are referenced
+                if referenced_type not in (None, resource_type):
+                    raise InvalidQuery
+                referenced_type = resource_type
+            elif referencing_type != resource_type:
+                # found resources are referencing
+                raise InvalidQuery
+            reference_types = REFERENCE_TYPES[referencing_type][param]
+            if (referenced_type is not None and
+                    referenced_type not in reference_types and
+                    reference_types[0] != 'Any'):
+                raise InvalidQuery
+            includes.append((reverse, referencing_type, param, referenced_type))
+        return includes
+
+    def build_include_query(self, include, resource_ids):
+        '''
+        Compile a SQL query of (current versions of) resources included by a search
+        (see `get_includes`), given ids of resources it found
+
+        Referenced resources are found by search params of found resources,
+        and referencing resources by their search params referencing found resources
+        (i.e. `ix_searchparam_reference`), so an include is one query for a page of resources.
+        '''
+        reverse, referencing_type, param, referenced_type = include
+        reference_pred = db.and_(SearchParam.owner_id==self.owner_id,
+                                 SearchParam.resource_type==referencing_type,
+                                 SearchParam.name==param,
+                                 SearchParam.param_type=='reference')
+        if reverse:
+            included = (db.select(SEARCH_PARAM_KEY)
+                    .where(db.and_(reference_pred,
+                                   SearchParam.referenced_type==referenced_type,
+                                   SearchParam.referenced_id.in_(resource_ids)))
+                    .alias())
+            included_key = RESOURCE_KEY
+        else:
+            if referenced_type is not None:
+                reference_pred = db.and_(reference_pred, SearchParam.referenced_type==referenced_type)
+            # only references of current versions of found resources
+            included = (db.select([SearchParam.owner_id, SearchParam.referenced_type, SearchParam.referenced_id])
+                    .select_from(SearchParam.__table__.join(
+                        Resource.__table__,
+                        db.and_(*[sp_col == res_col
+                                  for sp_col, res_col in zip(SEARCH_PARAM_KEY, RESOURCE_KEY)])))
+                    .where(db.and_(reference_pred,
+                                   Resource.visible == True,
+                                   SearchParam.resource_id.in_(resource_ids)))
+                    .alias())
+            included_key = (Resource.owner_id, Resource.resource_type, Resource.resource_id)
+        # (SQLite can only look up resources by keys from a subquery, see `build_query`)
+        return (Resource.query
+                .filter(Resource.visible == True,
+                        db.tuple_(*included_key).in_(
+                            db.select(list(included.c)).select_from(included)))
+                .order_by(Resource.update_time, Resource.resource_id))
@@ -0,0 +1,155 @@
+'''
+Statistics of search params, used to estimate how many resources a search predicate
+matches, so that the most selective one is run first (see `query_builder.QueryBuilder`)
+
+Statistics are gathered per owner, resource type and search param, of search params
+of current versions of resources (the only ones searched), and cached (per process)
+for STATS_TTL seconds, which is how long statistics of e.g. a bulk load take to be seen
+by workers of a server (that are separate processes). They're gathered from a sample of STATS_SAMPLE_SIZE search params,
+so a search doesn't wait for all search params of e.g. a million Observations to be read.
+
+The database's own planner needs statistics too. Postgres keeps them up to date itself
+(autovacuum), SQLite only has them after ANALYZE, without which it would check a predicate
+of every matched resource (see `query_builder.has_matched`) by e.g. scanning a date range
+of all search params, rather than looking up the resource's few search params.
+A full ANALYZE reads every index, so it's never run while serving a request: `migrate_db.py`
+runs it, and so do jobs that load a lot of resources (e.g. `load_bulk.py`) if search params
+have grown a lot since the last time. (A sampled ANALYZE, i.e. with `analysis_limit`,
+is no good, since every index of search params starts with `owner_id`,
+which is the same for a sample of any size.)
+'''
+import time
+from sqlalchemy.exc import OperationalError
+from database import db
+from models import Resource, SearchParam
+from util import LRUCache
+
+STATS_TTL = 600
+STATS_CACHE_SIZE = 10000
+# statistics of a search param of more resources than this are those of a sample of them
+STATS_SAMPLE_SIZE = 10000
+# number of distinct values in a sample is taken to grow with the sample,
+# if it's more than this fraction of values (like Postgres does)
+DISTINCT_SCALED = 0.1
+# SQLite is analyzed again when there are this many times as many search params
+ANALYZE_GROWTH = 2
+
+# column of the value of a search param of each type
+VALUE_COLUMNS = {
+    'token': SearchParam.code,
+    'reference': SearchParam.referenced_id,
+    'string': SearchParam.text,
+    'number': SearchParam.quantity,
+    'quantity': SearchParam.quantity,
+    'date': SearchParam.start_date
+}
+# types of search params that can be searched by a range (e.g. `date=>2010`)
+RANGE_TYPES = ('number', 'quantity', 'date')
+
+_cache = LRUCache(STATS_CACHE_SIZE)
+
+
+class ParamStats(object):
+    '''
+    number of rows, distinct values, and rows with the search param missing,
+    and the smallest and the largest value of a date, number or quantity
+    '''
+    def __init__(self, num_rows, num_distinct, num_missing, min_value=None, max_value=None):
+        self.num_rows = num_rows
+        self.num_distinct = num_distinct
+        self.num_missing = num_missing
+        self.min_value = min_value
+        self.max_value = max_value
+
+    @property
+    def num_present(self):
+        return self.num_rows - self.num_missing
+
+
+def _gather_stats(owner_id, resource_type, name, param_type):
+    '''
+    gather statistics of a search param of current versions of resources from a sample
+    of (at most `STATS_SAMPLE_SIZE`) search params, scaled up to all of them if there are more
+    '''
+    param_preds = [SearchParam.owner_id == owner_id,
+                   SearchParam.name == name,
+                   SearchParam.param_type == param_type,
+                   SearchParam.resource_type == resource_type]
+    sample = (db.select([VALUE_COLUMNS[param_type].label('value'), SearchParam.missing, Resource.visible])
+              .where(db.and_(Resource.owner_id == SearchParam.owner_id,
+                             Resource.resource_type == SearchParam.resource_type,
+                             Resource.resource_id == SearchParam.resource_id,
+                             Resource.update_time == SearchParam.update_time,
+                             *param_preds))
+              .limit(STATS_SAMPLE_SIZE)
+              .alias())
+    visible = (sample.c.visible == True)
+    visible_value = db.case([(visible, sample.c.value)])
+    columns = [db.func.count(),
+               db.func.sum(db.case([(visible, 1)], else_=0)),
+               db.func.count(db.distinct(visible_value)),
+               db.func.sum(db.case([(db.and_(visible, sample.c.missing == True), 1)], else_=0))]
+    if param_type in RANGE_TYPES:
+        columns.extend([db.func.min(visible_value), db.func.max(visible_value)])
+    row = db.session.query(*columns).select_from(sample).one()
+    num_sampled, num_rows, num_distinct, num_missing = [num or 0 for num in row[:4]]
+    if num_sampled >= STATS_SAMPLE_SIZE:
+        # counting search params (of every version) is a lot cheaper than sampling them
+        scale = float(db.session.query(db.func.count()).filter(*param_preds).scalar()) / num_sampled
+        if num_distinct > num_rows * DISTINCT_SCALED:
+            num_distinct = int(num_distinct * scale)
+        num_rows = int(num_rows * scale)
+        num_missing = int(num_missing * scale)
+    return ParamStats(num_rows, num_distinct, num_missing, *row[4:])
+
+
+def _get_analyzed_rows(conn):
+    '''
+    number of search params when SQLite was last analyzed, None if it never was
+    '''
+    try:
+        stat = conn.execute("SELECT stat FROM sqlite_stat1 WHERE idx = 'ix_searchparam_resource'").scalar()
+    except OperationalError:
+        # no sqlite_stat1, i.e. never analyzed
+        return None
+    return int(stat.split()[0]) if stat is not None else None
+
+
+def analyze(engine, force=False):
+    '''
+    update statistics of SQLite's query planner if search params have grown
+    `ANALYZE_GROWTH` times since they were last updated (or regardless if `force`),
+    return if it's done
+    '''
+    if engine.dialect.name != 'sqlite':
+        return False
+    conn = engine.connect()
+    try:
+        if not force:
+            analyzed_rows = _get_analyzed_rows(conn)
+            # (max of a rowid is about as good as a count, and a lot cheaper)
+            num_rows = conn.execute(db.select([db.func.max(SearchParam.id)])).scalar() or 0
+            if analyzed_rows is not None and num_rows < analyzed_rows * ANALYZE_GROWTH:
+                return False
+        conn.execute('ANALYZE')
+    except OperationalError:
+        # e.g. the database is locked by a writer, there's always next time
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+def get_param_stats(owner_id, resource_type, name, param_type):
+    '''
+    get statistics of a search param of an owner's resources of a type
+    '''
+    key = (owner_id, resource_type, name, param_type)
+    cached = _cache.get(key)
+    if cached is not None:
+        stats, cached_until = cached
+        if time.time() < cached_until:
+            return stats
+    stats = _gather_stats(*key)
+    _cache.set(key, (stats, time.time() + STATS_TTL))
+    return stats
@@ -0,0 +1,121 @@
+'''
+Trigram index of text of search params
+
+An inexact string search (see `query_builder.make_string_pred`) looks for a substring
+of `SearchParam.text`, which a B-tree index can't help with, so without this
+every `name=`/`family=` search scans the whole searchparam table.
+
+With Postgres we build a GIN index with pg_trgm, which `ILIKE '%word%'` uses as is.
+With SQLite we keep an FTS5 table (with the trigram tokenizer) in sync with searchparam
+using triggers, and `make_text_pred` searches it instead.
+If the index can't be built (e.g. the extension isn't available), we search without it.
+The index is built by `migrate_db.py` (and `setup_db.py`) rather than when the server starts,
+since creating an extension takes a lock, which every worker of a server would wait for.
+'''
+from sqlalchemy import event, DDL
+from sqlalchemy.exc import DBAPIError
+from database import db
+from models import SearchParam
+
+FTS_TABLE = 'searchparam_fts'
+POSTGRES_INDEX = 'ix_searchparam_text_trgm'
+
+POSTGRES_DDLS = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS %s ON searchparam USING gin (text gin_trgm_ops)' % POSTGRES_INDEX
+]
+
+SQLITE_DDLS = [
+    # an external content table, i.e. text is only stored in searchparam
+    "CREATE VIRTUAL TABLE {fts} USING fts5(text, content='searchparam', content_rowid='id', tokenize='trigram')",
+    '''CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON searchparam BEGIN
+        INSERT INTO {fts}(rowid, text) VALUES (new.id, new.text);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON searchparam BEGIN
+        INSERT INTO {fts}({fts}, rowid, text) VALUES ('delete', old.id, old.text);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF text ON searchparam BEGIN
+        INSERT INTO {fts}({fts}, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO {fts}(rowid, text) VALUES (new.id, new.text);
+    END''',
+    # index search params saved before the table is created
+    "INSERT INTO {fts}({fts}) VALUES ('rebuild')"
+]
+
+FTS = db.table(FTS_TABLE, db.column('rowid'), db.column('text'))
+
+# url of database -> whether the FTS table is there
+_has_fts = {}
+
+# FTS table is dropped with searchparam (its triggers are dropped anyway),
+# otherwise it'd index rows that are gone
+event.listen(SearchParam.__table__,
+             'after_drop',
+             DDL('DROP TABLE IF EXISTS %s' % FTS_TABLE).execute_if(dialect='sqlite'))
+
+
+@event.listens_for(SearchParam.__table__, 'after_drop')
+def _forget_fts(target, conn, **kwargs):
+    _has_fts.pop(str(conn.engine.url), None)
+
+
+def _has_fts_table(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        FTS_TABLE).first() is not None
+
+
+def create_text_index(engine):
+    '''
+    build the index if it's not there yet, return whether it's usable
+    '''
+    try:
+        with engine.begin() as conn:
+            if engine.dialect.name == 'postgresql':
+                for ddl in POSTGRES_DDLS:
+                    conn.execute(ddl)
+            elif engine.dialect.name == 'sqlite' and not _has_fts_table(conn):
+                for ddl in SQLITE_DDLS:
+                    conn.execute(ddl.format(fts=FTS_TABLE))
+        indexed = True
+    except DBAPIError:
+        indexed = False
+    if engine.dialect.name == 'sqlite':
+        _has_fts[str(engine.url)] = indexed
+    return indexed
+
+
+def has_fts(engine):
+    '''
+    check if we can search the FTS table (of a SQLite database)
+    '''
+    url = str(engine.url)
+    if url not in _has_fts:
+        with engine.connect() as conn:
+            _has_fts[url] = _has_fts_table(conn)
+    return _has_fts[url]
+
+
+def has_text_index(engine):
+    '''
+    check if the index is there
+    '''
+    if engine.dialect.name == 'sqlite':
+        return has_fts(engine)
+    elif engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            return conn.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                                POSTGRES_INDEX).first() is not None
+    return False
+
+
+def make_text_pred(text):
+    '''
+    make a predicate matching search params whose text contains `text` (case-insensitively)
+    '''
+    pattern = '%%%s%%' % text
+    engine = db.engine
+    if engine.dialect.name == 'sqlite' and has_fts(engine):
+        # LIKE of SQLite is case-insensitive, and FTS5 can use the trigram index with it
+        return SearchParam.id.in_(
+                db.select([FTS.c.rowid]).where(FTS.c.text.like(pattern)))
+    return SearchParam.text.ilike(pattern)
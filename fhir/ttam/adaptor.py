@@ -6,12 +6,12 @@ profile ids associated with the user who granted the access
 '''
 from flask import request, g
 from functools import wraps
-from itertools import chain
+from itertools import chain, islice
 from models import TTAMClient
 from error import TTAMOAuthError
 from ..models import Resource
 from ..query_builder import COORD_RE, InvalidQuery
-from util import slice_, get_snps, get_coord
+from util import slice_, get_coord, get_region, iter_distinct_snps, count_snps
 
 # we use this to distinguish any 23andMe resource from internal resources
 PREFIX = 'ttam_'
@@ -53,9 +53,9 @@ def make_ttam_seq(snp, coord, pid):
         },
         'genomeBuild': 'GRch37', 
         'type': 'dna',
-        'chromosome': chrom,
-        'startPosition': int(pos),
-        'endPosition': int(pos),
+        'chromosome': {'text': chrom},
+        'start': int(pos),
+        'end': int(pos),
         'observedSequence': list(snp['call']),
         'patient': {'reference': '/Patient/ttam_%s'% pid}
     }
@@ -190,45 +190,78 @@ def get_one(resource_type, resource_id):
         return get_one_patient(internal_id)
 
 
+def get_sequence_pids(query):
+    '''
+    given a query for Sequence resources, return ids of 23andMe profiles whose SNPs are searched
+    '''
+    if not is_dna_query(query):
+        # 23andMe only has DNA sequences
+        return []
+    return (extract_pids(query['patient'].split(','))
+            if 'patient' in query
+            else g.ttam_client.get_profiles())
+
+
+def get_patients(query):
+    '''
+    given a query for Patient resources, return 23andMe profiles found
+    '''
+    pids = (extract_pids(query['_id'].split(','))
+            if '_id' in query
+            else g.ttam_client.get_profiles())
+    return [pt for pt in g.ttam_client.get_patients()
+            if pt['id'] in pids]
+
+
 # TODO support _id query for Sequence resources
 @require_client
-def get_many(resource_type, query, offset, limit):
+def count_many(resource_type, query):
     '''
-    Get a list of Sequence/Patient resources from 23andMe
-    and its total count (returned resources might be a slice).
+    Count Sequence/Patient resources from 23andMe found by a query.
+
+    SNPs of regions are counted once (see `count_snps`), so later pages don't count them again.
     '''
     if resource_type == 'Sequence':
-        if not is_dna_query(query):
-            # 23andMe only has DNA sequences
-            return [], 0 
-        pids = (extract_pids(query['patient'].split(','))
-                if 'patient' in query
-                else g.ttam_client.get_profiles())
+        pids = get_sequence_pids(query)
         if len(pids) == 0:
-            return [], 0
-        limit /= len(pids) 
-        coords = extract_coords(query)
-        snp_table = {}
-        for coord in coords:
-            snp_table.update(get_snps(**coord))
-        rsids, num_snps = slice_(snp_table.keys(), offset, limit)
-        if num_snps == 0 or len(rsids) == 0:
-            # here we either find no snps
-            # or we find snps but don't have to make any
-            # query because of paging (i.e. limit is 0 or overly large offset)
-            return [], num_snps
-        snps_data = g.ttam_client.get_snps(rsids, pids)
-        seqs = []
-        for pid, snps in snps_data.iteritems():
-            for snp in snps:
-                coord = snp_table[snp['location']]
-                seqs.append(make_ttam_seq(snp, coord, pid)) 
-        return seqs, num_snps*len(pids)
+            return 0
+        regions = map(get_region, extract_coords(query))
+        return count_snps(regions) * len(pids)
+    else:
+        return len(get_patients(query))
+
+
+@require_client
+def get_many(resource_type, query, offset, limit):
+    '''
+    Get a page (`limit` resources starting at `offset`) of Sequence/Patient resources from 23andMe.
+
+    Sequences are ordered by position of their SNPs and then by order of patients,
+    i.e. the i-th Sequence is genotype of the (i / number of patients)-th SNP of
+    the (i % number of patients)-th patient. Only SNPs of the page are read and
+    only their genotypes are fetched.
+    '''
+    if resource_type == 'Sequence':
+        pids = get_sequence_pids(query)
+        if len(pids) == 0 or limit <= 0:
+            return []
+        regions = map(get_region, extract_coords(query))
+        first_snp = offset / len(pids)
+        end_snp = (offset + limit - 1) / len(pids) + 1
+        snps = list(islice(iter_distinct_snps(regions), first_snp, end_snp))
+        if len(snps) == 0:
+            # here we either find no snps or get an overly large offset
+            return []
+        snps_data = g.ttam_client.get_snps([rsid for rsid, _ in snps], pids)
+        genotypes = {(pid, snp['location']): snp
+                     for pid, pid_snps in snps_data.iteritems()
+                     for snp in pid_snps}
+        page_start = offset - first_snp * len(pids)
+        page = islice(((rsid, coord, pid) for rsid, coord in snps for pid in pids),
+                      page_start, page_start + limit)
+        return [make_ttam_seq(genotypes[(pid, rsid)], coord, pid)
+                for rsid, coord, pid in page
+                if (pid, rsid) in genotypes]
     else:
-        pids = (extract_pids(query['_id'].split(','))
-                if '_id' in query
-                else g.ttam_client.get_profiles())
-        patients = [pt for pt in g.ttam_client.get_patients()
-                if pt['id'] in pids]
-        patients, count = slice_(patients, offset, limit)
-        return map(make_ttam_patient, patients), count
+        patients, _ = slice_(get_patients(query), offset, limit)
+        return map(make_ttam_patient, patients)
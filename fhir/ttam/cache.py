@@ -0,0 +1,140 @@
+'''
+Cache of responses of 23andMe API
+
+By default responses are cached in memory of each process (see `LocalCache`).
+To share them between processes, set `TTAM_CACHE` of the app's config to a cache
+with the interface of werkzeug's caches (e.g. `werkzeug.contrib.cache.RedisCache`).
+
+Cached responses are shared, so don't modify them.
+'''
+import time
+from threading import Lock, Event
+from flask import current_app
+from ..util import LRUCache
+
+CACHE_SIZE = 10000
+DEFAULT_TTL = 300
+
+# counters are updated by threads of a process, hence the lock
+STATS = {'hits': 0, 'misses': 0, 'coalesced': 0}
+_stats_lock = Lock()
+
+
+class LocalCache(object):
+    '''
+    In-process LRU cache whose items expire
+    '''
+    def __init__(self, capacity=CACHE_SIZE, default_timeout=DEFAULT_TTL):
+        self.default_timeout = default_timeout
+        self._items = LRUCache(capacity)
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, expire_at = item
+        if time.time() > expire_at:
+            self._items.pop(key)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        self._items.set(key, (value, time.time() + timeout))
+        return True
+
+    def delete(self, key):
+        return self._items.pop(key) is not None
+
+    def clear(self):
+        self._items.clear()
+        return True
+
+
+_local_cache = LocalCache()
+
+
+def get_cache():
+    return current_app.config.get('TTAM_CACHE', _local_cache)
+
+
+class _Call(object):
+    '''
+    an on-going call to 23andMe that other identical calls can wait for
+    '''
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+_calls = {}
+_calls_lock = Lock()
+
+
+def coalesce(key, call):
+    '''
+    return result of `call()`, but if an identical call (with the same key) is going on,
+    wait for and return its result instead of calling again
+    '''
+    with _calls_lock:
+        ongoing = _calls.get(key)
+        if ongoing is None:
+            ongoing = _calls[key] = _Call()
+            is_caller = True
+        else:
+            is_caller = False
+
+    if not is_caller:
+        _count('coalesced')
+        ongoing.done.wait()
+        if ongoing.error is not None:
+            raise ongoing.error
+        return ongoing.result
+
+    try:
+        ongoing.result = call()
+        return ongoing.result
+    except Exception as error:
+        ongoing.error = error
+        raise
+    finally:
+        with _calls_lock:
+            del _calls[key]
+        ongoing.done.set()
+
+
+def get_cached(key):
+    '''
+    get a cached response, None if it's not cached
+    '''
+    value = get_cache().get(key)
+    _count('misses' if value is None else 'hits')
+    return value
+
+
+def set_cached(key, value, ttl):
+    get_cache().set(key, value, timeout=ttl)
+
+
+def cached_call(key, call, ttl):
+    '''
+    return cached response of a call, or make (coalesced) call and cache the response
+    '''
+    value = get_cached(key)
+    if value is None:
+        value = coalesce(key, call)
+        set_cached(key, value, ttl)
+    return value
+
+
+def _count(name):
+    with _stats_lock:
+        STATS[name] += 1
+
+
+def get_hit_rate():
+    with _stats_lock:
+        hits, lookups = STATS['hits'], STATS['hits'] + STATS['misses']
+    return float(hits) / lookups if lookups > 0 else 0.
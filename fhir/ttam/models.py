@@ -2,13 +2,20 @@ from flask import current_app
 from datetime import datetime, timedelta
 from urlparse import urljoin
 from urllib import urlencode
-import requests
-import grequests
+import hashlib
 from error import TTAMOAuthError
+from cache import cached_call, get_cached, set_cached, coalesce
+import upstream
 from ..database import db
 
 TOKEN_URI = 'https://api.23andme.com/token/' 
 API_BASE = 'https://api.23andme.com/1/' 
+# how long (in seconds) responses of 23andMe are cached
+GENOTYPE_CACHE_TTL = 3600
+PROFILE_CACHE_TTL = 300
+# a genotypes request asks for at most this many SNPs (so that its url doesn't get too long);
+# more SNPs are split into multiple requests
+MAX_LOCATIONS = 200
 
 def assert_good_resp(resp):
     '''
@@ -57,23 +64,27 @@ class TTAMClient(db.Model):
             'scope': ttam_config['scope'],
             'code': code
         }
-        resp = requests.post(TOKEN_URI, data=post_data)
+        self.user_id = user_id 
+        resp = upstream.post(TOKEN_URI, data=post_data)
         assert_good_resp(resp)
         self._set_tokens(resp.json())
         # see if need to use demo data
-        self.set_api_base()
-        patients = self.get_patients()
+        patients = self.set_api_base()
         self.profiles = ' '.join(p['id'] for p in patients)
-        self.user_id = user_id 
 
     def set_api_base(self):
         '''
         Check if the user has genetic data,
         if not, use 23andme's demo data
+
+        return profiles of the user (or of the demo data)
         '''
         self.api_base = API_BASE
-        if len(self.get_patients()) == 0:
+        patients = self.get_patients()
+        if len(patients) == 0:
             self.api_base = urljoin(API_BASE, 'demo')
+            patients = self.get_patients()
+        return patients
 
     def _set_tokens(self, credentials):
         '''
@@ -102,7 +113,7 @@ class TTAMClient(db.Model):
             'scope': ttam_config['scope'],
             'refresh_token': self.refresh_token
         }
-        update_resp = requests.post(TOKEN_URI, data=post_data)
+        update_resp = upstream.post(TOKEN_URI, data=post_data)
         assert_good_resp(update_resp)
         self._set_tokens(update_resp.json())
         db.session.add(self)
@@ -124,18 +135,47 @@ class TTAMClient(db.Model):
         '''
         if pids is None:
             pids = self.get_profiles()
+        # genotypes are cached by profile and set of rsids
+        query_hash = hashlib.sha1(' '.join(sorted(query))).hexdigest()
+        cache_keys = {pid: self._get_cache_key('genotypes', pid, query_hash) for pid in pids}
+        snps = {}
+        for pid in pids:
+            genotypes = get_cached(cache_keys[pid])
+            if genotypes is not None:
+                snps[pid] = genotypes
+        missing_pids = [pid for pid in pids if pid not in snps]
+        if len(missing_pids) > 0:
+            fetched = coalesce(self._get_cache_key('genotypes', ' '.join(missing_pids), query_hash),
+                               lambda: self._fetch_snps(query, missing_pids))
+            for pid, genotypes in fetched.iteritems():
+                set_cached(cache_keys.get(pid, self._get_cache_key('genotypes', pid, query_hash)),
+                           genotypes, GENOTYPE_CACHE_TTL)
+            snps.update(fetched)
+        return snps
+
+    def _fetch_snps(self, query, pids):
+        '''
+        get genotypes (see `get_snps`) from 23andMe
+        '''
         api_endpoint = urljoin(self.api_base, 'genotypes/')
-        snps_str = ' '.join(query)
-        args = {'locations': snps_str, 'format': 'embedded'}
-        urls = (urljoin(api_endpoint, p)+"?"+urlencode(args)
-                for p in pids)
-        auth_header = self._get_header() 
-        reqs = (grequests.get(u, headers=auth_header) for u in urls)
-        resps = grequests.map(reqs) 
+        chunks = [query[i:i+MAX_LOCATIONS] for i in xrange(0, len(query), MAX_LOCATIONS)] or [[]]
+        urls = [urljoin(api_endpoint, p)+"?"+urlencode({'locations': ' '.join(chunk), 'format': 'embedded'})
+                for p in pids
+                for chunk in chunks]
+        resps = upstream.get_many(urls, headers=self._get_header())
         if any(resp.status_code != 200 for resp in resps):
             raise TTAMOAuthError(map(lambda r: r.text, resps))
-        patient_data = (resp.json() for resp in resps) 
-        return {pdata['id']: pdata['genotypes'] for pdata in patient_data}
+        snps = {}
+        for resp in resps:
+            pdata = resp.json()
+            snps.setdefault(pdata['id'], []).extend(pdata['genotypes'])
+        return snps
+
+    def _get_cache_key(self, *args):
+        '''
+        key of a cached response, responses are cached per user and API base (which might be demo)
+        '''
+        return ':'.join(('ttam', self.user_id, self.api_base) + args)
 
     def _get_header(self):
         '''
@@ -148,8 +188,11 @@ class TTAMClient(db.Model):
         '''
         get all profiles owned by the user who authorized this client
         '''
+        return cached_call(self._get_cache_key('names'), self._fetch_patients, PROFILE_CACHE_TTL)
+
+    def _fetch_patients(self):
         auth_header = self._get_header()
-        resp = requests.get(urljoin(self.api_base, 'names/'), headers=auth_header)
+        resp = upstream.get(urljoin(self.api_base, 'names/'), headers=auth_header)
         assert_good_resp(resp)
         return resp.json()['profiles']
 
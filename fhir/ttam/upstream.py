@@ -0,0 +1,121 @@
+'''
+HTTP client of 23andMe API
+
+All calls to 23andMe share a keep-alive connection pool (one per process),
+are made with timeouts, and are retried with backoff when 23andMe is busy (429)
+or failing (5xx). Time spent waiting for 23andMe is recorded in `STATS`
+and (for the current request) in `g.ttam_seconds`.
+'''
+import time
+from os import getpid
+from threading import Lock
+from flask import g, has_app_context
+import requests
+import grequests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from error import TTAMOAuthError
+
+# at most this many requests are made to 23andMe at once by a single call
+MAX_CONCURRENCY = 10
+# connections kept alive (per host)
+POOL_SIZE = 20
+# (connect, read) timeout in seconds
+TIMEOUT = (3.05, 30)
+# retry a GET that failed with these status codes,
+# waiting RETRY_BACKOFF * (2 ** retries) seconds between retries
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# counters are updated by threads of a process, hence the lock
+STATS = {'calls': 0, 'requests': 0, 'errors': 0, 'seconds': 0.}
+_stats_lock = Lock()
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    '''
+    get the requests session of this process (connection pools aren't safe to share after fork)
+    '''
+    global _session, _session_pid
+    if _session_pid != getpid():
+        session = requests.Session()
+        # POST (token exchange) is not retried since it's not idempotent
+        retry = Retry(total=MAX_RETRIES,
+                      backoff_factor=RETRY_BACKOFF,
+                      status_forcelist=RETRY_STATUSES,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=POOL_SIZE, max_retries=retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _session, _session_pid = session, getpid()
+    return _session
+
+
+def _record(started, num_requests, num_errors=0):
+    '''
+    record time spent waiting for 23andMe
+    '''
+    seconds = time.time() - started
+    with _stats_lock:
+        STATS['calls'] += 1
+        STATS['requests'] += num_requests
+        STATS['errors'] += num_errors
+        STATS['seconds'] += seconds
+    if has_app_context():
+        g.ttam_seconds = getattr(g, 'ttam_seconds', 0.) + seconds
+
+
+def request(method, url, **kwargs):
+    '''
+    make a single call to 23andMe
+    '''
+    kwargs.setdefault('timeout', TIMEOUT)
+    started = time.time()
+    try:
+        resp = get_session().request(method, url, **kwargs)
+    except requests.RequestException as e:
+        _record(started, 1, 1)
+        raise TTAMOAuthError(str(e))
+    _record(started, 1, int(resp.status_code != 200))
+    return resp
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def get_many(urls, headers=None):
+    '''
+    GET urls concurrently (at most MAX_CONCURRENCY at once) and return responses in order
+    '''
+    session = get_session()
+    reqs = [grequests.get(u, headers=headers, session=session, timeout=TIMEOUT)
+            for u in urls]
+    errors = []
+    started = time.time()
+    resps = grequests.map(reqs,
+                          size=MAX_CONCURRENCY,
+                          exception_handler=lambda _, e: errors.append(e))
+    _record(started,
+            len(reqs),
+            sum(1 for resp in resps if resp is None or resp.status_code != 200))
+    if errors:
+        raise TTAMOAuthError(map(str, errors))
+    return resps
+
+
+def get_average_latency():
+    '''
+    average seconds spent per call (a batch of concurrent requests counts as one call)
+    '''
+    with _stats_lock:
+        seconds, calls = STATS['seconds'], STATS['calls']
+    return seconds / calls if calls > 0 else 0.
@@ -1,19 +1,61 @@
-from os import path
+from os import path, getpid
+from threading import local
 from pysam import TabixFile, asTuple
+from ..util import LRUCache
+import json
+import mmap
+import struct
 
 SNP_FILE = path.join(path.dirname(path.abspath(__file__)), 'snps.sorted.txt.gz')
+# rsid -> coordinate index built from SNP_FILE (see `write_coord_index`)
+COORD_INDEX_FILE = path.join(path.dirname(path.abspath(__file__)), 'snps.coord.bin')
+HEADER_LEN = struct.Struct('<I')
+# (encoded rsid, index of chromosome, position)
+COORD_RECORD = struct.Struct('<QBI')
+# 23andMe uses ids from dbSNP (e.g. rs123) as well as its own ids (e.g. i3000001)
+RSID_PREFIXES = ('rs', 'i')
 
 SNP_IDX = 1 
 CHROM_IDX = 2
 POS_IDX = 3
 
-def get_snp_data(*args, **kwargs):
+# number of regions whose SNPs we keep in memory (see `get_snps`)
+REGION_CACHE_SIZE = 1000
+# SNPs of a region larger than this are not cached
+MAX_CACHED_SNPS = 10000
+_region_cache = LRUCache(REGION_CACHE_SIZE)
+# number of SNPs of (sets of) regions (see `count_snps`)
+_count_cache = LRUCache(REGION_CACHE_SIZE)
+
+# TabixFile opened by current thread (and process)
+_tabix = local()
+
+
+def get_tabix_file():
+    '''
+    return a TabixFile of SNP_FILE, which is opened (and its index read) once per process and thread
+
+    A forked process (e.g. a gunicorn worker) doesn't use the TabixFile opened by its parent.
+    '''
+    pid = getpid()
+    if getattr(_tabix, 'pid', None) != pid:
+        _tabix.tabix_file = TabixFile(SNP_FILE, parser=asTuple())
+        _tabix.pid = pid
+    return _tabix.tabix_file
+
+
+def get_snp_data(reference=None, start=None, end=None):
     '''
     proxy for TabixFile.fetch
+
+    NOTE a fetch of a region invalidates iterators of previous fetches (of the same thread),
+    we don't ask for `multiple_iterators` since it reopens the file (and reads its index) every time.
+    A fetch of the whole file does reopen it, since it reads on from wherever the file was left
+    (e.g. the end of the previous fetch) rather than from the start.
     '''
-    kwargs['multiple_iterators'] = True
-    return TabixFile(SNP_FILE, parser=asTuple()).\
-            fetch(*args, **kwargs)
+    if reference is None:
+        return get_tabix_file().fetch(multiple_iterators=True)
+    return get_tabix_file().fetch(reference, start, end)
 
 
 def slice_(xs, offset, limit):
@@ -28,17 +70,189 @@ def slice_(xs, offset, limit):
     return xs[offset:bound], num_items
 
 
+def _iter_region(region):
+    '''
+    iterate over SNPs of a region read from SNP_FILE, caching them if the region is small
+    '''
+    snps = []
+    for row in get_snp_data(*region):
+        snp = (row[SNP_IDX], (row[CHROM_IDX], row[POS_IDX]))
+        if snps is not None:
+            snps.append(snp)
+            if len(snps) > MAX_CACHED_SNPS:
+                snps = None
+        yield snp
+    # a region is cached only when it's read to the end
+    if snps is not None:
+        _region_cache.set(region, snps)
+
+
+def iter_snps(chrom=None, start=None, end=None):
+    '''
+    iterate over SNPs, as (rsid, (chromosome, position)), given genomic coordinates
+
+    SNPs come in order of position (the order of SNP_FILE),
+    and are read lazily unless the region is cached.
+    '''
+    region = (chrom, start, end)
+    snps = _region_cache.get(region)
+    if snps is not None:
+        return iter(snps)
+    return _iter_region(region)
+
+
 def get_snps(chrom=None, start=None, end=None):
     '''
-    return SNPs given genomic coordinates
+    return a list of SNPs (see `iter_snps`) given genomic coordinates
+
+    SNPs of a region are cached, so don't modify what's returned.
+    '''
+    region = (chrom, start, end)
+    snps = _region_cache.get(region)
+    return snps if snps is not None else list(_iter_region(region))
+
+
+def get_region(coord):
+    '''
+    given args for calling `get_snp_data` (see `adaptor.extract_coords`), return (chrom, start, end)
+    '''
+    return (coord.get('chrom'), coord.get('start'), coord.get('end'))
+
+
+def iter_distinct_snps(regions):
+    '''
+    iterate over SNPs of regions (in order of the regions), skipping SNPs seen in earlier regions
+    '''
+    if len(regions) == 1:
+        return iter_snps(*regions[0])
+    return _iter_distinct_snps(regions)
+
+
+def _iter_distinct_snps(regions):
+    seen = set()
+    for region in regions:
+        for snp in iter_snps(*region):
+            if snp[0] not in seen:
+                seen.add(snp[0])
+                yield snp
+
+
+def count_snps(regions):
+    '''
+    count (distinct) SNPs of regions
+
+    Counts are cached so that paging through SNPs of regions doesn't count them again,
+    which is only right because every fetch (see `get_snp_data`), including one of the whole file,
+    reads from the start of what's fetched.
+    '''
+    regions = tuple(regions)
+    count = _count_cache.get(regions)
+    if count is None:
+        count = sum(1 for _ in iter_distinct_snps(regions))
+        _count_cache.set(regions, count)
+    return count
+
+
+def encode_rsid(rsid):
+    '''
+    encode id of a SNP as an integer, return None if it's not an id we know
+    '''
+    for prefix_code, prefix in enumerate(RSID_PREFIXES):
+        number = rsid[len(prefix):]
+        if rsid.startswith(prefix) and number.isdigit():
+            return prefix_code << 56 | int(number)
+    return None
+
+
+def write_coord_index(index_f, rows):
+    '''
+    write an index of coordinates of SNPs given rows of SNP_FILE
+
+    The index is a header (chromosome names) followed by
+    fixed-sized records (see COORD_RECORD) sorted by rsid,
+    so that it can be binary-searched without being loaded.
+    '''
+    chromosomes = []
+    chrom_idx = {}
+    coords = {}
+    for row in rows:
+        key = encode_rsid(row[SNP_IDX])
+        if key is None:
+            continue
+        chrom = row[CHROM_IDX]
+        if chrom not in chrom_idx:
+            chrom_idx[chrom] = len(chromosomes)
+            chromosomes.append(chrom)
+        # keep the first coordinate of a SNP, like a scan of the file would
+        coords.setdefault(key, (chrom_idx[chrom], int(row[POS_IDX])))
+
+    header = json.dumps(chromosomes)
+    index_f.write(HEADER_LEN.pack(len(header)))
+    index_f.write(header)
+    for key in sorted(coords):
+        chrom, pos = coords[key]
+        index_f.write(COORD_RECORD.pack(key, chrom, pos))
+
+
+class CoordIndex(object):
+    '''
+    Memory-mapped index written by `write_coord_index`
+
+    Pages of the index are shared by all processes reading it.
+    '''
+    def __init__(self, index_f):
+        self._map = mmap.mmap(index_f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_len, = HEADER_LEN.unpack_from(self._map, 0)
+        self._start = HEADER_LEN.size + header_len
+        self.chromosomes = json.loads(self._map[HEADER_LEN.size:self._start])
+        self._size = (len(self._map) - self._start) / COORD_RECORD.size
+
+    def __len__(self):
+        return self._size
+
+    def get(self, rsid):
+        '''
+        return (chromosome, position) of a SNP, None if it's not indexed
+        '''
+        key = encode_rsid(rsid)
+        if key is None:
+            return None
+        low, high = 0, self._size
+        while low < high:
+            mid = (low + high) / 2
+            mid_key, chrom, pos = COORD_RECORD.unpack_from(
+                    self._map, self._start + mid * COORD_RECORD.size)
+            if mid_key < key:
+                low = mid + 1
+            elif mid_key > key:
+                high = mid
+            else:
+                return self.chromosomes[chrom], str(pos)
+        return None
+
+
+_coord_index = None
+
+
+def get_coord_index():
+    '''
+    load the coordinate index (once per process), None if it's not built
     '''
-    return {row[SNP_IDX]: (row[CHROM_IDX], row[POS_IDX]) for row in get_snp_data(chrom, start, end)}
+    global _coord_index
+    if _coord_index is None and path.exists(COORD_INDEX_FILE):
+        with open(COORD_INDEX_FILE, 'rb') as index_f:
+            _coord_index = CoordIndex(index_f)
+    return _coord_index
 
 
 def get_coord(snp):
     '''
     given a SNP return its genomic coordinate
     '''
+    coord_index = get_coord_index()
+    if coord_index is not None:
+        return coord_index.get(snp)
+    # no index (see `load_snp_index.py`), scan the whole file
     for row in get_snp_data():
         _, rsid, row, pos = row
         if rsid == snp:
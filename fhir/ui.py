@@ -11,6 +11,7 @@ from urllib import urlencode
 from util import hash_password, get_api_base
 from ttam.models import TTAMClient
 from models import db, User, Session, Resource, Access, Client, SearchParam, App, Context
+import auth_cache
 from fhir_spec import RESOURCES
 
 ui = Blueprint('ui', __name__)
@@ -30,24 +31,15 @@ def log_in(user):
     return session_id
 
 
-# TODO make this more efficient using core insert
 def authorize_public_data(user):
     '''
     find all resources owned by super user, replicate them,
     and set owner to user
     '''
-    # find all resources owned by super user and replicate them
-    for resource in Resource.query.filter_by(owner_id='super'):
-        db.make_transient(resource) 
-        resource.owner = user
-        db.session.add(resource)
-    # find all search param owned by super user and replicate them
-    for sp in SearchParam.query.filter_by(owner_id='super'):
-        db.make_transient(sp)
-        sp.owner_id = user.email
-        sp.id = None
-        db.session.add(sp)
-    db.session.commit()
+    # copy resources and their search params in the database,
+    # rather than loading and re-adding them one by one
+    Resource.core_copy('super', user.email, bind=db.session)
+    SearchParam.core_copy('super', user.email, bind=db.session)
 
 
 def create_user(form):
@@ -58,9 +50,10 @@ def create_user(form):
     new_user = User(email=form['email'],
                     hashed_password=hashed,
                     salt=salt)
+    db.session.add(new_user)
+    db.session.flush()
     # give user access to public data
     authorize_public_data(new_user)
-    db.session.add(new_user)
     db.session.commit()
     return new_user
 
@@ -102,7 +95,7 @@ def get_session():
     get associated session from `session_id` cookie
     '''
     session_id = request.cookies.get('session_id') 
-    request.session = Session.query.filter_by(id=session_id).first()
+    request.session = auth_cache.get_session(session_id)
 
 
 @ui.route('/')
@@ -158,6 +151,7 @@ def logout():
         if session is not None:
             db.session.delete(session)
             db.session.commit()
+        auth_cache.forget_session(session_id)
 
     resp = redirect('/')
     resp.set_cookie('session_id', expires=0)
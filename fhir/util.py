@@ -4,7 +4,11 @@ from functools import partial
 from urlparse import urljoin
 import json
 import uuid
+import time
 import hashlib
+from threading import Lock
+from collections import OrderedDict, deque
+from datetime import datetime
 from werkzeug.datastructures import MultiDict
 
 FHIR_JSON_MIMETYPE = 'application/json'
@@ -12,38 +16,52 @@ FHIR_XML_MIMETYPE = 'application/xml'
 FHIR_BUNDLE_MIMETYPE = 'application/xml'
 
 FHIR_XMLNS = 'http://hl7.org/fhir'
+ATOM_XMLNS = 'http://www.w3.org/2005/Atom'
 XHTML_XMLNS = 'http://www.w3.org/1999/xhtml'
+ATOM_FEED_TAG = '{%s}feed' % ATOM_XMLNS
+ATOM_ENTRY_TAG = '{%s}entry' % ATOM_XMLNS
+# size of chunks in which xml documents are read (see `parse_xml`)
+XML_CHUNK_SIZE = 64 * 1024
 
 json_response = partial(Response, mimetype=FHIR_JSON_MIMETYPE)
 xml_response = partial(Response, mimetype=FHIR_XML_MIMETYPE)
 xml_bundle_response = partial(Response, mimetype=FHIR_BUNDLE_MIMETYPE)
 
 
-def _xml_to_json(root):
+def _elements_to_json(elements, jsondict):
     '''
-    helper function for converting an xml-formated FHIR resource into an json object
-
-    NOTE this can obviously be implemented way more efficient without recursion
+    helper function for converting xml elements of a FHIR resource into an json object,
+    json of each element is added to `jsondict` (json object of their parent)
     '''
-    if root.tag.split('}')[-1] == 'div':
-        return etree.tostring(root)
-    elif 'value' in root.attrib:
-        return root.attrib['value']
+    # local name of tags, e.g. "{http://hl7.org/fhir}name" -> "name"
+    names = {}
+    # (json object of parent, element) pairs yet to be converted
+    pending = [(jsondict, element) for element in reversed(elements)]
+    while pending:
+        parent, element = pending.pop()
+        tag = element.tag
+        if not isinstance(tag, basestring):
+            # comments and processing instructions
+            continue
+        name = names.get(tag)
+        if name is None:
+            name = names[tag] = tag[tag.rfind('}')+1:]
 
-    jsondict = {}
+        if name == 'div':
+            json_element = etree.tostring(element)
+        elif 'value' in element.attrib:
+            json_element = element.attrib['value']
+        else:
+            json_element = dict(element.attrib)
+            pending.extend((json_element, child) for child in reversed(element))
 
-    for element in root:
-        json_element = _xml_to_json(element)
-        tag_name = element.tag.split('}')[-1]
-        tag_val = jsondict.get(tag_name)
+        tag_val = parent.get(name)
         if tag_val is None:
-            jsondict[tag_name] = json_element
+            parent[name] = json_element
         elif isinstance(tag_val, list):
             tag_val.append(json_element)
         else:
-            jsondict[tag_name] = [tag_val, json_element]
-
-    jsondict.update(root.attrib)
+            parent[name] = [tag_val, json_element]
     return jsondict
 
 
@@ -51,56 +69,223 @@ def xml_to_json(root, resource_type):
     '''
     Convert an xml-formated FHIR resource into an json object
     '''
-    if 'xmlns' in root.attrib:
-        del root.attrib['xmlns']
-    jsondict = _xml_to_json(root)
+    jsondict = _elements_to_json(root, {})
+    jsondict.update(root.attrib)
+    jsondict.pop('xmlns', None)
     jsondict['resourceType'] = resource_type
     return jsondict
 
 
-def _to_xml(data, root):
+def _entry_to_json(entry):
     '''
-    convert a single json element (int, boolean, or object) into corresponding FHIR-XML-encoding
+    convert an entry of an Atom feed, only id and content of it is kept
     '''
-    if isinstance(data, dict):
-        _json_to_xml(data, root)
-    else:
-        data_str = str(data)
-        if isinstance(data, bool):
-            data_str = data_str.lower()
-        root.set('value', data_str)
+    json_entry = {'id': entry.findtext('{%s}id' % ATOM_XMLNS)}
+    content = entry.find('{%s}content' % ATOM_XMLNS)
+    if content is not None and len(content) > 0:
+        resource = content[0]
+        json_entry['content'] = xml_to_json(resource, resource.tag.split('}')[-1])
+    return json_entry
+
 
+def _entries_to_json(elements):
+    return [_entry_to_json(element) for element in elements if element.tag == ATOM_ENTRY_TAG]
 
-def _json_to_xml(jsondict, root):
+
+def _read_root_tag(source):
+    '''
+    read from `source` until we see the root element of a xml document,
+    return what's read and tag of the root
+    '''
+    parser = etree.XMLPullParser(events=('start',))
+    head = []
+    while True:
+        chunk = source.read(XML_CHUNK_SIZE)
+        if not chunk:
+            # raises XMLSyntaxError
+            parser.close()
+        head.append(chunk)
+        parser.feed(chunk)
+        for _, root in parser.read_events():
+            return ''.join(head), root.tag
+
+
+def parse_xml(source):
     '''
-    helper function for converting a json-formated FHIR resource into xml
+    Convert an xml-formated FHIR resource or Atom feed read from `source` (a file-like object)
+    into a json object
+
+    Unlike `xml_to_json`, children of the root are converted (and freed) as soon as they are parsed,
+    so we never keep the whole xml tree of a document in memory.
     '''
-    for k, v in jsondict.iteritems():
-        if isinstance(v, list):
-            for el in v:
-                new_node = etree.SubElement(root, k)
-                _to_xml(el, new_node)
+    head, root_tag = _read_root_tag(source)
+    # we only need the root, and making parser events (for other elements) isn't free
+    parser = etree.XMLPullParser(events=('start',), tag=root_tag)
+    root = None
+    jsondict = {}
+    entries = []
+    chunk = head
+    while chunk:
+        parser.feed(chunk)
+        events = parser.read_events()
+        if root is None:
+            _, root = next(events)
+        # drain events of elements (e.g. contained resources) sharing tag with the root
+        deque(events, maxlen=0)
+        # the last child might not be completely parsed yet
+        parsed = root[:-1]
+        if root_tag == ATOM_FEED_TAG:
+            entries.extend(_entries_to_json(parsed))
         else:
-            if k == 'div' and isinstance(v, basestring):
-                try:
-                    root.append(etree.fromstring(v))
+            _elements_to_json(parsed, jsondict)
+        del root[:-1]
+        chunk = source.read(XML_CHUNK_SIZE)
+    parser.close()
+
+    if root_tag == ATOM_FEED_TAG:
+        entries.extend(_entries_to_json(root))
+        return {'resourceType': 'Bundle', 'entry': entries}
+    _elements_to_json(root, jsondict)
+    jsondict.update(root.attrib)
+    jsondict.pop('xmlns', None)
+    jsondict['resourceType'] = root_tag.split('}')[-1]
+    return jsondict
+
+
+def _to_xml_value(data):
+    '''
+    convert a primitive json value (string, number, or boolean) into value of a FHIR-XML element
+    '''
+    if isinstance(data, basestring):
+        return data
+    elif isinstance(data, bool):
+        return str(data).lower()
+    return str(data)
+
+
+def _parse_div(data):
+    '''
+    parse a narrative (xhtml div), return None if it's not valid xml
+    '''
+    try:
+        return etree.fromstring(data)
+    except (etree.XMLSyntaxError, ValueError):
+        return None
+
+
+def json_to_etree(jsondict):
+    '''
+    Convert a json-formated FHIR resource into an xml element
+    '''
+    root = etree.Element(jsondict['resourceType'])
+    root.set('xmlns', FHIR_XMLNS)
+    # (element, json object) pairs whose children are yet to be converted
+    pending = [(root, jsondict)]
+    while pending:
+        node, data = pending.pop()
+        for k, v in data.iteritems():
+            if node is root and k == 'resourceType':
+                continue
+            for json_element in (v if isinstance(v, list) else (v,)):
+                if isinstance(json_element, dict):
+                    pending.append((etree.SubElement(node, k), json_element))
                     continue
-                except:
-                    pass
-            new_node = etree.SubElement(root, k)
-            _to_xml(v, new_node)
+                if k == 'div' and isinstance(json_element, basestring):
+                    div = _parse_div(json_element)
+                    if div is not None:
+                        node.append(div)
+                        continue
+                etree.SubElement(node, k).set('value', _to_xml_value(json_element))
+    return root
 
 
 def json_to_xml(jsondict):
     '''
     Convert a json-formated FHIR resource into xml
     '''
-    resource_type = jsondict['resourceType']
-    del jsondict['resourceType']
-    root = etree.Element(resource_type)
-    root.set('xmlns', FHIR_XMLNS)
-    _json_to_xml(jsondict, root)
-    return etree.tostring(root)
+    return etree.tostring(json_to_etree(jsondict))
+
+
+class LRUCache(object):
+    '''
+    A dictionary-like cache holding items of at most `capacity` in total size,
+    evicting the least recently used items when it's full.
+    Size of an item is given by `sizeof` (of its value), which is 1 by default,
+    i.e. `capacity` is the number of items.
+    '''
+    def __init__(self, capacity, sizeof=None):
+        self.capacity = capacity
+        self.sizeof = sizeof
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def _sizeof(self, value):
+        return self.sizeof(value) if self.sizeof is not None else 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            # move the item to the end (most recently used)
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.size -= self._sizeof(self._items.pop(key))
+            self._items[key] = value
+            self.size += self._sizeof(value)
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.capacity and self._items:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= self._sizeof(evicted)
+
+    def resize(self, capacity):
+        '''
+        change capacity of the cache, evicting items if it's shrunk
+        '''
+        with self._lock:
+            self.capacity = capacity
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items.pop(key)
+            self.size -= self._sizeof(value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._items)
+
+
+def buffer_chunks(chunks, size):
+    '''
+    join chunks of a streamed response so that each of them is at least `size` long
+    (except for the last one)
+    '''
+    buf = []
+    buf_len = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buf_len += len(chunk)
+        if buf_len >= size:
+            yield ''.join(buf)
+            buf = []
+            buf_len = 0
+    if buf:
+        yield ''.join(buf)
 
 
 def iterdict(d):
@@ -122,6 +307,55 @@ def iterdict(d):
             yield k, v
 
 
+# UCSC-style genomic binning (see http://genome.cshlp.org/content/12/6/996.full)
+# A sequence is put in the smallest bin that contains it,
+# there are 5 levels of bins of size 128kb, 1Mb, 8Mb, 64Mb and 512Mb.
+BIN_OFFSETS = (512+64+8+1, 64+8+1, 8+1, 1, 0)
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+
+def get_bin(start, end):
+    '''
+    return the bin of a sequence given its (inclusive) start and end position
+    '''
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = max(start, end) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if start_bin == end_bin:
+            return offset + start_bin
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    # sequence that goes beyond 512Mb, put it in the biggest bin
+    return 0
+
+
+def get_overlapping_bins(start, end):
+    '''
+    return ranges (as inclusive (first, last) pairs) of bins
+    that can have sequences overlapping with the (inclusive) start and end position
+    '''
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = max(start, end) >> BIN_FIRST_SHIFT
+    bins = []
+    for offset in BIN_OFFSETS:
+        bins.append((offset + start_bin, offset + end_bin))
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    if bins[-1][0] != 0:
+        # sequences beyond 512Mb are all in bin 0
+        bins.append((0, 0))
+    return bins
+
+
+def to_utc(local_time):
+    '''
+    convert a local time (e.g. `Resource.update_time`) to UTC, in seconds,
+    which is what HTTP dates (e.g. `Last-Modified`) are
+    '''
+    return datetime.utcfromtimestamp(time.mktime(local_time.timetuple()))
+
+
 def hash_password(password, salt=None):
     '''
     hash a password based on a salt
@@ -0,0 +1,112 @@
+'''
+Bulk load resources from a newline-delimited JSON file (one FHIR resource per line)
+
+$ python load_bulk.py resources.ndjson
+$ cat resources.ndjson | python load_bulk.py
+
+Resources are parsed by a pool of worker processes and saved in batches,
+so memory usage is bounded by the batch size rather than the size of the file.
+'''
+import sys
+import json
+import time
+from itertools import islice
+from argparse import ArgumentParser, FileType
+from multiprocessing import Pool, cpu_count
+from fhir.models import db, Resource, SearchParam, User, commit_buffers
+from fhir.indexer import index_resources
+from fhir.fhir_parser import parse_resources
+from fhir.fhir_spec import RESOURCES
+from fhir.search_stats import analyze
+
+BATCH_SIZE = 1000
+
+
+class MockG(object):
+    def __init__(self):
+        self._nodep_buffers = {}
+        self._reference_cache = {}
+
+
+def read_resources(lines, stats):
+    '''
+    yield (resource_type, resource) from lines of json,
+    skipping (and reporting) any line that's not a resource
+    '''
+    for line in lines:
+        stats['lines'] += 1
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            resource = json.loads(line)
+        except ValueError:
+            resource = None
+        if not isinstance(resource, dict) or resource.get('resourceType') not in RESOURCES:
+            stats['invalid'] += 1
+            print >> sys.stderr, 'line %d: not a resource' % stats['lines']
+            continue
+        yield resource['resourceType'], resource
+
+
+def save_batch(parsed, owner_id, stats):
+    '''
+    save a batch of parsed resources, return number of rows inserted
+    '''
+    buf = MockG()
+    resources = []
+    for valid, resource, search_elements in parsed:
+        if not valid:
+            stats['invalid'] += 1
+            continue
+        resources.append((Resource(resource['resourceType'], resource, owner_id=owner_id),
+                          search_elements))
+    index_resources(resources, g=buf)
+    num_search_params = len(buf._nodep_buffers.get(SearchParam, []))
+    commit_buffers(buf)
+    stats['resources'] += len(resources)
+    return len(resources) + num_search_params
+
+
+def load_bulk(ndjson_f, owner_id, pool, batch_size):
+    if User.query.get(owner_id) is None:
+        db.session.add(User(email=owner_id))
+        db.session.commit()
+
+    stats = {'lines': 0, 'invalid': 0, 'resources': 0}
+    num_rows = 0
+    start = time.time()
+    resources = read_resources(ndjson_f, stats)
+    while True:
+        batch = list(islice(resources, batch_size))
+        if len(batch) == 0:
+            break
+        num_rows += save_batch(parse_resources(batch, pool=pool), owner_id, stats)
+        elapsed = time.time() - start
+        print 'loaded %d resources (%.1f resources/s, %.1f rows/s)' % (
+                stats['resources'],
+                stats['resources'] / elapsed,
+                num_rows / elapsed)
+
+    elapsed = time.time() - start
+    print 'finished: %d resources, %d rows, %d invalid, in %.1f s' % (
+            stats['resources'], num_rows, stats['invalid'], elapsed)
+    if analyze(db.engine):
+        print 'updated statistics of query planner'
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('file', nargs='?', type=FileType('r'), default=sys.stdin)
+    # resources owned by "super" are public (see `fhir.models.Resource`)
+    arg_parser.add_argument('-o', '--owner', default='super')
+    arg_parser.add_argument('-p', '--processes', type=int, default=cpu_count())
+    arg_parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE)
+    arg_parser.add_argument('--base-url', default='http://localhost/',
+            help='url of the server, used to tell internal references from external ones')
+    args = arg_parser.parse_args()
+    # fork workers before the app is created so they don't inherit any database connection
+    pool = Pool(args.processes) if args.processes > 1 else None
+    from server import app
+    with app.test_request_context(base_url=args.base_url):
+        load_bulk(args.file, args.owner, pool, args.batch_size)
@@ -19,6 +19,7 @@ BASEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fhir')
 class MockG(object):
     def __init__(self):
         self._nodep_buffers = {}
+        self._reference_cache = {}
 
 BUF = MockG()
 
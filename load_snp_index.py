@@ -0,0 +1,16 @@
+'''
+Build the rsid -> coordinate index used by the 23andMe adaptor
+from the SNP file (`fhir/ttam/snps.sorted.txt.gz`)
+
+$ python load_snp_index.py
+'''
+import os
+from fhir.ttam.util import get_snp_data, write_coord_index, COORD_INDEX_FILE
+
+if __name__ == '__main__':
+    # write to a temporary file first so that a running server never sees a partial index
+    tmp_index_file = COORD_INDEX_FILE + '.tmp'
+    with open(tmp_index_file, 'wb') as index_f:
+        write_coord_index(index_f, get_snp_data())
+    os.rename(tmp_index_file, COORD_INDEX_FILE)
+    print 'wrote %s' % COORD_INDEX_FILE
@@ -3,10 +3,10 @@ import os
 import sys
 import json
 from fhir.sequence import sequence_resource, sequence_reference_types
+from fhir.fhir_spec import SPEC_FILE, write_specs
 
 # RE used to search resource profiles in FHIR's specs. directory
 PROFILE_F_RE = re.compile(r'^type-(?P<datatype>\w+).profile.json$|^(?P<resource>\w+).profile.json$')
-WARNING = 'WARNING: this is auto generated. Change it at your risk.'
 
 def load_and_process_profile(profile_loc):
     '''
@@ -55,6 +55,27 @@ def process_profile(profile):
     return elements, search_params, reference_types
 
 
+def strip_element(element):
+    '''
+    strip an element down to what we use to validate and index a resource
+    (i.e. no documentation)
+    '''
+    definition = element['definition']
+    stripped = {
+        'path': element['path'],
+        'definition': {
+            'min': definition['min'],
+            'max': definition['max']
+        }
+    }
+    if 'type' in definition:
+        stripped['definition']['type'] = [{'code': element_type['code']}
+                                          for element_type in definition['type']]
+    if 'searchParam' in element:
+        stripped['searchParam'] = element['searchParam']
+    return stripped
+
+
 def load_spec(spec_dir):
     '''
     Load FHIR specs. given directory of all the profiles
@@ -76,7 +97,7 @@ def load_spec(spec_dir):
                 resource_reference_types['assessed-condition'] = ['Condition']
 
             specs[name] = {
-                'elements': elements,
+                'elements': map(strip_element, elements),
                 'searchParams': resource_search_params
             }
 
@@ -91,14 +112,8 @@ def load_spec(spec_dir):
     resources.append('Sequence')
     print 'manually added Sequence resource for genomic support.'
 
-    with open('fhir/fhir_spec.py', 'w') as spec_target:
-        spec_target.write("'''\n%s\n'''" % WARNING)
-        spec_target.write('\n')
-        spec_target.write('SPECS=' + str(specs))
-        spec_target.write('\n')
-        spec_target.write('RESOURCES=set(%s)'% str(resources))
-        spec_target.write('\n')
-        spec_target.write('REFERENCE_TYPES=' + str(reference_types))
+    with open(SPEC_FILE, 'wb') as spec_target:
+        write_specs(spec_target, specs, resources, reference_types)
 
 if __name__ == '__main__':
     # find out where the specs. directory is.
@@ -0,0 +1,16 @@
+'''
+Bring the database in `config.py`, if it's created by an older version of the server,
+up to date (i.e. add columns and indexes added since then)
+
+$ python migrate_db.py
+'''
+from fhir import create_app, db
+from fhir.migration import migrate
+from config import APP_CONFIG
+
+if __name__ == '__main__':
+    with create_app(APP_CONFIG).app_context():
+        done = migrate(db.engine)
+    for step in done:
+        print step
+    print 'database is up to date'
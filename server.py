@@ -2,6 +2,7 @@ import subprocess
 from multiprocessing import cpu_count
 from argparse import ArgumentParser
 from fhir import create_app, db
+from fhir.text_index import create_text_index
 from config import APP_CONFIG, HOST
 # use this for WSGI server
 # e.g. `$ gunicorn server:app`
@@ -15,6 +16,7 @@ def clear_db(app):
     with app.app_context():
         db.drop_all()
         db.create_all() 
+        create_text_index(db.engine)
 
 if __name__ == '__main__':
     arg_parser = ArgumentParser()
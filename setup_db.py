@@ -4,8 +4,14 @@ for more advanced usage, well, this won't help
 '''
 import os
 import subprocess
-from config import PGUSERNAME, PGPASSWORD, DBNAME
+from config import PGUSERNAME, PGPASSWORD, DBNAME, APP_CONFIG
 
 if __name__ == '__main__':
     os.environ['PGPASSWORD'] = PGPASSWORD
     subprocess.call('psql -U%s -c "CREATE DATABASE %s"'% (PGUSERNAME, DBNAME), shell=True)
+    # tables are created by the app, the trigram index isn't (see `fhir.text_index`)
+    from fhir import create_app, db
+    from fhir.text_index import create_text_index
+    with create_app(APP_CONFIG).app_context():
+        if not create_text_index(db.engine):
+            print 'could not create trigram index of search params (see `fhir.text_index`)'